@@ -63,17 +63,21 @@ embedded_cpp_entry_points = """
 
 torch::Tensor entry(torch::Tensor t) {
     using namespace ks::entry_points;
-    auto ks_t = convert_to_ks_viewing_tensordata<ks::tensor<1, ks::Float>>(t);
-    auto ks_ret = ks::vgelu(&g_alloc, ks_t);
-    return convert_from_ks<torch::Tensor>(ks_ret);
+    return with_thread_allocator_torch([&](ks::allocator * alloc) {
+        auto ks_t = convert_to_ks_viewing_tensordata<ks::tensor<1, ks::Float>>(t);
+        auto ks_ret = ks::vgelu(alloc, ks_t);
+        return convert_from_ks<torch::Tensor>(ks_ret);
+    });
 }
 
 torch::Tensor entry_vjp(torch::Tensor t, torch::Tensor dret) {
     using namespace ks::entry_points;
-    auto ks_t = convert_to_ks_viewing_tensordata<ks::tensor<1, ks::Float>>(t);
-    auto ks_dret = convert_to_ks_viewing_tensordata<ks::tensor<1, ks::Float>>(dret);
-    auto ks_ret = ks::sufrev_vgelu(&g_alloc, ks_t, ks_dret);
-    return convert_from_ks<torch::Tensor>(ks_ret);
+    return with_thread_allocator_torch([&](ks::allocator * alloc) {
+        auto ks_t = convert_to_ks_viewing_tensordata<ks::tensor<1, ks::Float>>(t);
+        auto ks_dret = convert_to_ks_viewing_tensordata<ks::tensor<1, ks::Float>>(dret);
+        auto ks_ret = ks::sufrev_vgelu(alloc, ks_t, ks_dret);
+        return convert_from_ks<torch::Tensor>(ks_ret);
+    });
 }
 """
 
@@ -96,6 +100,16 @@ def vgelu_embedded_cpp_inlined_map():
     )
 
 
+def vgelu_embedded_cpp_inlined_map_views():
+    # As vgelu_embedded_cpp_inlined_map, but returning a view of the
+    # Knossos heap rather than a copy
+    return cpp_string_to_autograd_function(
+        cpp_inlined_map + embedded_cpp_entry_points,
+        "ksc_dl_activations__manual__vgelu_embedded_cpp_inlined_map_views",
+        extra_cflags=embedded_cflags + ksc.compile.view_results_cflags,
+    )
+
+
 def vgelu_embedded_cpp_inlined_map_flags():
     return cpp_string_to_autograd_function(
         cpp_inlined_map + embedded_cpp_entry_points,
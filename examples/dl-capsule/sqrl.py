@@ -81,17 +81,20 @@ embedded_cpp_entry_points = """
 
 ks::Float entry(torch::Tensor t) {
     using namespace ks::entry_points;
-    auto ks_t = convert_to_ks_viewing_tensordata<ks::tensor<2, ks::Float>>(t);
-    auto ks_ret = ks::sqrl(&g_alloc, ks_t);
-    return ks_ret;
+    return with_thread_allocator_torch([&](ks::allocator * alloc) {
+        auto ks_t = convert_to_ks_viewing_tensordata<ks::tensor<2, ks::Float>>(t);
+        return ks::sqrl(alloc, ks_t);
+    });
 }
 
 torch::Tensor entry_vjp(torch::Tensor t, ks::Float dret) {
     using namespace ks::entry_points;
-    auto ks_t = convert_to_ks_viewing_tensordata<ks::tensor<2, ks::Float>>(t);
-    auto ks_dret = dret;
-    auto ks_ret = ks::sufrev_sqrl(&g_alloc, ks_t, ks_dret);
-    return convert_from_ks<torch::Tensor>(ks_ret);
+    return with_thread_allocator_torch([&](ks::allocator * alloc) {
+        auto ks_t = convert_to_ks_viewing_tensordata<ks::tensor<2, ks::Float>>(t);
+        auto ks_dret = dret;
+        auto ks_ret = ks::sufrev_sqrl(alloc, ks_t, ks_dret);
+        return convert_from_ks<torch::Tensor>(ks_ret);
+    });
 }
 """
 
@@ -1,10 +1,10 @@
 # mypy: ignore-errors
 from collections import Counter
-from typing import Callable, Tuple, Dict, Set, Iterator, Sequence, Any, List
+from typing import Callable, Tuple, Dict, Set, Iterator, Sequence, Any, List, Optional
 
 from rlo import analytics
 from rlo import rewrites
-from rlo.node_evaluation_cache import NodeEvaluationCache
+from rlo.node_evaluation_cache import NodeEvaluationCache, evaluation_executor
 from rlo.search_ops import AbstractSearcher
 from rlo.tf_model import ModelWrapper
 from rlo.expression_util import ExprWithEnv
@@ -85,9 +85,15 @@ class EarliestEnqueuingCache(NodeEvaluationCache):
         model_wrapper: ModelWrapper,
         batch_size: int,
         enqueue_fn: Callable[[StateValueSearchTreeNode], None],
+        executor=None,
+        max_nodes_per_batch=None,
     ):
         super().__init__(
-            model_wrapper, batch_size, search_tree_node_class=StateValueSearchTreeNode
+            model_wrapper,
+            batch_size,
+            search_tree_node_class=StateValueSearchTreeNode,
+            executor=executor,
+            max_nodes_per_batch=max_nodes_per_batch,
         )
         self._greatest_time_left: Dict[ExprWithEnv, int] = {}
         self._pruned_count = 0
@@ -144,8 +150,8 @@ class EarliestEnqueuingCache(NodeEvaluationCache):
                     self._enqueue_fn(node)
         return node
 
-    def process_batches(self) -> Sequence[ExprWithEnv]:
-        exprs_evaluated = super().process_batches()
+    def collect_batches(self) -> Sequence[ExprWithEnv]:
+        exprs_evaluated = super().collect_batches()
         for exprenv in exprs_evaluated:
             self._enqueue_fn(self.earliest_existing_node(exprenv))
         return exprs_evaluated
@@ -232,17 +238,23 @@ class AStarSearcher(AbstractSearcher):
         self,
         max_gnn: int,
         batch_size: int = 16,
+        max_nodes_per_batch: Optional[int] = None,
         expander_factory: Callable[[rewrites.RuleMatcher], Expander] = LoggingExpander,
         cost_per_step=None,
+        async_eval: bool = False,
         **kwargs
     ):
+        """ If async_eval, batches are evaluated in the background while the search
+            expands other nodes on the open list (AStarSearcher only; subclasses evaluate synchronously). """
         super().__init__(**kwargs)
         if max_gnn < 1:
             raise ValueError("max_gnn {} must be a positive integer".format(max_gnn))
         self._max_gnn = max_gnn
         self._batch_size = batch_size
+        self._max_nodes_per_batch = max_nodes_per_batch
         self._expander_factory = expander_factory
         self._cost_per_step = cost_per_step
+        self._async_eval = async_eval
 
     def urgency(self, node: StateValueSearchTreeNode) -> float:
         # Negate expected final cost as higher urgency is better
@@ -287,27 +299,39 @@ class AStarSearcher(AbstractSearcher):
             Mostly this exists as a hook for subclasses (specifically BeamSearcher)
             to override and keep the other parts of _search. """
         open_list = UrgencyQueue()  # values are SearchTreeNodes
-        cache = EarliestEnqueuingCache(
-            model_wrapper,
-            self._batch_size,
-            lambda node: open_list.put(self.urgency(node), node),
-        )
-
-        # Note this will cause the root Expression to be evaluated, which isn't strictly necessary (if there are no routes back to it).
-        # But it'll help detect/handle routes back to the start node better if such are found.
-        start_posn = cache.get_node(start_expr, self._simulation_depth)
-
-        while cache.total_posns_evaluated < self._max_gnn:
-            if open_list.empty() and cache.eval_queue_length == 0:
-                break  # Nothing left we can do
-
-            if open_list.empty() or cache.has_sufficient_posns_to_eval():
-                cache.process_batches()
+        with evaluation_executor(self._async_eval) as executor:
+            cache = EarliestEnqueuingCache(
+                model_wrapper,
+                self._batch_size,
+                lambda node: open_list.put(self.urgency(node), node),
+                executor=executor,
+                max_nodes_per_batch=self._max_nodes_per_batch,
+            )
 
-            node = open_list.get()
-            # If the node has smaller time left than the best in the closed list, then ignore the node as it is a duplicate.
-            if not node._pruned:
-                expander(node, cache)
+            # Note this will cause the root Expression to be evaluated, which isn't strictly necessary (if there are no routes back to it).
+            # But it'll help detect/handle routes back to the start node better if such are found.
+            start_posn = cache.get_node(start_expr, self._simulation_depth)
+
+            while cache.total_posns_evaluated + cache.posns_in_flight < self._max_gnn:
+                if open_list.empty() and cache.eval_queue_length == 0:
+                    if cache.posns_in_flight == 0:
+                        break  # Nothing left we can do
+                    cache.collect_batches()
+                elif open_list.empty():
+                    cache.process_batches()
+                elif cache.has_sufficient_posns_to_eval():
+                    # Asynchronously, keep expanding while the batch is evaluated,
+                    # using the evaluations of the previous batch (collected first).
+                    if self._async_eval:
+                        cache.submit_batches()
+                    else:
+                        cache.process_batches()
+
+                node = open_list.get()
+                # If the node has smaller time left than the best in the closed list, then ignore the node as it is a duplicate.
+                if not node._pruned:
+                    expander(node, cache)
+            cache.collect_batches()
 
         return start_posn, cache, {"unexplored": len(open_list)}
 
@@ -49,6 +49,7 @@ class PseudoBeamSearcher(AStarSearcher):
             model_wrapper,
             self._batch_size,
             lambda node: open_lists[node.time_left].put(self.urgency(node), node),
+            max_nodes_per_batch=self._max_nodes_per_batch,
         )
 
         # Note this will cause the root Expression to be evaluated, which isn't strictly necessary (if there are no routes back to it).
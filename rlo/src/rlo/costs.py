@@ -55,7 +55,7 @@ assert all(k in Expression.node_types for k in _node_costs.keys())
 
 
 def cost(expr: Expression, defs: Mapping[str, Expression] = pmap()) -> float:
-    return _compute_cost(expr, defs, pmap())
+    return _subtree_cost(expr, defs, pmap(), cached=True)
 
 
 def _interpret_cost(e: Expression):
@@ -71,18 +71,52 @@ def _interpret_cost(e: Expression):
         raise ValueError("Only constant cost$ functions supported ATM")
 
 
+def _lam_cost(name: str, defs: Mapping[str, Expression], bound_lams: PMap[str, float]):
+    # Cost of calling the function bound to variable <name>.
+    if name in bound_lams:
+        return bound_lams[name]
+    cost_fn = defs.get("cost$" + name)
+    return _interpret_cost(cost_fn) if cost_fn is not None else default_edef_cost
+
+
+def _subtree_cost(
+    expr: Expression,
+    defs: Mapping[str, Expression],
+    bound_lams: PMap[str, float],
+    cached: bool,
+):
+    if not cached or len(expr.children) == 0:
+        return _compute_cost(expr, defs, bound_lams)
+    # The cost of a subtree depends upon its context (defs and bound_lams) only through the
+    # costs of the functions it calls, so we memoize on the Expression with those as key.
+    # Rewrites share all untouched subtrees with the original Expression, so costing the
+    # result of a rewrite recomputes only the spine from the rewritten node to the root.
+    key = tuple(_lam_cost(name, defs, bound_lams) for name in expr.free_lam_var_names)
+    if expr._cost_cache is None:
+        expr._cost_cache = {}
+    res = expr._cost_cache.get(key)
+    if res is None:
+        res = _compute_cost(expr, defs, bound_lams, cached=True)
+        expr._cost_cache[key] = res
+    return res
+
+
 def _compute_cost(
-    expr: Expression, defs: Mapping[str, Expression], bound_lams: PMap[str, float]
+    expr: Expression,
+    defs: Mapping[str, Expression],
+    bound_lams: PMap[str, float],
+    cached: bool = False,
 ):
     # First we (must) special-case all nodes binding or dealing with the environment (bound_lams)
     if expr.op == "let":
-        bound_cost = _compute_cost(expr.second, defs, bound_lams)
-        body_cost = _compute_cost(
+        bound_cost = _subtree_cost(expr.second, defs, bound_lams, cached)
+        body_cost = _subtree_cost(
             expr.third,
             defs,
             bound_lams.set(expr.first.name, bound_cost)
             if expr.second.type is not None and expr.second.type.kind == "Lam"
             else bound_lams.discard(expr.first.name),
+            cached,
         )
         # For Lambdas, we incur no cost now (the cost will be incurred when the function is used).
         # This is fine for compute but may not put enough emphasis on program size.
@@ -98,25 +132,20 @@ def _compute_cost(
         # but at present "(def f rettype (x:type) (body))" sparses to "let f = (lam x body) in f"
         # so we must give that some cost to incentivize optimization.
         if expr.type is not None and expr.type.kind == "Lam":
-            cost_fn = defs.get("cost$" + expr.name)
-            return (
-                bound_lams[expr.name]
-                if expr.name in bound_lams
-                else _interpret_cost(cost_fn)
-                if cost_fn is not None
-                else default_edef_cost
-            )
+            return _lam_cost(expr.name, defs, bound_lams)
         # Variable (eager evaluation)
         return 0
     if expr.op == "lam":
         assert expr.left.op == "variable" and expr.left.type is not None
         # Variable is not bound to a lam, so costs 0 (eager evaluation)
-        return _compute_cost(expr.right, defs, bound_lams.discard(expr.left.name))
+        return _subtree_cost(
+            expr.right, defs, bound_lams.discard(expr.left.name), cached
+        )
     if expr.op in ["build", "sumbuild"]:
         assert expr.second.op == "variable"
-        size_cost = _compute_cost(expr.first, defs, bound_lams)
-        body_cost = _compute_cost(
-            expr.third, defs, bound_lams.discard(expr.second.name)
+        size_cost = _subtree_cost(expr.first, defs, bound_lams, cached)
+        body_cost = _subtree_cost(
+            expr.third, defs, bound_lams.discard(expr.second.name), cached
         )
         child_cost = (
             size_cost + body_cost * assumed_vector_size
@@ -130,7 +159,7 @@ def _compute_cost(
         return 0
     if expr.op == "stop" and expr.declared_cost is not None:
         return expr.declared_cost
-    child_costs = [_compute_cost(c, defs, bound_lams) for c in expr.children]
+    child_costs = [_subtree_cost(c, defs, bound_lams, cached) for c in expr.children]
     # Special case cost of 'if'
     if expr.op == "if":
         arm_cost = sum(
@@ -179,3 +208,54 @@ def elementwise_cost(
     assert typ.is_lam_or_LM
     # It doesn't make sense to apply operation to Lam in first-order ksc.
     raise ValueError("elementwise_cost not defined for Lam / LM")
+
+
+_benchmark_expression_sets = [
+    "ksc/blas/blas_combined.kso",
+    "ksc/gmm/gmm_test.kso",
+    "ksc/conv1d_rev/conv1d_rev_test.kso",
+    "ksc/release/gelu.kso",
+]
+
+
+def _get_benchmarks():
+    from rlo.expr_sets import get_expression_set
+
+    return [
+        e
+        for set_name in _benchmark_expression_sets
+        for _, e in get_expression_set(set_name).named_exprenvs()
+    ]
+
+
+def _timeit(n=10, rules_name="binding_simplify_rules"):
+    """ Compares costing the result of every rewrite of each expression (as search does, having
+        already costed the expression itself) using incremental cost against the full _compute_cost. """
+    from time import perf_counter
+    from rlo.rewrites import get_rules
+
+    benchmarks = _get_benchmarks()
+    rewrites = get_rules(rules_name)
+    for e in benchmarks:
+        _ = e.cost()
+    times = {"Full _compute_cost": 0.0, "Incremental cost": 0.0}
+    num_children = 0
+    for _ in range(n):
+        for e in benchmarks:
+            # Apply the rewrites afresh each time so that nothing on the spine is cached.
+            children = [rw.apply(e) for rw in rewrites.get_all_rewrites(e)]
+            num_children += len(children)
+            start = perf_counter()
+            for c in children:
+                _ = _compute_cost(c.expr, c.env.defs, pmap())
+            times["Full _compute_cost"] += perf_counter() - start
+            start = perf_counter()
+            for c in children:
+                _ = cost(c.expr, c.env.defs)
+            times["Incremental cost"] += perf_counter() - start
+    for name, t in times.items():
+        print(f"{name}: {t:.3f}s for {num_children} rewritten expressions")
+
+
+if __name__ == "__main__":
+    _timeit()
@@ -1,8 +1,10 @@
 # fmt: off
 # mypy: ignore-errors
+from contextlib import contextmanager
 import functools
 import hashlib
 import re
+import weakref
 from typing import Any, Callable, Dict, Generator, List, Mapping, Optional, Sequence, Tuple, Union
 
 from rlo import utils
@@ -27,7 +29,55 @@ class TypePropagationError(Exception):
     pass
 
 
-class Expression:
+# When not None, maps the structure of every live Expression to that Expression; see interning().
+_intern_table: Optional[weakref.WeakValueDictionary] = None
+# When interning, the sets of free variable names (which are otherwise a large part of the memory used).
+_interned_var_sets: Optional[Dict[frozenset, frozenset]] = None
+
+def _intern_key(op, children, kwargs):
+    # Children are identified by object identity: if they were themselves interned, that is structural identity.
+    # Constants are keyed by the repr of the value (and its python type), as 1 == 1.0 == True and 0.0 == -0.0.
+    return (op, tuple(id(c) for c in children)) + tuple(
+        (k, (type(v), repr(v)) if k == "value" else v) for k, v in sorted(kwargs.items()) if v is not None)
+
+class _Interning(type):
+    """ Metaclass for Expression that, when interning is enabled, returns an existing Expression
+        in place of constructing a new one with the same structure. """
+    def __call__(cls, op, children, **kwargs):
+        if _intern_table is None:
+            return super().__call__(op, children, **kwargs)
+        key = _intern_key(op, children, kwargs)
+        res = _intern_table.get(key)
+        if res is None:
+            res = super().__call__(op, children, **kwargs)
+            _intern_table[key] = res
+        return res
+
+@contextmanager
+def interning():
+    """ Within this context, constructing an Expression structurally identical (same ops, names, values and
+        types throughout) to any live Expression returns that Expression, rather than a copy. Search produces many
+        Expressions differing only in a small subtree, so this saves much memory, and makes comparisons of
+        shared subtrees (e.g. by ExprWithEnv.__eq__) succeed immediately by identity.
+
+        Only Expressions constructed within the context are interned; Expressions built outside
+        (e.g. unpickled, or parsed beforehand) can be brought in with intern_expression. """
+    global _intern_table, _interned_var_sets
+    prev = (_intern_table, _interned_var_sets)
+    if _intern_table is None:
+        _intern_table, _interned_var_sets = weakref.WeakValueDictionary(), {}
+    try:
+        yield
+    finally:
+        _intern_table, _interned_var_sets = prev
+
+def intern_expression(e: "Expression") -> "Expression":
+    """ Returns the interned Expression structurally identical to <e>. Must be called within interning(). """
+    assert _intern_table is not None, "Interning is not enabled"
+    return Expression(e.op, [intern_expression(c) for c in e.children], **e._constructor_kwargs())
+
+
+class Expression(metaclass=_Interning):
     """
     Represents an expressions as a tree of operations, with each sub-tree being an Expression.
 
@@ -36,6 +86,12 @@ class Expression:
         self.op: a string specifying the operations type (e.g. "add", "let")
 
     """
+    # Each Expression is immutable once constructed; _hash, _free_lam_var_names, _cost_cache and _rewrites_cache are caches computed on demand.
+    # _rewritten_from is a weak reference to the Expression (if any) from which a Rewrite produced this one (see rlo.graph_data).
+    __slots__ = ("op", "children", "name", "value", "size", "declared_cost", "_type", "_num_nodes", "_hash",
+        "_free_var_names", "_next_unused_var", "_free_lam_var_names", "_cost_cache", "_rewrites_cache", "_rewritten_from",
+        "__weakref__")
+
     # dict from op/type to num_children.
     node_types = {
         "constant": 0,
@@ -126,6 +182,10 @@ class Expression:
 
         self._num_nodes = 1 + sum([n.num_nodes for n in self.children])
         self._hash = None # compute on demand
+        self._free_lam_var_names = None # compute on demand
+        self._cost_cache = None # see rlo.costs
+        self._rewrites_cache = None # see rlo.rewrites.RuleSet
+        self._rewritten_from = None # see rlo.rewrites.Rewrite.apply
         # Compute free variables.
         if self.is_binder:
             # Free vars of parent = union of free vars of children, EXCEPT that we don't count the binding occurrence,
@@ -141,6 +201,8 @@ class Expression:
             self._free_var_names = frozenset([self.name])
         else:
             self._free_var_names = functools.reduce(frozenset.union, (ch.free_var_names for ch in self.children), frozenset())
+        if _interned_var_sets is not None:
+            self._free_var_names = _interned_var_sets.setdefault(self._free_var_names, self._free_var_names)
         # Compute index of next unused temporary var
         if self.op == "variable":
             m = re.fullmatch("var([\\d]+)", self.name)
@@ -148,6 +210,18 @@ class Expression:
         else:
             self._next_unused_var = max([0] + [ch._next_unused_var for ch in self.children])
 
+    # Slots not pickled, as they are caches that may refer to objects (e.g. RuleSets) whose identity would not survive.
+    _unpickled_slots = ("_free_lam_var_names", "_cost_cache", "_rewrites_cache", "_rewritten_from", "__weakref__")
+
+    def __getstate__(self):
+        return {k: getattr(self, k) for k in self.__slots__ if k not in self._unpickled_slots and hasattr(self, k)}
+
+    def __setstate__(self, state):
+        for k in self._unpickled_slots[:-1]:
+            setattr(self, k, None)
+        for k, v in state.items():
+            setattr(self, k, v)
+
     def without_stop(self):
         return self.only_child.without_stop() if self.op == "stop" else self
 
@@ -389,7 +463,9 @@ class Expression:
               by renaming bound variables), producing a boolean.
             To construct the expression that compares values at runtime, use EF.Eq().
             To check the expressions are the same without alpha-renaming, use str(e)==str(e2). """
-            #(Or, if we had a flyweight pattern, could require using "is").
+            # (Within interning(), structurally identical Expressions are the same object, so the first check suffices.)
+        if self is other:
+            return True
         if not isinstance(other, Expression):
             return False
         sd = self._get_var_mapping(other)
@@ -577,6 +653,23 @@ class Expression:
     def free_var_names(self):
         return self._free_var_names
 
+    @property
+    def free_lam_var_names(self) -> Tuple[str, ...]:
+        """ The (sorted) names of free variables that have Lam type, i.e. functions called from this Expression. """
+        if self._free_lam_var_names is None:
+            if self.op == "variable":
+                names = {self.name} if self.type is not None and self.type.kind == "Lam" else set()
+            else:
+                names = set()
+                for i, ch in enumerate(self.children):
+                    ch_names = ch.free_lam_var_names
+                    if self.is_binder and self.binds_in_child(i):
+                        names.update(n for n in ch_names if n != self.bound_var.name)
+                    else:
+                        names.update(ch_names)
+            self._free_lam_var_names = tuple(sorted(names))
+        return self._free_lam_var_names
+
     @staticmethod
     def new_var(*exprs, type=None):
         """ Makes a variable with a name fresh within all Expressions in exprs (or this Expression if no exprs)"""
@@ -591,24 +684,27 @@ class Expression:
     def node_ids_with_environment(self, idx_offset=0, env=None, stop_at_stop=True):
         """ Generator, yields tuples (index, Expression, environment) for all subexps (except binding occurrences of variables).
             The environment is a mapping from variable names to tuple (index of binder, bound value), for let-bound variables only. """
-        if env is None:
-            env = {}
-        if self.op == "stop" and stop_at_stop:
-            return
-        yield (idx_offset, self, env)
-        if self.is_binder:
-            if self.op == "let":
-                bound_env = {**env, self.first.name: (idx_offset, self.second)}
+        # Iterative rather than recursive, as nested generators cost time proportional to depth for every node yielded.
+        stack = [(idx_offset, self, {} if env is None else env)]
+        while len(stack) > 0:
+            idx, node, env = stack.pop()
+            if node.op == "stop" and stop_at_stop:
+                continue
+            yield (idx, node, env)
+            # Push children in reverse order, so they are popped (and yielded) in order
+            children = list(node.children_with_indices(idx))
+            if node.is_binder:
+                if node.op == "let":
+                    bound_env = {**env, node.first.name: (idx, node.second)}
+                else:
+                    bound_env = {k:v for k,v in env.items() if k != node.bound_var.name}
+                for i in reversed(range(len(children))):
+                    if i != node._bound_var_index:
+                        child, c_idx = children[i]
+                        stack.append((c_idx, child, bound_env if node.binds_in_child(i) else env))
             else:
-                bound_env = {k:v for k,v in env.items() if k != self.bound_var.name}
-            for i, (child, c_idx) in enumerate(self.children_with_indices(idx_offset)):
-                if i != self._bound_var_index:
-                    yield from child.node_ids_with_environment(c_idx,
-                        bound_env if self.binds_in_child(i) else env,
-                        stop_at_stop)
-        else:
-            for child, c_idx in self.children_with_indices(idx_offset):
-                yield from child.node_ids_with_environment(c_idx, env, stop_at_stop)
+                for child, c_idx in reversed(children):
+                    stack.append((c_idx, child, env))
 
 
     def get_path(self, to_id: int, idx_offset: int=0) -> Generator[Tuple[int, "Expression", Optional[int]], None, None]:
@@ -715,12 +811,15 @@ class Expression:
         assert len(self.children) == len(new_children)
         if len(new_children) == 0:
             return self
-        extra_args = ({"name": self.name, "type": self.type} if self.op == "variable"
+        return Expression(self.op, new_children, **self._constructor_kwargs())
+
+    def _constructor_kwargs(self) -> Dict[str, Any]:
+        """ The keyword arguments (besides op and children) with which to construct a copy of this node. """
+        return ({"name": self.name, "type": self.type} if self.op == "variable"
             else {"value": self.value, "type": self.type} if self.op == "constant"
             else {"size": self.size} if self.op == "select"
             else {"cost": self.declared_cost} if self.op == "stop"
             else {})
-        return Expression(self.op, new_children, **extra_args)
 
     _child_accessor_name_map = {
         # A map from the name of each of the child accessors, to which element is selected.
@@ -93,6 +93,8 @@ def rollout_searcher_from_config(
     optional = ("batch_size",)
     renames = (
         ("search_batch_size", "batch_size"),
+        ("max_nodes_per_eval_batch", "max_nodes_per_batch"),
+        ("async_search_eval", "async_eval"),
         (f"max_num_episodes_{phase}", "max_num_episodes"),
         (f"simulation_depth_{phase}", "simulation_depth"),
     )
@@ -115,6 +117,7 @@ def searcher_kwargs_from_config(config: ConfigType, phase: PhaseType) -> Dict[st
     )
     renames = (
         ("search_batch_size", "batch_size"),
+        ("max_nodes_per_eval_batch", "max_nodes_per_batch"),
         (f"max_gnn_{phase}", "max_gnn"),
         (f"simulation_depth_{phase}", "simulation_depth"),
     )
@@ -130,7 +133,10 @@ def astar_searcher_from_config(
 ) -> AbstractSearcher:
     from rlo.astar_search import AStarSearcher
 
-    return AStarSearcher(**searcher_kwargs_from_config(config, phase))
+    return AStarSearcher(
+        **searcher_kwargs_from_config(config, phase),
+        **kwargs_from_config(config, (), (), (("async_search_eval", "async_eval"),)),
+    )
 
 
 def beam_searcher_from_config(config: ConfigType, phase: PhaseType) -> AbstractSearcher:
@@ -374,7 +380,7 @@ def torch_model_from_config(config: ConfigType, seed: Optional[int] = None) -> M
     model_kwargs = kwargs_from_config(
         config,
         required_keys=("num_gnn_blocks", "loss", "lr", "aggregation_over_edge_types"),
-        optional_keys=("num_propagations",),
+        optional_keys=("num_propagations", "fuse_edge_types"),
         renames=[
             ("hidden_dim", "gnn_hidden_dim"),
             ("output_hidden_dim", "regressor_hidden_dim"),
@@ -450,7 +456,20 @@ def single_regressor_from_config(config: ConfigType, seed=None):
     data_converter = data_converter_from_config(config)
     model = torch_model_from_config(config)
     device = torch_device_from_config(config)
-    return TorchModelWrapper(model=model, data_converter=data_converter, device=device)
+    return TorchModelWrapper(
+        model=model,
+        data_converter=data_converter,
+        device=device,
+        **kwargs_from_config(
+            config,
+            (),
+            (),
+            (
+                ("quantize_search_model", "quantize_inference"),
+                ("search_eval_threads", "inference_threads"),
+            ),
+        ),
+    )
 
 
 def regressor_from_config(config: ConfigType):
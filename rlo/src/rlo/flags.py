@@ -65,6 +65,13 @@ general_arguments = [
         choices=available_aggregations,
         help="aggregation of all edge_type messages before passing into gru",
     ),
+    Args(
+        "--unfused_edge_types",
+        action="store_false",
+        dest="fuse_edge_types",
+        help="In each GNN propagation, pass messages along each edge type in turn, rather than "
+        "along edges of all types together (equivalent, but slower); PyTorch only",
+    ),
     Args(
         "--decoder_readout",
         type=str,
@@ -299,6 +306,51 @@ search_algorithm_arguments = [
         default=16,
         help="Batch size to use for GNN evaluation during search",
     ),
+    Args(
+        "--max_nodes_per_eval_batch",
+        type=int,
+        default=None,
+        help="If set, GNN evaluation batches during search are bounded by this number of nodes, "
+        "instead of --search_batch_size expressions",
+    ),
+    Args(
+        "--async_search_eval",
+        action="store_true",
+        help="Evaluate search batches in a background thread while the search continues; for A*/Rollout only",
+    ),
+    Args(
+        "--value_cache_mb",
+        type=float,
+        default=None,
+        help="If set, each worker keeps model evaluations from searches (e.g. training searches, "
+        "for reuse by eval searches with the same weights) in an LRU cache of this many megabytes",
+    ),
+    Args(
+        "--graph_cache_mb",
+        type=float,
+        default=None,
+        help="If set, each worker keeps the graphs of recently encoded expressions (from which the "
+        "graphs of their rewrites are derived) in an LRU cache of about this many megabytes, instead "
+        "of 256; 0 disables the cache",
+    ),
+    Args(
+        "--intern_expressions",
+        action="store_true",
+        help="Within each worker task (e.g. a search), share one Expression object between all "
+        "structurally identical Expressions, to save memory (see expression.interning)",
+    ),
+    Args(
+        "--quantize_search_model",
+        action="store_true",
+        help="Evaluate expressions in search with a copy of the model whose linear and GRU layers are "
+        "dynamically quantized to int8; PyTorch on CPU only",
+    ),
+    Args(
+        "--search_eval_threads",
+        type=int,
+        default=None,
+        help="If set, the number of CPU threads PyTorch uses to evaluate expressions in search",
+    ),
     Args(
         "--hybrid_merge_handling",
         type=str.upper,
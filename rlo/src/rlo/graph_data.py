@@ -1,12 +1,14 @@
 # mypy: ignore-errors
+from collections import OrderedDict
 from enum import IntEnum, unique
 import itertools
-from typing import NamedTuple, Tuple
+import threading
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple
 
 import numpy as np
 
 from rlo.expression import Expression
-from rlo.group_subexps import nodes_and_groups
+from rlo.group_subexps import nodes_and_closest_binders, nodes_and_groups
 
 
 class GraphData(NamedTuple):
@@ -74,9 +76,429 @@ assert all(
 )
 
 
+# Each backward edge type immediately follows the corresponding forward type
+assert all(
+    bwd == fwd + 1
+    for fwd, bwd in zip(
+        EdgeType.forward_edge_types + [EdgeType.TUPLE_CHILD_FWD],
+        EdgeType.backward_edge_types + [EdgeType.TUPLE_CHILD_BWD],
+    )
+)
+_num_child_edge_types = EdgeType.SUBTREE_MATCH
+
+
+class _PreorderGraph(NamedTuple):
+    """ A flat encoding of the tree of an Expression, one element per node in pre-order
+    (the order of Expression.nodes). """
+
+    node_reps: np.ndarray
+    """ Array of shape [num_nodes, ], the node type of each node. """
+
+    parents: np.ndarray
+    """ Array of shape [num_nodes, ], the index of each node's parent (-1 for the root). """
+
+    fwd_edge_types: np.ndarray
+    """ Array of shape [num_nodes, ], the EdgeType of the edge from each node's parent
+        to the node (-1 for the root). """
+
+
+def _encode(expression: Expression) -> _PreorderGraph:
+    node_reps = []
+    parents = []
+    fwd_edge_types = []
+    stack = [(expression, -1, -1)]
+    while len(stack) > 0:
+        node, parent, edge_type = stack.pop()
+        idx = len(node_reps)
+        node_reps.append(Expression.node_type_lookup[node.op])
+        parents.append(parent)
+        fwd_edge_types.append(edge_type)
+        if len(node.children) > 0:
+            # Each consecutive child will be given a different edge type, except for tuple operations
+            edge_types = (
+                itertools.repeat(EdgeType.TUPLE_CHILD_FWD)
+                if node.op == "tuple"
+                else EdgeType.forward_edge_types
+            )
+            stack.extend(
+                reversed([(c, idx, t) for c, t in zip(node.children, edge_types)])
+            )
+    return _PreorderGraph(
+        np.array(node_reps, dtype=np.int32),
+        np.array(parents, dtype=np.int32),
+        np.array(fwd_edge_types, dtype=np.int32),
+    )
+
+
+class _Change(NamedTuple):
+    idx: int
+    """ The index of the changed subtree. """
+
+    old_subtree: Expression
+    new_subtree: Expression
+
+    spine: List[Tuple[int, Expression, int]]
+    """ For each ancestor of the changed subtree in the new Expression, outermost first, its index,
+        the node itself, and which of its children leads to the changed subtree. """
+
+
+def _changed_subtree(old: Expression, new: Expression) -> Optional[_Change]:
+    """ Returns the smallest subtree outside which <new> is made of the same nodes as <old>,
+        or None if <old> is <new>. Uses only object identity, so is fast for Expressions
+        sharing most of their subtrees (as does the result of a Rewrite with the original). """
+    idx = 0
+    spine = []
+    while old is not new:
+        differing = [
+            i for i, (o, n) in enumerate(zip(old.children, new.children)) if o is not n
+        ]
+        if (
+            old.op != new.op
+            or len(old.children) != len(new.children)
+            or len(differing) != 1
+        ):
+            # Note no differing children means the nodes differ in e.g. variable name or constant value
+            return _Change(idx, old, new, spine)
+        i = differing[0]
+        spine.append((idx, new, i))
+        idx += 1 + sum(c.num_nodes for c in old.children[:i])
+        old, new = old.children[i], new.children[i]
+    return None
+
+
+def _splice(
+    graph: _PreorderGraph, idx: int, old_num_nodes: int, subtree: _PreorderGraph
+) -> _PreorderGraph:
+    """ The encoding of <graph> with the subtree at <idx>, of <old_num_nodes> nodes,
+        replaced by the encoding <subtree>. """
+    end = idx + old_num_nodes
+    delta = len(subtree.node_reps) - old_num_nodes
+    # Parents of nodes after the subtree are before its root, or after it (so move by delta).
+    parents_after = graph.parents[end:]
+    parents_after = np.where(parents_after >= end, parents_after + delta, parents_after)
+    subtree_parents = subtree.parents + idx
+    subtree_parents[0] = graph.parents[idx]
+    subtree_edge_types = subtree.fwd_edge_types.copy()
+    subtree_edge_types[0] = graph.fwd_edge_types[idx]
+    return _PreorderGraph(
+        np.concatenate(
+            [graph.node_reps[:idx], subtree.node_reps, graph.node_reps[end:]]
+        ),
+        np.concatenate([graph.parents[:idx], subtree_parents, parents_after]),
+        np.concatenate(
+            [graph.fwd_edge_types[:idx], subtree_edge_types, graph.fwd_edge_types[end:]]
+        ),
+    )
+
+
+def _child_edge_lists(graph: _PreorderGraph) -> List[np.ndarray]:
+    """ The edge lists (as in GraphData) for all edge types except SUBTREE_MATCH. """
+    dsts = np.arange(1, len(graph.node_reps), dtype=np.int32)
+    srcs = graph.parents[1:]
+    fwd_types = graph.fwd_edge_types[1:]
+    # Order by edge type, then (as the nodes are traversed) by parent, then by child
+    order = np.lexsort((dsts, srcs, fwd_types))
+    edges = np.stack([srcs[order], dsts[order]], axis=1)
+    bounds = np.searchsorted(
+        fwd_types[order], np.arange(_num_child_edge_types + 1, dtype=np.int32)
+    )
+    edge_lists = []
+    for fwd_type in range(0, _num_child_edge_types, 2):
+        fwd = edges[bounds[fwd_type] : bounds[fwd_type + 1]]
+        edge_lists.extend([fwd, np.ascontiguousarray(fwd[:, ::-1])])
+    return edge_lists
+
+
+_labels_lock = threading.Lock()
+_next_label = 0
+
+
+def _new_labels(num_nodes: int) -> np.ndarray:
+    """ Labels for <num_nodes> nodes, distinct from all labels returned before. """
+    global _next_label
+    with _labels_lock:
+        start = _next_label
+        _next_label += num_nodes
+    return np.arange(start, start + num_nodes, dtype=np.int64)
+
+
+class _SubtreeClasses(NamedTuple):
+    """ Which subtrees of an Expression are equivalent (as in rlo.group_subexps.nodes_and_groups),
+        one element per node in pre-order, in a form that can be updated after a Rewrite. """
+
+    labels: np.ndarray
+    """ Array of shape [num_nodes, ], distinct for each node. Nodes outside the changed subtree
+        keep their labels when the Expression is rewritten. """
+
+    closest_binders: np.ndarray
+    """ Array of shape [num_nodes, ], the label of the closest binder of each node (-1 if none). """
+
+    class_ids: np.ndarray
+    """ Array of shape [num_nodes, ], equal for nodes that are equivalent. """
+
+    representatives: Dict[Tuple[int, int, str], Any]
+    """ For each (closest binder, num_nodes, op), an Expression of each class of subtrees with
+        those, and the class id: either a tuple of (Expression, class id) pairs or, if there are more
+        than _max_linear_representatives classes, a dict from Expression to class id. May include
+        classes that no longer have any nodes. Shared with updated _SubtreeClasses. """
+
+    num_classes: int
+
+
+# Comparing a new subtree with one sharing most of its children is cheap, whereas
+# hashing a new subtree within the scope of a binder traverses all of it.
+_max_linear_representatives = 8
+
+
+def _classify(
+    nodes: Sequence[Expression],
+    closest_binders: Sequence[int],
+    representatives: Dict[Tuple[int, int, str], Any],
+    num_classes: int,
+) -> Tuple[List[int], int]:
+    """ Returns the class id of each of <nodes>, and the new total number of classes, adding classes
+        to <representatives> (replacing rather than modifying its values). """
+    class_ids = []
+    for node, closest_binder in zip(nodes, closest_binders):
+        key = (closest_binder, node.num_nodes, node.op)
+        reps = representatives.get(key, ())
+        if isinstance(reps, tuple):
+            class_id = next((c for rep, c in reps if rep == node), None)
+        else:
+            class_id = reps.get(node)
+        if class_id is None:
+            class_id = num_classes
+            num_classes += 1
+            if isinstance(reps, dict):
+                reps = {**reps, node: class_id}
+            elif len(reps) < _max_linear_representatives:
+                reps = reps + ((node, class_id),)
+            else:
+                reps = {**dict(reps), node: class_id}
+            representatives[key] = reps
+        class_ids.append(class_id)
+    return class_ids, num_classes
+
+
+def _subtree_classes(expression: Expression) -> _SubtreeClasses:
+    labels = _new_labels(expression.num_nodes)
+    nodes, closest_binders = nodes_and_closest_binders(
+        expression, idx_offset=int(labels[0])
+    )
+    representatives: Dict[Tuple[int, int, str], Any] = {}
+    class_ids, num_classes = _classify(nodes, closest_binders, representatives, 0)
+    return _SubtreeClasses(
+        labels,
+        np.array(closest_binders, dtype=np.int64),
+        np.array(class_ids, dtype=np.int64),
+        representatives,
+        num_classes,
+    )
+
+
+def _update_subtree_classes(
+    classes: _SubtreeClasses, change: _Change
+) -> _SubtreeClasses:
+    """ The _SubtreeClasses of the Expression with <change> from that of <classes>. Only the nodes
+        in the new subtree, and its ancestors, are classified again. """
+    binder_stack: List[Tuple[str, int]] = []
+    spine_idxs, spine_nodes, spine_closest_binders = [], [], []
+    for idx, node, child_idx in change.spine:
+        spine_idxs.append(idx)
+        spine_nodes.append(node)
+        spine_closest_binders.append(
+            next(
+                (
+                    label
+                    for name, label in reversed(binder_stack)
+                    if name in node.free_var_names
+                ),
+                -1,
+            )
+        )
+        if node.is_binder and node.binds_in_child(child_idx):
+            binder_stack.append((node.bound_var.name, int(classes.labels[idx])))
+    subtree_labels = _new_labels(change.new_subtree.num_nodes)
+    subtree_nodes, subtree_closest_binders = nodes_and_closest_binders(
+        change.new_subtree, binder_stack, idx_offset=int(subtree_labels[0])
+    )
+    representatives = dict(classes.representatives)
+    class_ids, num_classes = _classify(
+        spine_nodes + subtree_nodes,
+        spine_closest_binders + subtree_closest_binders,
+        representatives,
+        classes.num_classes,
+    )
+
+    end = change.idx + change.old_subtree.num_nodes
+
+    def splice(arr, subtree_arr, spine_arr=None):
+        res = np.concatenate([arr[: change.idx], subtree_arr, arr[end:]])
+        if spine_arr is not None:
+            res[spine_idxs] = spine_arr
+        return res
+
+    return _SubtreeClasses(
+        splice(classes.labels, subtree_labels),
+        splice(classes.closest_binders, subtree_closest_binders, spine_closest_binders),
+        splice(
+            classes.class_ids,
+            class_ids[len(spine_nodes) :],
+            class_ids[: len(spine_nodes)],
+        ),
+        representatives,
+        num_classes,
+    )
+
+
+def _subtree_match_edges(class_ids: np.ndarray) -> np.ndarray:
+    """ Edges (in both directions) linking each class of equivalent subtrees into a clique,
+        ordered by source and then destination. """
+    # Node indices grouped by class, each class in order of index
+    nodes = np.argsort(class_ids, kind="stable")
+    sorted_ids = class_ids[nodes]
+    starts = np.flatnonzero(np.r_[True, sorted_ids[1:] != sorted_ids[:-1]])
+    sizes = np.diff(np.r_[starts, len(nodes)])
+    edges = [np.empty((0, 2), dtype=np.int64)]
+    # Generate the cliques of all classes of the same size at once
+    for size in np.unique(sizes[sizes >= 2]):
+        members = nodes[starts[sizes == size][:, np.newaxis] + np.arange(size)]
+        firsts, seconds = np.triu_indices(size, 1)
+        srcs, dsts = members[:, firsts].ravel(), members[:, seconds].ravel()
+        edges.append(
+            np.stack(
+                [np.concatenate([srcs, dsts]), np.concatenate([dsts, srcs])], axis=1
+            )
+        )
+    edges = np.concatenate(edges).astype(np.int32)
+    return edges[np.lexsort((edges[:, 1], edges[:, 0]))]
+
+
+def _graph_data(entry: "_CacheEntry", use_subtree_match_edges: bool) -> GraphData:
+    edge_lists = _child_edge_lists(entry.graph)
+    if use_subtree_match_edges:
+        edge_lists.append(_subtree_match_edges(entry.classes.class_ids))
+    for arr in [entry.graph.node_reps, *edge_lists]:
+        # Shared by all users of the cache
+        arr.flags.writeable = False
+    return GraphData(entry.graph.node_reps, tuple(edge_lists))
+
+
+class _CacheEntry:
+    def __init__(self, graph: _PreorderGraph):
+        self.graph = graph
+        # Computed only if subtree match edges are required
+        self.classes: Optional[_SubtreeClasses] = None
+        # GraphData, indexed by use_subtree_match_edges
+        self.graph_data: Dict[bool, GraphData] = {}
+
+
+class _GraphCache:
+    """ A least-recently-used map from Expression to _CacheEntry, holding entries for
+        at most max_nodes nodes (in total). Thread-safe. """
+
+    def __init__(self, max_nodes: int):
+        self._max_nodes = max_nodes
+        self._entries: "OrderedDict[Expression, _CacheEntry]" = OrderedDict()
+        self._num_nodes = 0
+        self._lock = threading.Lock()
+
+    def get(self, expression: Expression) -> Optional[_CacheEntry]:
+        with self._lock:
+            entry = self._entries.get(expression)
+            if entry is not None:
+                self._entries.move_to_end(expression)
+            return entry
+
+    def put(self, expression: Expression, entry: _CacheEntry) -> None:
+        with self._lock:
+            if expression in self._entries:
+                return
+            self._entries[expression] = entry
+            self._num_nodes += expression.num_nodes
+            self._evict()
+
+    def set_max_nodes(self, max_nodes: int) -> None:
+        with self._lock:
+            self._max_nodes = max_nodes
+            self._evict()
+
+    def _evict(self) -> None:
+        while self._num_nodes > self._max_nodes:
+            evicted, _ = self._entries.popitem(last=False)
+            self._num_nodes -= evicted.num_nodes
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._num_nodes = 0
+
+
+# Approximate bytes retained by the cache for each node: about 130 for the arrays of its
+# _CacheEntry, the rest for the Expressions (and representative subtrees) it keeps alive.
+_BYTES_PER_CACHED_NODE = 300
+
+_graph_cache = _GraphCache(max_nodes=(256 * 2 ** 20) // _BYTES_PER_CACHED_NODE)
+
+
+def set_graph_cache_mb(graph_cache_mb: float) -> None:
+    """ Bounds the approximate memory, in megabytes, used by the cache of graphs behind
+        expr_to_graph_data (by default 256), evicting graphs as necessary. The cache is shared
+        by all threads of the process; 0 disables it. """
+    _graph_cache.set_max_nodes(int(graph_cache_mb * 2 ** 20) // _BYTES_PER_CACHED_NODE)
+
+
+def _cache_entry(expression: Expression, use_subtree_match_edges: bool) -> _CacheEntry:
+    entry = _graph_cache.get(expression)
+    if entry is not None and (entry.classes is not None or not use_subtree_match_edges):
+        return entry
+    parent_ref = expression._rewritten_from
+    parent = parent_ref() if parent_ref is not None else None
+    parent_entry = _graph_cache.get(parent) if parent is not None else None
+    change = _changed_subtree(parent, expression) if parent_entry is not None else None
+    if entry is None:
+        # Splice the encoding of the rewritten subtree into that of the parent
+        graph = (
+            _encode(expression)
+            if change is None
+            else _splice(
+                parent_entry.graph,
+                change.idx,
+                change.old_subtree.num_nodes,
+                _encode(change.new_subtree),
+            )
+        )
+        entry = _CacheEntry(graph)
+        _graph_cache.put(expression, entry)
+    if use_subtree_match_edges:
+        entry.classes = (
+            _subtree_classes(expression)
+            if change is None or parent_entry.classes is None
+            else _update_subtree_classes(parent_entry.classes, change)
+        )
+    return entry
+
+
 def expr_to_graph_data(
     expression: Expression, use_subtree_match_edges: bool
 ) -> GraphData:
+    """ Returns the graph of <expression>, which must not be modified.
+
+    Graphs are cached (for a bounded number of recently-used Expressions, see set_graph_cache_mb);
+    if <expression> was produced by a Rewrite from a cached Expression, its graph is derived from
+    that one's. """
+    entry = _cache_entry(expression, use_subtree_match_edges)
+    graph_data = entry.graph_data.get(use_subtree_match_edges)
+    if graph_data is None:
+        graph_data = _graph_data(entry, use_subtree_match_edges)
+        entry.graph_data[use_subtree_match_edges] = graph_data
+    return graph_data
+
+
+def _expr_to_graph_data_uncached(
+    expression: Expression, use_subtree_match_edges: bool
+) -> GraphData:
+    """ The reference implementation of expr_to_graph_data, without caching or NumPy. """
     adj_lists = [[] for _ in range(EdgeType.num_edge_types(use_subtree_match_edges))]
 
     if use_subtree_match_edges:
@@ -120,3 +542,40 @@ def expr_to_graph_data(
         [Expression.node_type_lookup[n.op] for n in nodes], dtype=np.int32
     )
     return GraphData(node_types, adj_lists)
+
+
+def _timeit(n=3, rules_name="binding_simplify_rules", use_subtree_match_edges=True):
+    """ Compares computing the graph of the result of every rewrite of each expression (as search
+        does, having already computed the graph of the expression itself) using expr_to_graph_data
+        against the uncached reference implementation. """
+    from time import perf_counter
+    from rlo.costs import _get_benchmarks
+    from rlo.rewrites import get_rules
+
+    benchmarks = _get_benchmarks()
+    rewrites = get_rules(rules_name)
+    times = {"_expr_to_graph_data_uncached": 0.0, "expr_to_graph_data": 0.0}
+    num_children = 0
+    for _ in range(n):
+        _graph_cache.clear()
+        for e in benchmarks:
+            _ = expr_to_graph_data(e.expr, use_subtree_match_edges)
+            children = [rw.apply(e) for rw in rewrites.get_all_rewrites(e)]
+            for c in children:
+                # As search does, to look up the expression in its caches
+                hash(c.expr)
+            num_children += len(children)
+            start = perf_counter()
+            for c in children:
+                _ = _expr_to_graph_data_uncached(c.expr, use_subtree_match_edges)
+            times["_expr_to_graph_data_uncached"] += perf_counter() - start
+            start = perf_counter()
+            for c in children:
+                _ = expr_to_graph_data(c.expr, use_subtree_match_edges)
+            times["expr_to_graph_data"] += perf_counter() - start
+    for name, t in times.items():
+        print(f"{name}: {t:.3f}s for {num_children} rewritten expressions")
+
+
+if __name__ == "__main__":
+    _timeit()
@@ -1,4 +1,4 @@
-from typing import Iterable, List, Tuple
+from typing import Iterable, List, Sequence, Tuple
 
 from rlo import utils
 from rlo.expression import Expression
@@ -50,15 +50,42 @@ def nodes_and_groups(expr: Expression) -> Tuple[List[Expression], Iterable[List[
         * an iterable of lists of indices, where each list contains indices of nodes which are equivalent
              (compute the same value). Note that nodes that are not in 
     """
+    nodes, closest_binders = nodes_and_closest_binders(expr)
+
+    def equiv_groups() -> Iterable[List[int]]:
+        # Group node indices by whether they have the same closest binder, same number of nodes, and are the same op.
+        for g in utils.group_by(
+            range(len(nodes)),
+            lambda idx: (closest_binders[idx], nodes[idx].num_nodes, nodes[idx].op),
+        ).values():
+            # Skip obviously-singleton groups
+            if len(g) >= 2:
+                yield from utils.group_by(g, lambda idx: nodes[idx]).values()
+
+    return nodes, equiv_groups()
+
+
+def nodes_and_closest_binders(
+    expr: Expression, binder_stack: Sequence[Tuple[str, int]] = (), idx_offset: int = 0
+) -> Tuple[List[Expression], List[int]]:
+    """
+    Returns a list of all sub-expressions, and a list of the index of the closest binder of each (-1 if none).
+    This is the binder of the innermost-bound free variable of the sub-expression - intuitively, the scope of the
+    sub-expression, the highest point to which a let containing its value could be lifted. (That is - a sub-expression
+    cannot be the same as any other unless their closest binders are the same.)
+
+    Args:
+        expr: An expression
+        binder_stack: (bound variable name, index) of each binder within whose scope expr lies, outermost first,
+            if expr is a subtree of a larger expression
+        idx_offset: the index of expr itself, from which those of its sub-expressions (and so binders) follow
+    """
     nodes: List[Expression] = []
     closest_binders: List[int] = []
 
     def traverse(subexp: Expression, binder_stack: List[Tuple[str, int]]) -> None:
-        idx = len(nodes)
+        idx = len(nodes) + idx_offset
         nodes.append(subexp)
-        # Calculate the closest binder of a free-variable - intuitively, the scope of the subexp,
-        # the highest point to which a let containing this subexp's value could be lifted.
-        # (That is - this subexp cannot be the same as any other subexp unless their closest binder's are the same)
         closest_binder = -1  # Global
         for skip, (bv_name, binder_idx) in enumerate(reversed(binder_stack)):
             if bv_name in subexp.free_var_names:
@@ -78,18 +105,7 @@ def nodes_and_groups(expr: Expression) -> Tuple[List[Expression], Iterable[List[
                 else binder_stack,
             )
 
-    traverse(expr, [])
+    traverse(expr, list(binder_stack))
     assert len(nodes) == expr.num_nodes
     assert len(closest_binders) == expr.num_nodes
-
-    def equiv_groups() -> Iterable[List[int]]:
-        # Group node indices by whether they have the same closest binder, same number of nodes, and are the same op.
-        for g in utils.group_by(
-            range(len(nodes)),
-            lambda idx: (closest_binders[idx], nodes[idx].num_nodes, nodes[idx].op),
-        ).values():
-            # Skip obviously-singleton groups
-            if len(g) >= 2:
-                yield from utils.group_by(g, lambda idx: nodes[idx]).values()
-
-    return nodes, equiv_groups()
+    return nodes, closest_binders
@@ -79,6 +79,7 @@ class HybridSearcher(AStarSearcher):
             model_wrapper,
             self._batch_size,
             lambda node: open_list.put(self.urgency(node), node),
+            max_nodes_per_batch=self._max_nodes_per_batch,
         )
 
         rng = utils.rng(random_source)
@@ -1,9 +1,11 @@
 import time
 from typing import Callable, Optional, Union
 
-from rlo import factory
+from rlo import analytics, factory, graph_data, utils
+from rlo.expression import interning
 from rlo.tf_model import Weights
 from rlo.model.model import ModelState as TorchModelState
+from rlo.value_cache import ValueCache, caching_values
 from rlo.worker import Accumulator, WorkerPool
 
 ModelState = Union[TorchModelState, Weights]
@@ -20,11 +22,25 @@ def measure_time(func: Callable, time_acc: Optional[Accumulator], *args, **kwarg
 
 
 class WorkerWithModel:
-    """ An object that contains a ModelWrapper, and manages loading a new set of weights. """
+    """ An object that contains a ModelWrapper, and manages loading a new set of weights.
+        If config["value_cache_mb"] is set, model evaluations in searches are kept in a ValueCache
+        of that size, shared by all tasks executed with the same weights.
+        If config["graph_cache_mb"] is set, it bounds the process's cache of expression graphs
+        (see graph_data.set_graph_cache_mb).
+        If config["intern_expressions"] is set, tasks are executed within expression.interning(). """
 
     def __init__(self, config):
         self._config = config
         self._model_wrapper = None
+        value_cache_mb = config.get("value_cache_mb")
+        self._value_cache = (
+            None
+            if value_cache_mb is None
+            else ValueCache(int(value_cache_mb * 2 ** 20))
+        )
+        graph_cache_mb = config.get("graph_cache_mb")
+        if graph_cache_mb is not None:
+            graph_data.set_graph_cache_mb(graph_cache_mb)
 
     def _set_weights_or_seed(self, weights_or_seed: Union[ModelState, int, None]):
         def create_model(seed: int = 0xFFFF):
@@ -57,8 +73,24 @@ class WorkerWithModel:
         start_time = time.time()
         self._set_weights_or_seed(weights_or_seed)
         weights_loaded_time = time.time()
-        res = func(self._model_wrapper)
+        # Only weights (not seeds) identify the model across tasks
+        weights_key = (
+            weights_or_seed.content_hash()
+            if self._value_cache is not None
+            and isinstance(weights_or_seed, (TorchModelState, Weights))
+            else None
+        )
+        with caching_values(self._value_cache, weights_key), (
+            interning()
+            if self._config.get("intern_expressions")
+            else utils.nullcontext()
+        ):
+            res = func(self._model_wrapper)
         finish_time = time.time()
+        if weights_key is not None:
+            analytics.event(
+                "value_cache", verbosity=1, **self._value_cache.log_entries()
+            )
         return res, weights_loaded_time - start_time, finish_time - weights_loaded_time
 
 
@@ -0,0 +1,152 @@
+"""
+Evaluation of a model during search, without the machinery needed to train it.
+
+The inference copy of a model is in eval mode, has its dropout layers removed, and has
+parameters that do not require gradients; TorchModelWrapper evaluates it under
+torch.inference_mode. Optionally, its linear and GRU layers are dynamically quantized to int8,
+which changes its outputs slightly (see TorchModelWrapper.inference_agreement).
+"""
+from contextlib import contextmanager
+import copy
+from typing import Hashable, Iterator, Optional, Tuple
+
+import torch
+from torch import nn
+
+from .layers import DropoutGRUCell
+
+
+def _without_dropout(module: nn.Module) -> nn.Module:
+    """ Returns <module>, or a replacement for it, with dropout layers (recursively) removed. """
+    if isinstance(module, nn.Dropout):
+        return nn.Identity()
+    if isinstance(module, DropoutGRUCell):
+        gru_cell = nn.GRUCell(module.input_size, module.hidden_size, bias=module.bias)
+        gru_cell.load_state_dict(module.state_dict())
+        return gru_cell.to(module.weight_ih.device)
+    for name, child in module.named_children():
+        setattr(module, name, _without_dropout(child))
+    return module
+
+
+def inference_model(model: nn.Module, quantize: bool = False) -> nn.Module:
+    """
+    Returns a copy of <model> for inference only.
+
+    Args:
+        model: the model, which is not modified
+        quantize: whether to quantize the weights of linear and GRU layers to int8 (dynamically,
+            i.e. activations are quantized as the model is evaluated). Only supported on CPU.
+    """
+    if quantize and any(p.device.type != "cpu" for p in model.parameters()):
+        raise ValueError("Quantized inference is only supported on CPU")
+    # Do not copy the optimizer, which refers to the parameters of <model>.
+    optimizer = getattr(model, "optimizer", None)
+    memo = {} if optimizer is None else {id(optimizer): None}
+    model = _without_dropout(copy.deepcopy(model, memo))
+    model.eval().requires_grad_(False)
+    if quantize:
+        model = torch.quantization.quantize_dynamic(
+            model, {nn.Linear, nn.GRUCell}, dtype=torch.qint8
+        )
+    return model
+
+
+def parameters_version(model: nn.Module) -> Tuple[Hashable, ...]:
+    """ Changes whenever the parameters of <model> are modified (e.g. by an optimizer step or
+    load_state_dict, which update them in place) or moved to another device. """
+    # pylint: disable=protected-access
+    return tuple((p.data_ptr(), p._version) for p in model.parameters())
+
+
+@contextmanager
+def num_threads(n: Optional[int]) -> Iterator[None]:
+    """ Within this context, PyTorch uses <n> threads for intra-op parallelism on CPU
+    (throughout the process), if <n> is not None. """
+    if n is None:
+        yield
+        return
+    prev = torch.get_num_threads()
+    torch.set_num_threads(n)
+    try:
+        yield
+    finally:
+        torch.set_num_threads(prev)
+
+
+def _timeit(n=3, batch_size=16, num_threads=None):
+    """ Compares evaluations per second of the benchmark expressions of rlo.costs, in batches
+    as in search, by a model with default flags (hidden_dim 200, 10 propagations) evaluated as
+    a training model (in eval mode), and by its inference copy with and without quantization. """
+    from time import perf_counter
+    from rlo import graph_data, utils
+    from rlo.costs import _get_benchmarks
+    from rlo.expression import Expression
+    from rlo.model.model import TorchModelWrapper
+    from rlo.model.state_value_estimator import StateValueModel
+    from rlo.torch_graph_data import DataConverter
+
+    exprenvs = _get_benchmarks()
+    batches = [
+        exprenvs[i : i + batch_size] for i in range(0, len(exprenvs), batch_size)
+    ]
+    with utils.random_state_context(0):
+        model = StateValueModel(
+            num_node_types=Expression.num_node_types,
+            gnn_hidden_dim=200,
+            num_edge_types=graph_data.EdgeType.num_edge_types(),
+            num_gnn_blocks=1,
+            regressor_hidden_dim=200,
+            num_time_heads=11,
+            loss="huber",
+            lr=0.0001,
+            gnn_dropout=0.5,
+            regressor_dropout=0.2,
+            num_propagations=10,
+        )
+    data_converter = DataConverter(
+        num_time_heads=11,
+        cost_norm="none",
+        use_subtree_match_edges=True,
+        device=torch.device("cpu"),
+    )
+
+    def evaluate_training_model(expr_batch):
+        model.eval()
+        output = model(data_converter.exprs_to_graph(expr_batch))
+        return data_converter.denormalize_and_numpify(output, expr_batch)
+
+    wrappers = {
+        quantize: TorchModelWrapper(
+            model,
+            data_converter,
+            torch.device("cpu"),
+            quantize_inference=quantize,
+            inference_threads=num_threads,
+        )
+        for quantize in [False, True]
+    }
+    evaluators = {
+        "training model": evaluate_training_model,
+        "inference model": wrappers[False].evaluate_all_time_left,
+        "quantized inference model": wrappers[True].evaluate_all_time_left,
+    }
+    times = {name: 0.0 for name in evaluators}
+    for _ in range(n):
+        for name, evaluate in evaluators.items():
+            start = perf_counter()
+            for expr_batch in batches:
+                evaluate(expr_batch)
+            times[name] += perf_counter() - start
+    for name, t in times.items():
+        print(f"{name}: {n * len(exprenvs) / t:.1f} evaluations/s")
+    for name, wrapper in [
+        ("inference model", wrappers[False]),
+        ("quantized inference model", wrappers[True]),
+    ]:
+        agreement = wrapper.inference_agreement(exprenvs, batch_size)
+        print(f"{name}: {agreement}")
+
+
+if __name__ == "__main__":
+    _timeit()
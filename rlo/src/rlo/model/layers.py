@@ -209,8 +209,11 @@ class RelationalGatedGraphConv(nn.Module):
     to allow to pass different messages along each edge. That implementation indexes 
     into the weights vector with the edge-type, which can be computationally expensive.
 
-    This implementation instead does a separate round of message propagation for each
-    edge type, and then aggregates the results.
+    This implementation instead gathers the source node states for the edges of all
+    types at once, applies the message function of each edge type to the (contiguous)
+    edges of that type, and then aggregates the results. (The original implementation,
+    which does a separate round of message propagation for each edge type, is kept for
+    comparison; see fuse_edge_types.)
     """
 
     def __init__(
@@ -221,6 +224,7 @@ class RelationalGatedGraphConv(nn.Module):
         aggr: ScatterAggregation = "sum",
         bias: bool = True,
         recurrent_dropout: float = 0.0,
+        fuse_edge_types: bool = True,
     ):
         super().__init__()
         self._num_edge_types = num_edge_types
@@ -228,6 +232,8 @@ class RelationalGatedGraphConv(nn.Module):
         self._hidden_dim = hidden_dim
         self._recurrent_dropout = recurrent_dropout
         self._aggr = aggr
+        # Whether to process all edge types together; False for the original implementation
+        self.fuse_edge_types = fuse_edge_types
         # Aggregation method
 
         self.aggregate_messages = functools.partial(aggregate_messages, aggr=aggr)
@@ -290,34 +296,25 @@ class RelationalGatedGraphConv(nn.Module):
 
         # Get the message targets for all messages (along edges of all edge types)
         message_target_idxs = torch.cat([edge_index[1] for edge_index in edge_lists])
+        if self.fuse_edge_types:
+            message_source_idxs = torch.cat(
+                [edge_index[0] for edge_index in edge_lists]
+            )
+            num_edges_by_type = [edge_index.shape[1] for edge_index in edge_lists]
 
         # Perform message passing num_propagations times (with same weights each time)
         for _ in range(self._num_propagations):
-            # 1. Gather messages for each edge type
-            all_messages: List[
-                Tensor  # shape [num_messages_of_this_type, hidden_dim]
-            ] = []
-
-            # TODO: consider asynchronous computation below: https://pytorch.org/tutorials/advanced/torch-script-parallelism.html
-            for (edge_type_idx, edge_list) in enumerate(edge_lists):
-                # edge_list shape: [2, "num_edges_of_this_type"]
-                message_source_idxs = edge_list[0, :]
-
-                # 1.0 Look up node_states for message sources
-                source_node_states = nn.functional.embedding(
-                    message_source_idxs, node_states
+            # 1. Compute messages along edges of all edge types
+            if self.fuse_edge_types:
+                messages = self._compute_messages(
+                    node_states.index_select(0, message_source_idxs), num_edges_by_type
                 )
-
-                # 1.1 Apply edge-type-specific message function
-                edge_message_function = self.edge_message_functions[edge_type_idx]
-                message = edge_message_function(source_node_states)
-
-                # 1.2 Store to all_messages
-                all_messages.append(message)
+            else:
+                messages = self._compute_messages_per_edge_type(node_states, edge_lists)
 
             # 2. Aggregate the messages from each edge for all edge types
             aggregated_messages = self.aggregate_messages(
-                messages=torch.cat(all_messages, dim=0),
+                messages=messages,
                 message_targets=message_target_idxs,
                 num_nodes=num_nodes,
             )  # [num_nodes, node_state_dim]
@@ -327,6 +324,66 @@ class RelationalGatedGraphConv(nn.Module):
 
         return node_states
 
+    def _compute_messages(
+        self,
+        source_node_states: Tensor,  # [num_messages, hidden_dim]
+        num_edges_by_type: List[int],
+    ) -> Tensor:  # [num_messages, hidden_dim]
+        """
+        Applies the message function of each edge type to the states of the sources of
+        the edges of that type, which are consecutive in source_node_states.
+        """
+        segments = torch.split(source_node_states, num_edges_by_type)
+        if torch.is_grad_enabled() or not all(
+            isinstance(f, nn.Linear) for f in self.edge_message_functions
+        ):
+            # Writing into a preallocated tensor (below) does not support autograd,
+            # nor message functions other than nn.Linear (e.g. once quantized)
+            return torch.cat(
+                [
+                    message_function(segment)
+                    for message_function, segment in zip(
+                        self.edge_message_functions, segments
+                    )
+                ]
+            )
+        messages = torch.empty_like(source_node_states)
+        for message_function, segment, out in zip(
+            self.edge_message_functions,
+            segments,
+            torch.split(messages, num_edges_by_type),
+        ):
+            torch.addmm(
+                message_function.bias, segment, message_function.weight.t(), out=out
+            )
+        return messages
+
+    def _compute_messages_per_edge_type(
+        self,
+        node_states: Tensor,  # [num_nodes, hidden_dim]
+        edge_lists: List[EdgeList],
+    ) -> Tensor:  # [num_messages, hidden_dim]
+        """ The original implementation of _compute_messages, which handles each edge type separately. """
+        all_messages: List[Tensor] = []  # shape [num_messages_of_this_type, hidden_dim]
+
+        # TODO: consider asynchronous computation below: https://pytorch.org/tutorials/advanced/torch-script-parallelism.html
+        for (edge_type_idx, edge_list) in enumerate(edge_lists):
+            # edge_list shape: [2, "num_edges_of_this_type"]
+            message_source_idxs = edge_list[0, :]
+
+            # 1.0 Look up node_states for message sources
+            source_node_states = nn.functional.embedding(
+                message_source_idxs, node_states
+            )
+
+            # 1.1 Apply edge-type-specific message function
+            edge_message_function = self.edge_message_functions[edge_type_idx]
+            message = edge_message_function(source_node_states)
+
+            # 1.2 Store to all_messages
+            all_messages.append(message)
+        return torch.cat(all_messages, dim=0)
+
 
 class StackedRelationalGNN(nn.Module):
     """
@@ -341,6 +398,7 @@ class StackedRelationalGNN(nn.Module):
         num_propagations: int = 1,
         num_gnn_blocks: int = 1,
         aggr: ScatterAggregation = "sum",
+        fuse_edge_types: bool = True,
     ):
         super().__init__()
         self._num_edge_types = num_edge_types
@@ -352,6 +410,7 @@ class StackedRelationalGNN(nn.Module):
                     num_propagations=num_propagations,
                     aggr=aggr,
                     recurrent_dropout=recurrent_dropout,
+                    fuse_edge_types=fuse_edge_types,
                 )
                 for _ in range(num_gnn_blocks)
             ]
@@ -382,6 +441,7 @@ class GNNEncoder(nn.Module):
         num_propagations: int = 1,
         num_gnn_blocks: int = 1,
         aggr: ScatterAggregation = "sum",
+        fuse_edge_types: bool = True,
     ):
         super().__init__()
         self._hidden_dim = hidden_dim
@@ -396,6 +456,7 @@ class GNNEncoder(nn.Module):
             num_propagations=num_propagations,
             num_gnn_blocks=num_gnn_blocks,
             aggr=aggr,
+            fuse_edge_types=fuse_edge_types,
         )
         self.reset_parameters()
 
@@ -515,3 +576,47 @@ def global_pooling_from_str(pooling: Literal["mean", "sum", "max"]) -> GlobalGra
         return global_max_pool
     else:
         raise ValueError(f"No such global pooling strategy implemented: {pooling}.")
+
+
+def _timeit(n=5, batch_sizes=(1, 8, 64), hidden_dim=200, num_propagations=10):
+    """ Compares the CPU inference latency of RelationalGatedGraphConv with and without
+    fuse_edge_types, for batches of the benchmark expressions of rlo.costs of increasing size. """
+    from time import perf_counter
+    from rlo import graph_data
+    from rlo.costs import _get_benchmarks
+    from rlo.torch_graph_data import DataConverter
+
+    exprenvs = _get_benchmarks()
+    data_converter = DataConverter(
+        num_time_heads=11,
+        cost_norm="none",
+        use_subtree_match_edges=True,
+        device=torch.device("cpu"),
+    )
+    gcns = {
+        fuse_edge_types: RelationalGatedGraphConv(
+            hidden_dim=hidden_dim,
+            num_edge_types=graph_data.EdgeType.num_edge_types(),
+            num_propagations=num_propagations,
+            fuse_edge_types=fuse_edge_types,
+        ).eval()
+        for fuse_edge_types in [False, True]
+    }
+    gcns[True].load_state_dict(gcns[False].state_dict())
+    print("num_nodes  per_edge_type_ms  fused_ms")
+    for batch_size in batch_sizes:
+        batch = data_converter.exprs_to_graph(exprenvs[:batch_size])
+        node_states = torch.randn(batch.num_nodes, hidden_dim)
+        latencies = {}
+        for fuse_edge_types, gcn in gcns.items():
+            with torch.no_grad():
+                gcn(node_states, batch.edge_lists)
+                start = perf_counter()
+                for _ in range(n):
+                    gcn(node_states, batch.edge_lists)
+            latencies[fuse_edge_types] = (perf_counter() - start) / n * 1000
+        print(f"{batch.num_nodes:9}  {latencies[False]:16.2f}  {latencies[True]:8.2f}")
+
+
+if __name__ == "__main__":
+    _timeit()
@@ -1,7 +1,7 @@
 from __future__ import annotations
 
 import os
-from typing import Dict, Iterable, Optional
+from typing import Dict, Hashable, Iterable, Optional, Sequence, Tuple
 import abc
 from dataclasses import dataclass
 import copy
@@ -10,12 +10,14 @@ import torch
 import numpy as np
 
 from rlo.expression_util import ExprWithEnv
+from rlo import utils
 from rlo import worker
 from rlo.torch_graph_data import (
     DataConverter,
     BatchedGraphDataWithTarget,
     BatchedGraphData,
 )
+from . import inference
 from .losses import LossFunc
 
 
@@ -27,10 +29,25 @@ class TorchModelWrapper:
     """Wrap a torch model for use in search."""
 
     def __init__(
-        self, model: Model, data_converter: DataConverter, device: torch.device,
+        self,
+        model: Model,
+        data_converter: DataConverter,
+        device: torch.device,
+        quantize_inference: bool = False,
+        inference_threads: Optional[int] = None,
     ):
+        """
+        Args:
+            quantize_inference: whether to evaluate expressions with a copy of the model whose
+                linear and GRU layers are dynamically quantized to int8 (see rlo.model.inference)
+            inference_threads: if given, the number of CPU threads PyTorch uses to evaluate expressions
+        """
         self._data_converter = data_converter
         self._model = model
+        self._quantize_inference = quantize_inference
+        self._inference_threads = inference_threads
+        self._inference_model: Optional[torch.nn.Module] = None
+        self._inference_model_version: Optional[Tuple[Hashable, ...]] = None
         self.to(device)
 
     def to(self, device: torch.device):
@@ -60,12 +77,62 @@ class TorchModelWrapper:
     def __exit__(self, ex_type, exc, ex_trace):
         return False  # Do not suppress any exception
 
+    @property
+    def inference_model(self) -> torch.nn.Module:
+        """ A copy of the model for evaluating expressions (see rlo.model.inference),
+        made again whenever the weights of the model have changed. """
+        version = inference.parameters_version(self._model)
+        if self._inference_model is None or version != self._inference_model_version:
+            self._inference_model = inference.inference_model(
+                self._model, quantize=self._quantize_inference
+            )
+            self._inference_model_version = version
+        return self._inference_model
+
     def evaluate_all_time_left(self, expr_batch: Iterable[ExprWithEnv]) -> np.ndarray:
+        expr_batch = list(expr_batch)
+        batch = self._data_converter.exprs_to_graph(expr_batch)
+        with torch.inference_mode(), inference.num_threads(self._inference_threads):
+            model_output = self.inference_model(batch)
+            return self._data_converter.denormalize_and_numpify(
+                model_output, expr_batch
+            )
+
+    def inference_agreement(
+        self, exprenvs: Sequence[ExprWithEnv], batch_size: int = 64
+    ) -> Dict[str, float]:
+        """ Compares the values of <exprenvs> from evaluate_all_time_left with those of the model
+        itself (in eval mode), returning entries to log. The model is then returned to the mode
+        (training or eval) it was in. """
+        was_training = self._model.training
         self._model.eval()
-        graphs = [self._data_converter.expr_to_graph(e) for e in expr_batch]
-        batch = BatchedGraphData.collate(graphs)
-        model_output = self._model(batch)
-        return self._data_converter.denormalize_and_numpify(model_output, expr_batch)
+        diffs, values = [], []
+        try:
+            for i in range(0, len(exprenvs), batch_size):
+                expr_batch = exprenvs[i : i + batch_size]
+                with torch.no_grad():
+                    model_output = self._model(
+                        self._data_converter.exprs_to_graph(expr_batch)
+                    )
+                expected = self._data_converter.denormalize_and_numpify(
+                    model_output, expr_batch
+                )
+                diffs.append(np.abs(self.evaluate_all_time_left(expr_batch) - expected))
+                values.append(np.abs(expected))
+        finally:
+            self._model.train(was_training)
+        if len(diffs) == 0:
+            return {}
+        return {
+            "inference_max_abs_diff": float(max(np.max(d) for d in diffs)),
+            "inference_mean_abs_diff": float(np.mean(np.concatenate(diffs))),
+            "inference_mean_abs_value": float(np.mean(np.concatenate(values))),
+        }
+
+    @property
+    def interpretation(self) -> Hashable:
+        """ Distinguishes search models which evaluate differently with the same weights. """
+        return "quantized" if self._quantize_inference else None
 
     def as_train_search_model(self):
         return self
@@ -177,6 +244,12 @@ class ModelState:
             path,
         )
 
+    def content_hash(self) -> str:
+        """ A hash of the model weights (not the optimizer state). """
+        return utils.hash_arrays(
+            t.detach().cpu().numpy() for t in self.model_state_dict.values()
+        )
+
     @classmethod
     def from_path(cls, path):
         if torch.cuda.is_available():
@@ -28,6 +28,7 @@ class StateValueModel(Model):
         aggregation_over_edge_types: ScatterAggregation = "sum",
         global_pooling: GlobalGraphPool = tg.nn.global_mean_pool,
         num_propagations: int = 1,
+        fuse_edge_types: bool = True,
     ):
         super().__init__()
 
@@ -39,6 +40,7 @@ class StateValueModel(Model):
             num_propagations=num_propagations,
             num_gnn_blocks=num_gnn_blocks,
             aggr=aggregation_over_edge_types,
+            fuse_edge_types=fuse_edge_types,
         )
         self.regressor = GatedRegression(
             input_dim=self.encoder.output_dim,  # GNNEncoder returns init node embedding and GNN outputs stacked together
@@ -1,15 +1,47 @@
-from typing import Dict, Generic, Hashable, List, Tuple, Type, Any, Mapping, Sequence
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import (
+    Dict,
+    Generic,
+    Hashable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Type,
+    Any,
+    Mapping,
+    Sequence,
+)
 
 import numpy as np
 
 from rlo.expression_util import ExprWithEnv
 from rlo import utils
+from rlo.pipelines.pipeline import batch_with_max_nodes
 from rlo.search_tree import NodeType
 from rlo.tf_model import ModelWrapper
 
 
+@contextmanager
+def evaluation_executor(async_eval: bool) -> Iterator[Optional[Executor]]:
+    """ An executor on which a NodeEvaluationCache can evaluate batches in the background,
+    or None (to evaluate synchronously) if async_eval is False.
+    A single thread evaluates batches one at a time, in the order they were submitted. """
+    if not async_eval:
+        yield None
+        return
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="gnn_eval") as executor:
+        yield executor
+
+
 class NodeEvaluationCache(Generic[NodeType]):
     """ This class stores both node and model evaluation cache used in Searchers.
+
+    If an executor is given (see evaluation_executor), submit_batches evaluates batches on it,
+    while the searcher continues to expand nodes. Evaluations are set on nodes only by
+    collect_batches (or process_batches, which does both), so a search that calls these at
+    deterministic points is deterministic however long the evaluations take.
     """
 
     def __init__(
@@ -17,9 +49,20 @@ class NodeEvaluationCache(Generic[NodeType]):
         model_wrapper: ModelWrapper,
         batch_size: int,
         search_tree_node_class: Type[NodeType],
+        executor: Optional[Executor] = None,
+        max_nodes_per_batch: Optional[int] = None,
     ):
+        """
+        Args:
+            batch_size: number of expressions in each batch evaluated by the model,
+                unless max_nodes_per_batch is given
+            max_nodes_per_batch: if given, batches are instead bounded by the total number of
+                nodes in their expressions (an expression with more nodes is evaluated alone)
+        """
         self._model_wrapper = model_wrapper
         self._batch_size = batch_size
+        self._max_nodes_per_batch = max_nodes_per_batch
+        self._executor = executor
         self._search_tree_node_class = search_tree_node_class
         # The position map. Maps hashes of positions (search_tree_node) to evaluation caches
         self._posn_map: Dict[
@@ -39,6 +82,12 @@ class NodeEvaluationCache(Generic[NodeType]):
         self._tl_cache: Dict[ExprWithEnv, np.ndarray] = dict()
         self._tl_cache_hits = 0
         self._posns_waiting_for_eval: Dict[ExprWithEnv, List[NodeType]] = {}
+        self._num_nodes_waiting_for_eval = 0
+        # Submitted batches whose evaluations have not yet been collected, in submission order
+        self._posns_in_flight: Dict[ExprWithEnv, List[NodeType]] = {}
+        self._batches_in_flight: List[
+            Tuple[Sequence[ExprWithEnv], "Future[Tuple[Any, float]]"]
+        ] = []
         self._best_traj: List[Tuple[str, float, int]] = []
         self._cur_best = float("+inf")
         self._total_posns_evaluated = 0
@@ -47,6 +96,8 @@ class NodeEvaluationCache(Generic[NodeType]):
         # total seconds spent / number of expression nodes processed in model evaluation
         self._total_gnn_eval_time = 0
         self._total_gnn_eval_nodes = 0
+        # total seconds the search spent waiting for model evaluation
+        self._total_gnn_eval_wait_time = 0
 
     def _to_cache_key(self, *args, **kwargs):
         """ Return something hashable that can be used as a dict key."""
@@ -93,23 +144,38 @@ class NodeEvaluationCache(Generic[NodeType]):
     def enqueue(self, node: NodeType) -> None:
         """ Add an expression to the queue for evaluation.
         """
+        if node.exprenv in self._posns_in_flight:
+            # Already being evaluated; the node will get the evaluation when it is collected.
+            self._posns_in_flight[node.exprenv].append(node)
+            return
         # Using dict here makes sure that we don't queue the same expression again.
-        self._posns_waiting_for_eval.setdefault(node.exprenv, []).append(node)
+        if node.exprenv not in self._posns_waiting_for_eval:
+            self._posns_waiting_for_eval[node.exprenv] = []
+            self._num_nodes_waiting_for_eval += node.exprenv.expr.num_nodes
+        self._posns_waiting_for_eval[node.exprenv].append(node)
+
+    def _evaluate_batch(self, expr_batch: Sequence[ExprWithEnv]) -> Tuple[Any, float]:
+        """ Evaluate a batch of expressions (on the executor, if any).
+
+        Returns:
+            the evaluations, and the seconds taken.
+        """
+        assert len(expr_batch) > 0
+        elapsed = []
+        with utils.elapsed_time(lambda t0, t1: elapsed.append(t1 - t0)):
+            values = self._model_wrapper.evaluate_all_time_left(expr_batch)
+        return values, elapsed[0]
 
     def _process_batch(
         self,
         expr_batch: Sequence[ExprWithEnv],
         posns_to_update_batch: Sequence[Sequence[NodeType]],
+        values,
+        eval_time: float,
     ) -> None:
-        """ Evaluate all the expressions that are queued for evaluation."""
-        assert len(expr_batch) > 0 and len(expr_batch) <= self._batch_size
-
-        def update_gnn_eval_stats(t0, t1):
-            self._total_gnn_eval_nodes += sum(et.expr.num_nodes for et in expr_batch)
-            self._total_gnn_eval_time += t1 - t0
-
-        with utils.elapsed_time(update_gnn_eval_stats):
-            values = self._model_wrapper.evaluate_all_time_left(expr_batch)
+        """ Set the evaluations of a batch of expressions on all the nodes for them."""
+        self._total_gnn_eval_nodes += sum(et.expr.num_nodes for et in expr_batch)
+        self._total_gnn_eval_time += eval_time
         self._total_posns_evaluated += len(expr_batch)
 
         for expr, val, posns in zip(expr_batch, values, posns_to_update_batch):
@@ -118,38 +184,107 @@ class NodeEvaluationCache(Generic[NodeType]):
                 node.set_evaluation(val)
         self._iter_counter += 1
 
-    def process_batches(self) -> List[ExprWithEnv]:
-        """ Evaluate all expressions in self._posns_waiting_for_eval.
+    def submit_batches(self) -> List[ExprWithEnv]:
+        """ Collect the evaluations of any batches in flight (see collect_batches), then start
+        evaluating all expressions in self._posns_waiting_for_eval. Without an executor, they are
+        evaluated now, but nodes only get their evaluations from the next collect_batches.
 
         Returns:
-            the expressions that were evaluated.
+            the expressions whose evaluations were collected.
         """
-        # TODO #19061 allow batching by number of nodes, not number of graphs (and then deduplicate this code with log_fitted_vals in training.py)
+        collected = self.collect_batches()
 
+        for expr_batch in self._batches_to_eval():
+            if self._executor is None:
+                future: "Future[Tuple[Any, float]]" = Future()
+                future.set_result(self._evaluate_batch(expr_batch))
+                self._total_gnn_eval_wait_time += future.result()[1]
+            else:
+                future = self._executor.submit(self._evaluate_batch, expr_batch)
+            self._batches_in_flight.append((expr_batch, future))
+        self._posns_in_flight.update(self._posns_waiting_for_eval)
+        self._posns_waiting_for_eval.clear()
+        self._num_nodes_waiting_for_eval = 0
+        return collected
+
+    def _batches_to_eval(self) -> Iterator[Sequence[ExprWithEnv]]:
         # Use dict insertion order (guaranteed since python3.7, accidental in CPython3.6).
         keys = list(self._posns_waiting_for_eval.keys())
+        if self._max_nodes_per_batch is not None:
+            yield from batch_with_max_nodes(
+                keys, lambda e: e.expr.num_nodes, self._max_nodes_per_batch
+            )
+            return
         for i in range(0, len(keys), self._batch_size):
-            expr_batch = keys[i : i + self._batch_size]
-            posns_to_update_batch = [
-                self._posns_waiting_for_eval[e] for e in expr_batch
-            ]
-            self._process_batch(expr_batch, posns_to_update_batch)
-        self._posns_waiting_for_eval.clear()
-        return keys
+            yield keys[i : i + self._batch_size]
+
+    def collect_batches(self) -> List[ExprWithEnv]:
+        """ Wait for all batches in flight to be evaluated, and set their evaluations on the nodes.
+
+        Returns:
+            the expressions that were evaluated.
+        """
+        exprs_evaluated: List[ExprWithEnv] = []
+        for expr_batch, future in self._batches_in_flight:
+
+            def update_wait_time(t0, t1):
+                self._total_gnn_eval_wait_time += t1 - t0
+
+            with utils.elapsed_time(update_wait_time):
+                values, eval_time = future.result()
+            self._process_batch(
+                expr_batch,
+                [self._posns_in_flight.pop(e) for e in expr_batch],
+                values,
+                eval_time,
+            )
+            exprs_evaluated.extend(expr_batch)
+        self._batches_in_flight.clear()
+        assert len(self._posns_in_flight) == 0
+        return exprs_evaluated
+
+    def process_batches(self) -> List[ExprWithEnv]:
+        """ Evaluate all expressions in flight or in self._posns_waiting_for_eval.
+
+        Returns:
+            the expressions that were evaluated.
+        """
+        collected = self.submit_batches()
+        return collected + self.collect_batches()
 
     def has_sufficient_posns_to_eval(self) -> bool:
         """ If true, RolloutSearcher will not add new rollouts
         """
+        if self._max_nodes_per_batch is not None:
+            return self._num_nodes_waiting_for_eval >= self._max_nodes_per_batch
         return len(self._posns_waiting_for_eval) >= self._batch_size
 
     @property
     def eval_queue_length(self) -> int:
         return len(self._posns_waiting_for_eval)
 
+    @property
+    def evaluates_asynchronously(self) -> bool:
+        return self._executor is not None
+
+    @property
+    def posns_in_flight(self) -> int:
+        """ Number of expressions submitted for evaluation but not yet collected."""
+        return len(self._posns_in_flight)
+
     def rollout_end_log_entries(self) -> Dict[str, Any]:
         """
         Helper method that returns entries to log in the end-of-search `rollout_end` event
         """
+        # Model throughput, per second of evaluation
+        nodes_per_sec, posns_per_sec = (
+            (
+                self._total_gnn_eval_nodes / self._total_gnn_eval_time,
+                self._total_posns_evaluated / self._total_gnn_eval_time,
+            )
+            if self._total_gnn_eval_time > 0
+            else (0.0, 0.0)
+        )
         return {
             "best_traj": self._best_traj,
             "posns_evaluated": self.total_posns_evaluated,
@@ -158,6 +293,13 @@ class NodeEvaluationCache(Generic[NodeType]):
             "generated": self._generated,
             "gnn_eval_nodes": self._total_gnn_eval_nodes,
             "gnn_eval_time": self._total_gnn_eval_time,
+            "gnn_eval_nodes_per_sec": nodes_per_sec,
+            "gnn_eval_posns_per_sec": posns_per_sec,
+            "gnn_eval_wait_time": self._total_gnn_eval_wait_time,
+            # Evaluation time hidden behind expansion (zero without an executor)
+            "gnn_eval_overlap_time": max(
+                0, self._total_gnn_eval_time - self._total_gnn_eval_wait_time
+            ),
         }
 
     @property
@@ -20,6 +20,9 @@ class PolicyNetPolicy(Agent):
                 raise NodeNotReady
         return self._rng.choice(node.actions, p=node.probs)
 
+    def can_compute_probs(self, node):
+        return node.has_evaluation()
+
     def compute_probs(self, node):
         # This will raise if any children don't yet have an evaluation (log_probs estimate).
         log_probs = [
@@ -1,9 +1,11 @@
 # fmt: off
 from abc import ABC, abstractmethod
+import copy
 from dataclasses import replace as dataclass_replace
 from itertools import chain
 import logging
 from typing import Callable, Dict, Iterable, Sequence, List, Tuple, Optional, Mapping
+import weakref
 import numpy as np # For constant-propagation rules for log/exp
 
 from rlo.native_impls import native_impls
@@ -44,7 +46,11 @@ class Rewrite(ABC):
         """ Returns the result of transforming the specified top-level Expression.
             Default implementation applies the rule at the location indicated by self.node_id
         """
-        return dataclass_replace(exprenv, expr=self.apply_expr(exprenv.expr))
+        new_expr = self.apply_expr(exprenv.expr)
+        if new_expr is not exprenv.expr:
+            # Allows the graph of new_expr to be derived from that of exprenv.expr (see rlo.graph_data)
+            new_expr._rewritten_from = weakref.ref(exprenv.expr)
+        return dataclass_replace(exprenv, expr=new_expr)
 
     def apply_expr(self, exp: Expression) -> Expression:
         # _apply_to_subtree is a function, and default is no free variables, so there will be no capture-avoidance.
@@ -64,6 +70,13 @@ class Rewrite(ABC):
     def _apply_to_subtree(self, exp):
         """ Apply the action at the top of the indicated subtree """
 
+    def _with_offset(self, delta: int) -> "Rewrite":
+        """ Returns a copy of this Rewrite acting on the same subtree when that subtree has been moved
+            <delta> nodes later in the expression (along with any binders outside it that this Rewrite refers to). """
+        res = copy.copy(self)
+        res._node_id += delta
+        return res
+
 
 class RuleMatcher(ABC):
     def get_all_rewrites(self, exprenv: ExprWithEnv) -> Iterable[Rewrite]:
@@ -256,6 +269,11 @@ class ParsedRule(NamedRule):
     def may_yield(self, op: str) -> bool:
         return self.lhs.op == "variable" or op == self.lhs.op
 
+    @property
+    def template_vars(self) -> frozenset:
+        """ The variables in the template that may be substituted (the arguments, and any bound in the template). """
+        return self._vars
+
     def get_local_rewrites(self, exp, node_id, env, **_):
         if exp.op == "stop": return
         substs = fit_template(self.lhs, exp, self._vars)
@@ -273,6 +291,10 @@ class _RewriteChild(Rewrite):
         self._which_c = which_c
     def apply_expr(self, exp: Expression):
         return exp.replace_subtree(self._parent_id, self._apply_to_subtree_typed)
+    def _with_offset(self, delta):
+        res = super()._with_offset(delta)
+        res._parent_id += delta
+        return res
     def _apply_to_subtree(self, exp):
         # exp is the parent node
         parent_copy_fn = lambda ch: exp.clone_with_new_children(
@@ -313,8 +335,63 @@ class ReplaceParentRule(NamedRule):
                 with the child e replaced by e' and the symtab removed. (Thus, parent_copy_fn(e) == parent.)
         """
 
+def _index_symbol(exp: Expression):
+    """ The part of a node that must match exactly for a template to fit (see fit_template). """
+    if exp.op == "variable":
+        return ("variable", exp.name)
+    if exp.op == "constant":
+        return ("constant", exp.value)
+    return (exp.op, len(exp.children))
+
+class _TemplateIndex:
+    """ A discrimination tree over rule templates: each template is flattened into the sequence of its
+        nodes' _index_symbol's in pre-order, with a wildcard (None) for each template variable (which matches
+        an entire subtree), and these sequences are stored in a trie. Looking up an Expression then finds,
+        in one pass over its top few nodes, every template that might fit it (fit_template must still check
+        that all occurrences of each template variable are the same). """
+    def __init__(self):
+        self._values: List[int] = []
+        self._children: Dict = {}
+
+    def add(self, templ: Expression, template_vars: Sequence[str], value: int) -> None:
+        node = self
+        for symbol in self._flatten(templ, template_vars):
+            node = node._children.setdefault(symbol, _TemplateIndex())
+        node._values.append(value)
+
+    @staticmethod
+    def _flatten(templ, template_vars):
+        if templ.op == "variable" and templ.name in template_vars:
+            yield None
+        else:
+            yield _index_symbol(templ)
+            for c in templ.children:
+                yield from _TemplateIndex._flatten(c, template_vars)
+
+    def lookup(self, exp: Expression) -> List[int]:
+        res: List[int] = []
+        self._lookup([exp], res)
+        return res
+
+    def _lookup(self, pending, res):
+        # pending is a stack of the subtrees of the Expression remaining to match, next on top.
+        if len(pending) == 0:
+            res.extend(self._values)
+            return
+        exp = pending[-1]
+        wildcard = self._children.get(None)
+        if wildcard is not None:
+            wildcard._lookup(pending[:-1], res)
+        node = self._children.get(_index_symbol(exp))
+        if node is not None:
+            node._lookup(pending[:-1] + exp.children[::-1], res)
+
 class RuleSet(Sequence[Rule], RuleMatcher):
-    """A container for an ordered set of rules with optimized `get_local_rewrites`."""
+    """A container for an ordered set of rules with optimized `get_local_rewrites`.
+
+    ParsedRules are found by looking up each node in a _TemplateIndex of their templates.
+    get_all_rewrites also caches the rewrites found at each node on that node, so that rewrites in subtrees
+    that a Rewrite left unchanged (and thus shared between the original and rewritten Expression) are reused."""
     def __init__(self, rules: Iterable[Rule], name=None):
         self.rules_name = name
         self.rules = tuple(rules)
@@ -323,6 +400,14 @@ class RuleSet(Sequence[Rule], RuleMatcher):
             op: tuple(rule for i, rule in enumerate(self.rules) if rule.may_yield(op))
             for op in Expression.node_types
         }
+        self._template_index = _TemplateIndex()
+        for i, r in enumerate(self.rules):
+            if isinstance(r, ParsedRule):
+                self._template_index.add(r.lhs, r.template_vars, i)
+        self._unindexed_may_yields = {
+            op: [i for i, r in enumerate(self.rules) if r.may_yield(op) and not isinstance(r, ParsedRule)]
+            for op in Expression.node_types
+        }
         if name is not None:
             assert name not in _rule_sets
             _rule_sets[name] = self
@@ -337,9 +422,37 @@ class RuleSet(Sequence[Rule], RuleMatcher):
         assert isinstance(other, RuleSet)
         return RuleSet(self.rules + other.rules)
 
+    def get_all_rewrites_expr(self, expr: Expression) -> Iterable[Rewrite]:
+        for node_id, node, env in expr.node_ids_with_environment():
+            yield from self._cached_local_rewrites(node, node_id, env)
+
+    def _cached_local_rewrites(self, node: Expression, node_id: int, env) -> Sequence[Rewrite]:
+        # The rewrites at a node depend upon the node and its environment. We assume rules look in the
+        # environment only for variables free in the node, and then (as per inline_let/inline_call) only at
+        # the binder's position and whether the bound value is a function. We record the binder's position
+        # relative to the node so that we can reuse the rewrites wherever the node (with those binders) has moved.
+        env_key = tuple(
+            (name, binder_id - node_id, bound_val.op, bound_val.without_stop().op)
+            for name in sorted(node.free_var_names) if name in env
+            for binder_id, bound_val in [env[name]])
+        if node._rewrites_cache is None:
+            node._rewrites_cache = {}
+        key = (self, env_key)
+        cached = node._rewrites_cache.get(key)
+        if cached is None:
+            rewrites = tuple(self.get_local_rewrites(node, node_id, env=env))
+            node._rewrites_cache[key] = (node_id, rewrites)
+            return rewrites
+        cached_id, rewrites = cached
+        if cached_id == node_id:
+            return rewrites
+        return [rw._with_offset(node_id - cached_id) for rw in rewrites]
+
     def get_local_rewrites(self, node: Expression, node_id: int, env=None):
-        for r in self._may_yields[node.op]:
-            yield from r.get_local_rewrites(node, node_id, env=env)
+        indexed = self._template_index.lookup(node)
+        unindexed = self._unindexed_may_yields[node.op]
+        for i in (sorted(indexed + unindexed) if len(indexed) > 0 else unindexed):
+            yield from self.rules[i].get_local_rewrites(node, node_id, env=env)
 
     def id_for_rule(self, rule_obj: Rule) -> int:
         return self._rule_ids[rule_obj]
@@ -453,6 +566,11 @@ class _InlineLetRewrite(Rewrite):
         # Override to replace the *binding* subtree...
         return exp.replace_subtree(self._binder_id, self._apply_to_subtree_typed)
 
+    def _with_offset(self, delta):
+        res = super()._with_offset(delta)
+        res._binder_id += delta
+        return res
+
     def _apply_to_subtree(self, exp):
         # The bound value is computed in the context here, at the root of the binder - there is no recursion yet -
         # so we must make sure that nothing between the binder and the usage site redefines (rebinds) any variables
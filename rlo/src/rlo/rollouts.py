@@ -18,7 +18,7 @@ from rlo.search_tree import (
     ActionSearchTreeNode,
     Episode,
 )
-from rlo.node_evaluation_cache import NodeEvaluationCache
+from rlo.node_evaluation_cache import NodeEvaluationCache, evaluation_executor
 from rlo.state_value_softmax_policy import StateValueSoftmaxPolicy
 from rlo import utils
 from rlo.expression_util import ExprWithEnv
@@ -159,11 +159,16 @@ class RolloutSearcher(AbstractSearcher):
         num_positive_examples: int,
         alpha_test: float,
         batch_size: int = 16,
+        max_nodes_per_batch: Optional[int] = None,
+        async_eval: bool = False,
         **kwargs
     ):
+        """ If async_eval, batches are evaluated in the background while other rollouts advance. """
         super().__init__(**kwargs)
         self._alpha_test = alpha_test
         self._batch_size = batch_size
+        self._max_nodes_per_batch = max_nodes_per_batch
+        self._async_eval = async_eval
         self._max_num_episodes = max_num_episodes
         self._num_positive_examples = num_positive_examples
 
@@ -244,18 +249,32 @@ class RolloutSearcher(AbstractSearcher):
                     pending_rollouts=len(rollouts_waiting_for_probs),
                     **search_ctrl.event_fields
                 )
-                # Evaluate the pending positions
-                cache.process_batches()
-                # All rollouts that were in rollouts_waiting_for_values, must now have all the _evaluation (value estimate) they need.
-                for rollout in rollouts_waiting_for_probs:
+                # Evaluate the pending positions. Asynchronously, first collect the previous
+                # batches, and advance only the rollouts they make ready while the new ones are evaluated.
+                cache.submit_batches()
+                ready, waiting = [], []
+                if cache.evaluates_asynchronously:
+                    for r in rollouts_waiting_for_probs:
+                        (
+                            ready
+                            if policy.can_compute_probs(r.current_node)
+                            else waiting
+                        ).append(r)
+                if len(ready) == 0:
+                    cache.collect_batches()
+                    ready, waiting = rollouts_waiting_for_probs, []
+                # All rollouts that are ready must now have all the _evaluation (value estimate) they need.
+                for rollout in ready:
                     # No need to compute probs more than once
                     if rollout.current_node.probs is None:
                         # Many rollouts may have been blocked at the same point
                         policy.compute_probs(rollout.current_node)
-                rollouts_to_advance.extend(rollouts_waiting_for_probs)
-                rollouts_waiting_for_probs.clear()
+                rollouts_to_advance.extend(ready)
+                rollouts_waiting_for_probs = waiting
             else:  # we know len(rollouts_to_advance) == 0
                 break
+        # Positions that no rollout is waiting for may still be in flight
+        cache.collect_batches()
 
         log_entries = {
             "seed": seed,
@@ -312,16 +331,19 @@ class ValueBasedRolloutSearcher(RolloutSearcher):
     ) -> Tuple[List[Episode], NodeEvaluationCache, Dict]:
         """ Performs value-based rollout search. """
         rng = utils.rng(seed)
-        cache = NodeEvaluationCache(
-            model_wrapper,
-            self._batch_size,
-            search_tree_node_class=StateValueSearchTreeNode,
-        )
         policy = StateValueSoftmaxPolicy(self._rules, alpha, rng)
-        # Enqueuing here slightly changes the behavior of StateValueSoftmaxPolicy.
-        # The root node will have it's value computed even tho that's not really necessary.
-        start_posn = cache.get_node(exprenv, self._simulation_depth)
-        return self._search_internal(seed, start_posn, policy, cache, search_ctrl)
+        with evaluation_executor(self._async_eval) as executor:
+            cache = NodeEvaluationCache(
+                model_wrapper,
+                self._batch_size,
+                search_tree_node_class=StateValueSearchTreeNode,
+                executor=executor,
+                max_nodes_per_batch=self._max_nodes_per_batch,
+            )
+            # Enqueuing here slightly changes the behavior of StateValueSoftmaxPolicy.
+            # The root node will have it's value computed even tho that's not really necessary.
+            start_posn = cache.get_node(exprenv, self._simulation_depth)
+            return self._search_internal(seed, start_posn, policy, cache, search_ctrl)
 
     def _build_dataset(self, seed, episodes, target_cost, **_kwargs):
         ep_costs = [
@@ -381,13 +403,18 @@ class PolicyBasedRolloutSearcher(RolloutSearcher):
     ) -> Tuple[List[Episode], NodeEvaluationCache, Dict]:
         """ Performs policy-based rollout search. """
         rng = utils.rng(seed)
-        cache = NodeEvaluationCache(
-            model_wrapper, self._batch_size, search_tree_node_class=ActionSearchTreeNode
-        )
         policy = PolicyNetPolicy(self._rules, alpha, rng)
-        # Enqueuing here slightly changes the behavior of StateValueSoftmaxPolicy
-        start_posn = cache.get_node(exprenv, self._simulation_depth)
-        return self._search_internal(seed, start_posn, policy, cache, search_ctrl)
+        with evaluation_executor(self._async_eval) as executor:
+            cache = NodeEvaluationCache(
+                model_wrapper,
+                self._batch_size,
+                search_tree_node_class=ActionSearchTreeNode,
+                executor=executor,
+                max_nodes_per_batch=self._max_nodes_per_batch,
+            )
+            # Enqueuing here slightly changes the behavior of StateValueSoftmaxPolicy
+            start_posn = cache.get_node(exprenv, self._simulation_depth)
+            return self._search_internal(seed, start_posn, policy, cache, search_ctrl)
 
     @staticmethod
     def get_empty_dataset():
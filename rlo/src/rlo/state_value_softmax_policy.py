@@ -54,6 +54,9 @@ class StateValueSoftmaxPolicy:
         index = self._rng.choice(len(transitions), p=node.probs)
         return [transitions[index]]
 
+    def can_compute_probs(self, node):
+        return all(c.has_evaluation() for c in node.children)
+
     def compute_probs(self, node):
         # This will raise if any children have None _evaluation (value estimate).
         action_values = [c.evaluation() + node.exprenv.cost() - c.exprenv.cost() for c in node.children]
@@ -2,7 +2,7 @@
 import abc
 
 from itertools import islice
-from typing import Dict, Iterable, Optional, List, Tuple, Union
+from typing import Dict, Hashable, Iterable, Optional, List, Tuple, Union
 
 import numpy as np
 import tensorflow as tf
@@ -318,6 +318,9 @@ class Weights:
     def weights(self):
         return self._weights
 
+    def content_hash(self) -> str:
+        return utils.hash_arrays(self._weights)
+
     def save(self, path):
         print("Saving model to {}".format(path))
         with utils.open_file_mkdir(path, "wb") as f:
@@ -406,6 +409,11 @@ class ModelInterpreter:
     def __init__(self, model: ModelWrapper):
         self.model = model
 
+    @property
+    def interpretation(self) -> Hashable:
+        """ Distinguishes interpreters which evaluate differently with the same weights. """
+        return None
+
     def evaluate_all_time_left(self, expr_batch: Iterable[Expression]):
         return self.model.evaluate_all_time_left(expr_batch)
 
@@ -416,6 +424,10 @@ class DualModelInterpolator(ModelInterpreter):
         self.model2 = model.model2
         self.var_fraction = var_fraction
 
+    @property
+    def interpretation(self) -> Hashable:
+        return self.var_fraction
+
     def evaluate_all_time_left(self, expr_batch: Iterable[Expression]):
         v1 = self.model1.evaluate_all_time_left(expr_batch)
         v2 = self.model2.evaluate_all_time_left(expr_batch)
@@ -427,6 +439,9 @@ class DualWeights(Weights):
         self.weights1 = weights1
         self.weights2 = weights2
 
+    def content_hash(self) -> str:
+        return self.weights1.content_hash() + self.weights2.content_hash()
+
     def save(self, path):
         path_before_ext, ext = path.split(".")
         self.weights1.save(path_before_ext + "_1" + ext)
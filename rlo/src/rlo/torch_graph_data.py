@@ -19,7 +19,7 @@ from rlo.expression_util import ExprWithEnv
 from rlo.dataset import RawValueExample
 from rlo.cost_normalizers import cost_normalizer
 from rlo.pipelines.pipeline import batch_with_max_nodes
-from rlo.graph_data import expr_to_graph_data as expr_to_numpy_graph_data
+from rlo.graph_data import GraphData, expr_to_graph_data as expr_to_numpy_graph_data
 
 # TODO use torchtyping to enforce that EdgeList is of shape [2, num_edges]
 # 1st row holds the source node index, and the 2nd row the target node index
@@ -161,22 +161,59 @@ class DataConverter:
 
     def expr_to_graph(self, exprenv: ExprWithEnv) -> BatchedGraphData:
         """Convert one expression to graph data"""
-        graph_data = expr_to_numpy_graph_data(
+        return self._to_batched_graph([self._numpy_graph_data(exprenv)], graph_id=False)
+
+    def exprs_to_graph(self, exprenvs: Sequence[ExprWithEnv]) -> BatchedGraphData:
+        """Convert a batch of expressions to graph data; equivalent to BatchedGraphData.collate
+        of expr_to_graph of each, but combines the graphs before copying to the device."""
+        return self._to_batched_graph(
+            [self._numpy_graph_data(e) for e in exprenvs], graph_id=True
+        )
+
+    def _numpy_graph_data(self, exprenv: ExprWithEnv) -> GraphData:
+        return expr_to_numpy_graph_data(
             exprenv.expr, use_subtree_match_edges=self._use_subtree_match_edges
         )
+
+    def _to_batched_graph(
+        self, graphs: List[GraphData], graph_id: bool
+    ) -> BatchedGraphData:
+        num_nodes = np.array([len(g.node_reps) for g in graphs])
+        node_offsets = np.cumsum(num_nodes) - num_nodes
+        # Edges of all types and graphs, ordered by type then graph, offset by the graph's first node.
+        num_edge_types = len(graphs[0].edge_lists)
+        edge_lists = [
+            edge_list
+            for t in range(num_edge_types)
+            for edge_list in (g.edge_lists[t] for g in graphs)
+        ]
+        num_edges = np.array([len(edge_list) for edge_list in edge_lists])
+        edges = np.concatenate(edge_lists).astype(np.int64)
+        edges += np.repeat(np.tile(node_offsets, num_edge_types), num_edges)[:, None]
+        # One copy to the device for each of node types, edges and graph ids.
         # pylint: disable=not-callable
-        node_type = torch.tensor(
-            graph_data.node_reps, dtype=torch.long, device=self._device
-        )
+        all_edges = torch.from_numpy(np.ascontiguousarray(edges.T)).to(self._device)
+        node_type = torch.from_numpy(
+            np.concatenate([g.node_reps for g in graphs]).astype(np.int64)
+        ).to(self._device)
         return BatchedGraphData(
             node_type=cast(torch.LongTensor, node_type),
             edge_lists=tuple(
-                cast(
-                    torch.LongTensor,
-                    torch.tensor(edge_index.T, dtype=torch.long, device=self._device),
+                cast(torch.LongTensor, edge_index)
+                for edge_index in torch.split(
+                    all_edges,
+                    num_edges.reshape(num_edge_types, len(graphs)).sum(axis=1).tolist(),
+                    dim=1,
                 )
-                for edge_index in graph_data.edge_lists
             ),
+            _graph_id=cast(
+                torch.LongTensor,
+                torch.from_numpy(np.repeat(np.arange(len(graphs)), num_nodes)).to(
+                    self._device
+                ),
+            )
+            if graph_id
+            else None,
         )
 
     def denormalize_and_numpify(
@@ -170,6 +170,14 @@ def train_model(
         loss_at_best=train_loss_at_best,
     )
 
+    # How closely the model as evaluated in search agrees with the model trained, on held-out data
+    analytics.event(
+        "inference_agreement",
+        verbosity=1,
+        num_exprs=len(raw_valid_examples),
+        **model_wrapper.inference_agreement([e.exprenv for e in raw_valid_examples]),
+    )
+
     log_fitted_vals(
         model_wrapper=model_wrapper,
         raw_examples=raw_train_examples + raw_valid_examples,
@@ -1,4 +1,5 @@
 import glob
+import hashlib
 import json
 import os
 import pickle
@@ -489,3 +490,14 @@ def permutation(nprng: np.random.Generator, seq: Sequence):
     if isinstance(seq, tuple):
         return tuple(permuted)
     return permuted
+
+
+def hash_arrays(arrays: Iterable[np.ndarray]) -> str:
+    """ A hash of the dtypes, shapes and contents of a sequence of arrays,
+    which is the same for equal arrays in any process. """
+    h = hashlib.sha256()
+    for a in arrays:
+        a = np.ascontiguousarray(a)
+        h.update(repr((a.dtype.str, a.shape)).encode())
+        h.update(a.tobytes())
+    return h.hexdigest()
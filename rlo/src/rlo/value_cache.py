@@ -0,0 +1,161 @@
+"""
+A bounded cache of model evaluations that persists across searches.
+
+Each search has its own NodeEvaluationCache, so successive searches with the same weights
+(e.g. over the same start expressions, or the eval searches following training searches)
+would otherwise re-evaluate the same expressions. A worker process keeps one ValueCache,
+and makes it active while executing each task with the weights it has loaded (see
+WorkerWithModel.exec); AsTrainModel / AsEvalModel then wrap the search model so that
+evaluations are looked up in, and stored into, the active cache.
+"""
+from collections import OrderedDict
+from contextlib import contextmanager
+import threading
+from typing import Any, Dict, Hashable, Iterable, Iterator, Optional, Tuple
+
+import numpy as np
+
+from rlo.expression_util import ExprWithEnv
+
+# Approximate bytes retained by the cache for each node of an expression used as a key
+_BYTES_PER_EXPR_NODE = 200
+
+
+def _evaluation_nbytes(evaluation) -> int:
+    if isinstance(evaluation, np.ndarray):
+        return evaluation.nbytes
+    if isinstance(evaluation, tuple):  # e.g. RawPolicyValueEvaluation
+        return sum(_evaluation_nbytes(e) for e in evaluation)
+    return 0
+
+
+def _own_copy(evaluation):
+    # Rows of a batch's evaluation are views that would keep the whole batch alive
+    if isinstance(evaluation, np.ndarray):
+        return evaluation.copy()
+    return evaluation
+
+
+class ValueCache:
+    """ A least-recently-used map from (weights key, expression) to the model's evaluation,
+    whose approximate size in bytes is kept at most max_bytes. Thread-safe. """
+
+    def __init__(self, max_bytes: int):
+        self._max_bytes = max_bytes
+        self._entries: "OrderedDict[Tuple[Hashable, ExprWithEnv], Tuple[Any, int]]" = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, weights_key: Hashable, exprenv: ExprWithEnv) -> Optional[Any]:
+        key = (weights_key, exprenv)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry[0]
+
+    def put(self, weights_key: Hashable, exprenv: ExprWithEnv, evaluation) -> None:
+        key = (weights_key, exprenv)
+        evaluation = _own_copy(evaluation)
+        nbytes = (
+            _evaluation_nbytes(evaluation)
+            + exprenv.expr.num_nodes * _BYTES_PER_EXPR_NODE
+        )
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._nbytes -= old[1]
+            self._entries[key] = (evaluation, nbytes)
+            self._nbytes += nbytes
+            while self._nbytes > self._max_bytes:
+                _, (_, evicted_nbytes) = self._entries.popitem(last=False)
+                self._nbytes -= evicted_nbytes
+                self._evictions += 1
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def nbytes(self) -> int:
+        return self._nbytes
+
+    def log_entries(self) -> Dict[str, Any]:
+        return {
+            "value_cache_hits": self._hits,
+            "value_cache_misses": self._misses,
+            "value_cache_evictions": self._evictions,
+            "value_cache_entries": len(self._entries),
+            "value_cache_bytes": self._nbytes,
+        }
+
+
+class CachedValuesModel:
+    """ A search model whose evaluations are looked up in a ValueCache, so that only
+    expressions not found there are evaluated by the underlying model. """
+
+    def __init__(self, model, value_cache: ValueCache, weights_key: Hashable):
+        """
+        Args:
+            model: the search model, e.g. from ModelWrapper.as_train_search_model()
+            weights_key: identifies the weights loaded into the model, and how the
+                model interprets them (see ModelInterpreter.interpretation)
+        """
+        self._model = model
+        self._value_cache = value_cache
+        self._weights_key = weights_key
+
+    def evaluate_all_time_left(self, expr_batch: Iterable[ExprWithEnv]):
+        expr_batch = list(expr_batch)
+        evaluations = [self._value_cache.get(self._weights_key, e) for e in expr_batch]
+        misses = [i for i, ev in enumerate(evaluations) if ev is None]
+        if len(misses) == 0:
+            return self._combine(evaluations)
+        evaluated = self._model.evaluate_all_time_left([expr_batch[i] for i in misses])
+        for i, ev in zip(misses, evaluated):
+            self._value_cache.put(self._weights_key, expr_batch[i], ev)
+            evaluations[i] = ev
+        if len(misses) == len(expr_batch):
+            return evaluated
+        return self._combine(evaluations)
+
+    @staticmethod
+    def _combine(evaluations):
+        # Value models return an array with a row per expression; others return lists.
+        if all(isinstance(ev, np.ndarray) for ev in evaluations):
+            return np.stack(evaluations)
+        return evaluations
+
+
+_active_cache: Optional[Tuple[ValueCache, Hashable]] = None
+
+
+@contextmanager
+def caching_values(
+    value_cache: Optional[ValueCache], weights_key: Optional[Hashable]
+) -> Iterator[None]:
+    """ Within this context, search models for the loaded weights identified by weights_key
+    (see with_cached_values) use value_cache. Does nothing if either is None. """
+    global _active_cache
+    prev = _active_cache
+    if value_cache is not None and weights_key is not None:
+        _active_cache = (value_cache, weights_key)
+    try:
+        yield
+    finally:
+        _active_cache = prev
+
+
+def with_cached_values(search_model):
+    """ Returns search_model using the active ValueCache (see caching_values), if any. """
+    if _active_cache is None:
+        return search_model
+    value_cache, weights_key = _active_cache
+    return CachedValuesModel(
+        search_model, value_cache, (weights_key, search_model.interpretation)
+    )
@@ -2,7 +2,7 @@
 from abc import ABC, abstractmethod
 from typing import Any, Callable, Generator, Iterable, Optional, Union
 
-from rlo import analytics
+from rlo import analytics, value_cache
 from rlo.utils import UrgencyQueue
 
 class Accumulator:
@@ -193,15 +193,17 @@ class ComposableFunction:
 
 class AsTrainModel(ComposableFunction):
     """ An adapter function that interprets a ModelWrapper for training search.
+        Uses the worker's ValueCache, if any (see value_cache.caching_values).
     """
     def __init__(self):
-        super().__init__(lambda model_wrapper: model_wrapper.as_train_search_model())
+        super().__init__(lambda model_wrapper: value_cache.with_cached_values(model_wrapper.as_train_search_model()))
 
 class AsEvalModel(ComposableFunction):
     """ An adapter function that interprets a ModelWrapper for evaluation search.
+        Uses the worker's ValueCache, if any (see value_cache.caching_values).
     """
     def __init__(self):
-        super().__init__(lambda model_wrapper: model_wrapper.as_eval_search_model())
+        super().__init__(lambda model_wrapper: value_cache.with_cached_values(model_wrapper.as_eval_search_model()))
 
 
 class WhenAllResultsReceived:
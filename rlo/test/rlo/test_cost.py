@@ -8,7 +8,7 @@ from rlo.costs import (
     let_cost,
 )
 from rlo.expression import Expression, EF, TypePropagationError
-from rlo.expression_util import SymtabAndDefs
+from rlo.expression_util import ExprWithEnv, SymtabAndDefs
 from testutils import make_toplevel as MT
 from rlo.sparser import parse_defs
 from ksc.type import Type
@@ -151,3 +151,37 @@ def test_ksc_rlo_costs_same(basic_symtab):  # pylint: disable=redefined-outer-na
     ).cost()
     # RLO adds a cost of 0.1 for the "let" corresponding to that "def" in the prelude
     assert cost_ksc == cost_rlo - let_cost
+
+
+@pytest.mark.parametrize(
+    "file",
+    [
+        "ksc/release/gelu.kso",
+        pytest.param("ksc/blas/blas_test.kso", marks=pytest.mark.notquick),
+        pytest.param("ksc/gmm/gmm_test.kso", marks=pytest.mark.notquick),
+    ],
+)
+def test_incremental_cost_after_rewrites(file):
+    from rlo.costs import _compute_cost
+    from rlo.expr_sets import get_expression_set
+    from rlo.rewrites import get_rules
+    from pyrsistent import pmap
+
+    rules = get_rules("binding_simplify_rules")
+    for _, e in get_expression_set(file).named_exprenvs():
+        assert e.cost() == _compute_cost(e.expr, e.env.defs, pmap())
+        for rewrite in rules.get_all_rewrites(e):
+            child = rewrite.apply(e)
+            assert child.cost() == _compute_cost(child.expr, child.env.defs, pmap())
+
+
+def test_incremental_cost_reuses_subtrees():
+    x = Expression.Variable("x", Type.Float)
+    e = MT(EF.Tuple(EF.Build(100, "i", EF.Build(100, "j", x * 2.0)), x + 1.0))
+    e.cost()
+    big = e.expr.children[0]
+    # Replace only the second element of the tuple; the first is shared with the original, so is not re-costed.
+    big._cost_cache[()] += 1000.0
+    rewritten = e.expr.replace_subtree(1 + big.num_nodes, x + 2.0)
+    assert rewritten.children[0] is big
+    assert ExprWithEnv(rewritten, e.env).cost() == e.cost() + 1000.0
@@ -1,4 +1,5 @@
 # fmt: off
+import pickle
 import pytest
 
 from rlo.expression import Expression, EF
@@ -218,3 +219,40 @@ def test_get_path():
         (4, e.right, 0),
         (5, Expression.Variable("a"), None)
     ]
+
+def test_interning():
+    from rlo.expression import interning, intern_expression
+    outside = EF.Let("x", 3.0, EF.Add("x", "y"))
+    with interning():
+        a = EF.Let("x", 3.0, EF.Add("x", "y"))
+        b = EF.Let("x", 3.0, EF.Add("x", "y"))
+        assert a is b
+        assert a.third is EF.Add("x", "y")
+        assert intern_expression(outside) is a
+        # Alpha-equivalent, but not structurally identical
+        c = EF.Let("z", 3.0, EF.Add("z", "y"))
+        assert c == a and c is not a
+        # Constants that compare equal in python, but are different Expressions
+        assert Expression.Constant(1) is not Expression.Constant(1.0)
+        assert Expression.Constant(1) is not Expression.Constant(True)
+        assert Expression.Constant(0.0) is not Expression.Constant(-0.0)
+        assert Expression.Variable("x", Type.Float) is not Expression.Variable("x")
+        assert a.free_var_names is EF.Mul(3.0, "y").free_var_names
+    check_equal_but_not_id(a, EF.Let("x", 3.0, EF.Add("x", "y")))
+    check_equal_but_not_id(a, outside)
+
+def test_interning_rewrites():
+    from rlo.expression import interning, intern_expression
+    from rlo import rewrites, sparser
+    from rlo.expression_util import ExprWithEnv
+    _, e = sparser.parse_defs(utils.read_file("src/rlo/ksc/blas/blas_test.kso"))[0]
+    rules = rewrites.get_rules("simplify_rules")
+    children = [rw.apply(e) for rw in rules.get_all_rewrites(e)]
+    with interning():
+        interned = ExprWithEnv(intern_expression(e.expr), e.env)
+        interned_children = [rw.apply(interned) for rw in rules.get_all_rewrites(interned)]
+        assert [str(c.expr) for c in interned_children] == [str(c.expr) for c in children]
+        assert [c.cost() for c in interned_children] == [c.cost() for c in children]
+        # The same rewrite applied again produces the same object
+        assert all(rw.apply(interned).expr is c.expr for rw, c in zip(rules.get_all_rewrites(interned), interned_children))
+    assert pickle.loads(pickle.dumps(interned_children[0])) == children[0]
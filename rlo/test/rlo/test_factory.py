@@ -26,6 +26,28 @@ def test_torch_model_from_config(use_subtree_match_edges, loss):
     factory.torch_model_from_config(config)
 
 
+@pytest.mark.parametrize("fuse_edge_types", [True, False])
+def test_torch_model_from_config_fuse_edge_types(fuse_edge_types):
+    config = {
+        "hidden_dim": 2,
+        "num_gnn_blocks": 2,
+        "output_hidden_dim": 2,
+        "simulation_depth_train": 10,
+        "lr": 0.01,
+        "loss": "huber",
+        "repetition": 1,
+        "decoder_readout": "sum",
+        "graph_state_keep_prob": 0.9,
+        "output_keep_prob": 0.2,
+        "aggregation_over_edge_types": "sum",
+        "use_subtree_match_edges": True,
+        "fuse_edge_types": fuse_edge_types,
+    }
+    model = factory.torch_model_from_config(config)
+    gnn_blocks = model.encoder.gnn.gnn_blocks
+    assert [b.fuse_edge_types for b in gnn_blocks] == [fuse_edge_types] * 2
+
+
 @pytest.mark.parametrize("use_subtree_match_edges", [True, False])
 def test_torch_data_converter_from_config(use_subtree_match_edges):
     # Check we can construct a DataConverter
@@ -1,6 +1,10 @@
 import numpy as np
+import pytest
 
+from rlo import graph_data
+from rlo.expr_sets import get_expression_set
 from rlo.graph_data import EdgeType, GraphData, expr_to_graph_data
+from rlo.rewrites import get_rules
 from testutils import parse_expr_typed
 
 
@@ -93,3 +97,49 @@ def test_tuple():
 
     # No edges of any remaining edge type
     assert all(len(e) == 0 for e in adj_lists.values())
+
+
+@pytest.mark.parametrize("use_subtree_match_edges", [True, False])
+def test_rewritten_graphs_match_reference(use_subtree_match_edges):
+    rules = get_rules("binding_simplify_rules")
+    graph_data._graph_cache.clear()
+    exprenvs = [
+        e for _, e in get_expression_set("ksc/gmm/gmm_test.kso").named_exprenvs()
+    ][:2]
+    # Graphs of the results of rewrites are derived from the graph of the rewritten expression
+    for _ in range(3):
+        for exprenv in exprenvs:
+            data = expr_to_graph_data(exprenv.expr, use_subtree_match_edges)
+            expected = graph_data._expr_to_graph_data_uncached(
+                exprenv.expr, use_subtree_match_edges
+            )
+            np.testing.assert_equal(data.node_reps, expected.node_reps)
+            for edge_type, (edges, expected_edges) in enumerate(
+                zip(data.edge_lists, expected.edge_lists)
+            ):
+                assert edges.dtype == expected_edges.dtype
+                if edge_type == EdgeType.SUBTREE_MATCH:
+                    # In order of source then destination
+                    expected_edges = expected_edges[
+                        np.lexsort((expected_edges[:, 1], expected_edges[:, 0]))
+                    ]
+                np.testing.assert_equal(edges, expected_edges)
+        exprenvs = [rw.apply(e) for e in exprenvs for rw in rules.get_all_rewrites(e)][
+            ::7
+        ]
+
+
+def test_set_graph_cache_mb():
+    e = parse_expr_typed("(add x (mul y 2.0))").expr
+    data = expr_to_graph_data(e, True)
+    assert graph_data._graph_cache.get(e) is not None
+    try:
+        # Too small for any graph: evicts e, and caches no more graphs
+        graph_data.set_graph_cache_mb(0)
+        assert graph_data._graph_cache.get(e) is None
+        np.testing.assert_equal(expr_to_graph_data(e, True), data)
+        assert graph_data._graph_cache.get(e) is None
+    finally:
+        graph_data.set_graph_cache_mb(256)
+    expr_to_graph_data(e, True)
+    assert graph_data._graph_cache.get(e) is not None
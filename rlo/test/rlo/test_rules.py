@@ -544,3 +544,40 @@ def test_rewrite_seq_to_exprenvs():
     # Without strict, we should get back *something*
     exprs = rewrites.rewrite_seq_to_exprenvs(e, bad_sequence)
     assert exprs[0] == e
+
+def _unindexed_rewrites(rules, expr):
+    # As RuleSet.get_all_rewrites, but trying every rule at every node, without the index or cache
+    return [rw for node_id, node, env in expr.node_ids_with_environment()
+        for r in rules for rw in r.get_local_rewrites(node, node_id, env=env)]
+
+def _rewrite_signature(rw):
+    return (type(rw), rw.rule_name, {k: str(v) for k, v in rw.__dict__.items()})
+
+@pytest.mark.parametrize("rules_name", ["ml_rules", "monomorphic_rules", "build_simplify_rules"])
+def test_indexed_rewrites_match_all_rules(rules_name):
+    rules = rewrites.get_rules(rules_name)
+    rand = random.Random(0)
+    for _, e in parse_defs(open(os.path.join("src", "rlo", "ksc", "blas", "blas_test.kso")).read())[:3]:
+        for _step in range(5):
+            rws = list(rules.get_all_rewrites(e))
+            assert [_rewrite_signature(rw) for rw in rws] == [_rewrite_signature(rw) for rw in _unindexed_rewrites(rules, e.expr)]
+            if len(rws) == 0:
+                break
+            e = rand.choice(rws).apply(e)
+
+def test_rewrites_reused_in_unchanged_subtrees():
+    rules = rewrites.get_rules("binding_simplify_rules")
+    x = Expression.Variable("x", Type.Float)
+    e = MT(EF.Let("a", EF.Mul(1.0, x), EF.Add(EF.Add("a", EF.Add(0.0, "a")), EF.Mul(1.0, EF.Add(0.0, x)))))
+    rws = list(rules.get_all_rewrites(e))
+    # Rewrite the bound value; the body is shared with the original but moves, as the bound value shrinks.
+    child = single_elem([rw for rw in rws if rw.rule_name == "mul_one" and rw.node_id == 2]).apply(e)
+    assert child.expr.third is e.expr.third
+    assert child.expr.num_nodes == e.expr.num_nodes - 2
+    child_rws = list(rules.get_all_rewrites(child))
+    assert [_rewrite_signature(rw) for rw in child_rws] == [_rewrite_signature(rw) for rw in _unindexed_rewrites(rules, child.expr)]
+    # And the moved rewrites produce the right results
+    body_rws = [rw for rw in child_rws if rw.node_id > 3]
+    assert any(rw.rule_name == "inline_let" for rw in body_rws)
+    for rw in body_rws:
+        assert rw.apply(child).expr.second is child.expr.second
@@ -1,4 +1,7 @@
 import functools
+import threading
+import time
+import numpy as np
 import pytest
 from typing import Tuple, Callable
 
@@ -415,6 +418,164 @@ def test_hybrid_search(seed=0):
         )
 
 
+class SlowModel:
+    """ Wraps a mock ModelWrapper, taking a random time for each evaluation
+    (independent of the model's own random values), and recording the evaluating threads. """
+
+    def __init__(self, model_wrapper, timing_seed):
+        self._model_wrapper = model_wrapper
+        self._timing_rng = np.random.default_rng(timing_seed)
+        self.threads = set()
+
+    def evaluate_all_time_left(self, exprenvs):
+        self.threads.add(threading.current_thread())
+        time.sleep(self._timing_rng.uniform(0, 0.005))
+        return self._model_wrapper.evaluate_all_time_left(exprenvs)
+
+
+def search_replay(searcher, model_wrapper, rng, *args, **kwargs):
+    """ The episodes and rollout_end log entries (except timings) of a search. """
+    with LogEventsToList(verbosity_limit=0) as logger:
+        episodes, _cache = searcher._search(model_wrapper, rng, *args, **kwargs)
+    rollout_end = utils.single_elem(
+        [e for e in logger.log_items if e["event"] == "rollout_end"]
+    )
+    timings = {
+        k: rollout_end.pop(k)
+        for k in list(rollout_end)
+        if k.endswith(("_time", "_per_sec"))
+    }
+    episodes = tuple(
+        tuple("{}@{}".format(n.node.exprenv.expr, n.node.time_left) for n in ep)
+        for ep in episodes
+    )
+    return episodes, rollout_end, timings
+
+
+class SlowExpander(Expander):
+    def __call__(self, node, cache):
+        time.sleep(0.001)
+        super().__call__(node, cache)
+
+
+def test_astar_async_eval_deterministic(seed=0):
+    searcher = AStarSearcher(
+        rules=rewrites.get_rules("binding_rules"),
+        maxing=dummy_maxing,
+        simulation_depth=10,
+        max_gnn=200,
+        batch_size=8,
+        expander_factory=SlowExpander,
+        async_eval=True,
+    )
+    replays = []
+    for timing_seed in range(3):
+        model = SlowModel(
+            RandomStateValueModel(make_rng(seed), num_time_heads=11), timing_seed
+        )
+        replays.append(search_replay(searcher, model, None, get_test_expr()))
+        assert threading.main_thread() not in model.threads
+    episodes, log_entries, timings = replays[0]
+    assert all(r[:2] == (episodes, log_entries) for r in replays)
+    assert log_entries["posns_evaluated"] >= 200
+    # Expansion, which takes at least 1ms, overlaps with evaluation of the previous batch
+    assert timings["gnn_eval_overlap_time"] > 0
+
+
+@pytest.mark.parametrize("async_eval", [False, True])
+def test_rollouts_async_eval_deterministic(async_eval, seed=0):
+    searcher = ValueBasedRolloutSearcher(
+        rules=rewrites.get_rules("simplify_rules"),
+        maxing=dummy_maxing,
+        simulation_depth=10,
+        num_episode_clusters=3,
+        alpha_test=0.0,
+        num_positive_examples=0,
+        max_num_episodes=0,
+        batch_size=8,
+        async_eval=async_eval,
+    )
+    e = parse_expr_typed("(div (div 1.0 x) (add 1.0 (div 1.0 x)))")
+    replays = []
+    for timing_seed in range(3):
+        # The model evaluates on another thread, so must not share the search's rng
+        model = SlowModel(
+            RandomStateValueModel(make_rng(seed), num_time_heads=11), timing_seed
+        )
+        replays.append(
+            search_replay(
+                searcher,
+                model,
+                seed,
+                e,
+                SearchController(64),
+                target_cost=None,
+                alpha=0.5,
+            )
+        )
+        assert (threading.main_thread() in model.threads) != async_eval
+    episodes, log_entries, timings = replays[0]
+    assert len(episodes) == 64
+    assert all(r[:2] == (episodes, log_entries) for r in replays)
+    if not async_eval:
+        assert timings["gnn_eval_overlap_time"] == 0
+
+
+class BatchRecordingModel:
+    """ Wraps a mock ModelWrapper, recording the number of nodes in each expression of each batch. """
+
+    def __init__(self, model_wrapper):
+        self._model_wrapper = model_wrapper
+        self.batches = []
+
+    def evaluate_all_time_left(self, exprenvs):
+        self.batches.append([e.expr.num_nodes for e in exprenvs])
+        return self._model_wrapper.evaluate_all_time_left(exprenvs)
+
+
+@pytest.mark.parametrize("cls", [AStarSearcher, HybridSearcher, PseudoBeamSearcher])
+def test_astarlike_max_nodes_per_batch(cls, seed=0):
+    searcher = cls(
+        rules=rewrites.get_rules("binding_rules"),
+        maxing=dummy_maxing,
+        simulation_depth=10,
+        max_gnn=200,
+        max_nodes_per_batch=100,
+    )
+    model = BatchRecordingModel(
+        RandomStateValueModel(make_rng(seed), num_time_heads=11)
+    )
+    episodes, log_entries, timings = search_replay(
+        searcher, model, make_rng(seed), get_test_expr()
+    )
+    assert all(sum(batch) <= 100 for batch in model.batches)
+    # Most batches are full: only the last batch of each process_batches may not be
+    assert sum(map(sum, model.batches)) > 50 * len(model.batches)
+    assert log_entries["gnn_eval_nodes"] == sum(map(sum, model.batches))
+    assert timings["gnn_eval_nodes_per_sec"] > 0
+
+
+def test_rollouts_max_nodes_per_batch(seed=0):
+    searcher = ValueBasedRolloutSearcher(
+        rules=rewrites.get_rules("binding_rules"),
+        maxing=dummy_maxing,
+        simulation_depth=10,
+        num_episode_clusters=3,
+        alpha_test=0.0,
+        num_positive_examples=0,
+        max_num_episodes=0,
+        max_nodes_per_batch=1000,
+    )
+    rng = make_rng(seed)
+    model = BatchRecordingModel(RandomStateValueModel(rng, num_time_heads=11))
+    searcher._search(
+        model, rng, get_test_expr(), SearchController(64), target_cost=None, alpha=0.5
+    )
+    assert all(sum(batch) <= 1000 for batch in model.batches)
+    # More expressions than the default batch_size
+    assert max(len(batch) for batch in model.batches) > 16
+
+
 def test_more_maxing_strictly_better():
     # These counts will change if either (a) ValueBasedRolloutSearcher changes,
     # OR (b) the rulesets change: the order of the rules, or new rules being added/removed
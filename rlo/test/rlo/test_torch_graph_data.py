@@ -47,6 +47,23 @@ def test_batch_size(batch_size, use_subtree_match_edges):
     assert batch.num_graphs == batch_size
 
 
+def test_exprs_to_graph(use_subtree_match_edges):
+    dataset = load_dataset("datasets/value_dataset.json")
+    exprenvs = [
+        parse_expr_typed(x, default_var_type=Type.Float) for _, x, _ in dataset[:10]
+    ]
+    data_converter = get_data_converter(use_subtree_match_edges)
+    expected = BatchedGraphData.collate(
+        [data_converter.expr_to_graph(exprenv) for exprenv in exprenvs]
+    )
+    batch = data_converter.exprs_to_graph(exprenvs)
+    assert torch.equal(batch.node_type, expected.node_type)
+    assert torch.equal(batch.graph_id, expected.graph_id)
+    assert len(batch.edge_lists) == len(expected.edge_lists)
+    for edge_list, expected_edge_list in zip(batch.edge_lists, expected.edge_lists):
+        assert torch.equal(edge_list, expected_edge_list)
+
+
 @pytest.mark.parametrize(
     "expr_str,num_nodes,num_edges", [("x", 1, 0), ("sub (mul a b) 3", 5, 8)]
 )
@@ -191,6 +191,40 @@ class TestRelationalGatedGraphConv:
             ),
         )
 
+    def test_fused_edge_types_equivalent(
+        self, relational_gcn: RelationalGatedGraphConv, use_subtree_match_edges: bool
+    ):
+        batch_size = 10
+        batch = get_graph_batch(batch_size, use_subtree_match_edges)
+        relational_gcn.eval()
+
+        def outputs_and_grads(fuse_edge_types: bool):
+            relational_gcn.fuse_edge_types = fuse_edge_types
+            relational_gcn.zero_grad()
+            with torch.no_grad():
+                no_grad_outputs = relational_gcn(
+                    node_states=as_one_hot(batch.node_type),
+                    edge_lists=batch.edge_lists,
+                )
+            outputs = relational_gcn(
+                node_states=as_one_hot(batch.node_type), edge_lists=batch.edge_lists,
+            )
+            outputs.sum().backward()
+            return (
+                no_grad_outputs,
+                outputs.detach(),
+                [p.grad.clone() for p in relational_gcn.parameters()],
+            )
+
+        fused_no_grad, fused, fused_grads = outputs_and_grads(True)
+        per_edge_type_no_grad, per_edge_type, per_edge_type_grads = outputs_and_grads(
+            False
+        )
+        torch.testing.assert_allclose(fused_no_grad, per_edge_type_no_grad)
+        torch.testing.assert_allclose(fused, per_edge_type)
+        for grad, per_edge_type_grad in zip(fused_grads, per_edge_type_grads):
+            torch.testing.assert_allclose(grad, per_edge_type_grad)
+
 
 class TestStackedRelationalGNN:
     @pytest.fixture
@@ -367,3 +401,27 @@ def test_gnn_encoder_and_regressor__end_to_end__outputs_expected_shape(
     encoded = encoder(node_type=batch.node_type, edge_lists=batch.edge_lists,)
     regressed_values = regressor(encoded, graph_id=batch.graph_id)
     assert regressed_values.shape == (batch_size, num_time_heads)
+
+
+@pytest.mark.parametrize("batch_size", [1, 8, 64])
+def test_fused_edge_types_inference(batch_size: int):
+    """The fused and per-edge-type implementations agree in inference, for batches of
+    increasing size. (rlo.model.layers._timeit compares their latency.)"""
+    gcns = {
+        fuse_edge_types: RelationalGatedGraphConv(
+            hidden_dim=32,
+            num_edge_types=EdgeType.num_edge_types(),
+            num_propagations=10,
+            fuse_edge_types=fuse_edge_types,
+        ).eval()
+        for fuse_edge_types in [False, True]
+    }
+    gcns[True].load_state_dict(gcns[False].state_dict())
+    batch = get_graph_batch(batch_size, use_subtree_match_edges=True)
+    node_states = torch.randn(batch.num_nodes, 32)
+    with torch.no_grad():
+        outputs = {
+            fuse_edge_types: gcn(node_states, batch.edge_lists)
+            for fuse_edge_types, gcn in gcns.items()
+        }
+    torch.testing.assert_allclose(outputs[True], outputs[False])
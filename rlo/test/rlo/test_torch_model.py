@@ -7,7 +7,13 @@ import pytest
 import torch
 
 from test_torch_state_value_estimator import get_state_value_estimator
+from rlo import utils
+from rlo.expr_sets import get_expression_set
+from rlo.expression import Expression
+from rlo.graph_data import EdgeType
+from rlo.model.layers import DropoutGRUCell
 from rlo.model.model import TorchModelWrapper, OptimizerAndLossNotInitialized
+from rlo.model.state_value_estimator import StateValueModel
 from rlo.torch_graph_data import DataConverter
 from testutils import parse_expr_typed
 
@@ -146,3 +152,87 @@ def test_save_restore_model_state(expr_batch):
             # Model with different num_time_heads is incompatible
             with pytest.raises(Exception):
                 model_wrapper.set_weights(weights)
+
+
+def get_model_wrapper_with_dropout(**kwargs):
+    with utils.random_state_context(0):
+        model = StateValueModel(
+            num_node_types=Expression.num_node_types,
+            gnn_hidden_dim=16,
+            num_edge_types=EdgeType.num_edge_types(use_subtree_match_edges=False),
+            num_gnn_blocks=2,
+            regressor_hidden_dim=13,
+            num_time_heads=12,
+            loss="pinball=0.9",
+            lr=0.001,
+            gnn_dropout=0.5,
+            regressor_dropout=0.5,
+        )
+    return TorchModelWrapper(
+        data_converter=get_data_converter(num_time_heads=12),
+        model=model,
+        device=torch.device("cpu"),
+        **kwargs,
+    )
+
+
+def get_exprenvs():
+    return [
+        e for _, e in get_expression_set("ksc/gmm/gmm_test.kso").named_exprenvs()
+    ] + [
+        parse_expr_typed("(let ((a (add x 3.0))) (add (mul a a) y))"),
+        parse_expr_typed("(mul (add x 3.0) (add x y))"),
+    ]
+
+
+def test_inference_model_matches_model():
+    model_wrapper = get_model_wrapper_with_dropout(inference_threads=1)
+    model_wrapper.model.init_optimizer_and_loss()
+    exprenvs = get_exprenvs()
+    model_wrapper.model.eval()
+    with torch.no_grad():
+        expected = model_wrapper.model(
+            model_wrapper.data_converter.exprs_to_graph(exprenvs)
+        ).numpy()
+    np.testing.assert_allclose(
+        model_wrapper.evaluate_all_time_left(exprenvs), expected, rtol=1e-6
+    )
+    assert model_wrapper.interpretation is None
+    model_wrapper.model.train()
+    assert model_wrapper.inference_agreement(exprenvs)["inference_max_abs_diff"] < 1e-5
+    # The model is not left in eval mode, which would disable dropout in training
+    assert model_wrapper.model.training
+
+    inference_model = model_wrapper.inference_model
+    assert not any(
+        isinstance(m, (torch.nn.Dropout, DropoutGRUCell))
+        for m in inference_model.modules()
+    )
+    assert not any(p.requires_grad for p in inference_model.parameters())
+    assert all(p.requires_grad for p in model_wrapper.model.parameters())
+    # The same copy is used until the weights of the model change
+    assert model_wrapper.inference_model is inference_model
+    dummy_step(model_wrapper)
+    assert model_wrapper.inference_model is not inference_model
+
+
+def test_quantized_inference_agreement():
+    exprenvs = get_exprenvs()
+    model_wrapper = get_model_wrapper_with_dropout()
+    quantized_model_wrapper = get_model_wrapper_with_dropout(quantize_inference=True)
+    assert quantized_model_wrapper.interpretation != model_wrapper.interpretation
+    assert any(
+        isinstance(m, torch.nn.quantized.dynamic.Linear)
+        for m in quantized_model_wrapper.inference_model.modules()
+    )
+    agreement = quantized_model_wrapper.inference_agreement(exprenvs)
+    assert 0 < agreement["inference_max_abs_diff"]
+    assert (
+        agreement["inference_mean_abs_diff"]
+        < 0.05 * agreement["inference_mean_abs_value"]
+    )
+    np.testing.assert_allclose(
+        quantized_model_wrapper.evaluate_all_time_left(exprenvs),
+        model_wrapper.evaluate_all_time_left(exprenvs),
+        atol=agreement["inference_max_abs_diff"] * 1.01,
+    )
@@ -7,6 +7,7 @@ from rlo import analytics
 from testutils import get_config, parse_expr_typed
 from rlo.local_worker import LocalWorker
 from rlo import utils
+from rlo import value_cache
 from rlo import worker
 
 exp = parse_expr_typed("(let (a (div 1.0 x)) (div a (add 1.0 a)))")
@@ -204,3 +205,92 @@ def test_local_worker_stackoverflow_without_wait():
             w.schedule_work_requests_from(foo(1000, False))
     w.run()
     w.schedule_work_requests_from(foo(2000, True))
+
+
+def test_value_cache_lru():
+    e1, e2, e3 = [
+        parse_expr_typed(s) for s in ["(add 1.0 x)", "(mul 2.0 x)", "(div x 3.0)"]
+    ]
+    entry_bytes = np.zeros(4).nbytes + e1.expr.num_nodes * 200
+    cache = value_cache.ValueCache(max_bytes=entry_bytes - 1)
+    cache.put("w", e1, np.zeros(4))
+    assert len(cache) == 0  # A single entry exceeds the limit
+    cache = value_cache.ValueCache(max_bytes=2 * entry_bytes)
+    cache.put("w", e1, np.zeros(4))
+    cache.put("w", e2, np.ones(4))
+    assert cache.get("w", e1) is not None  # Now e2 is least recently used
+    assert cache.get("other_weights", e1) is None
+    cache.put("w", e3, np.full(4, 3.0))
+    assert cache.get("w", e2) is None
+    np.testing.assert_equal(cache.get("w", e1), np.zeros(4))
+    np.testing.assert_equal(cache.get("w", e3), np.full(4, 3.0))
+    assert cache.log_entries()["value_cache_evictions"] == 1
+
+
+def test_local_worker_value_cache():
+    exps = [exp, parse_expr_typed("(div 1.0 (add 1.0 x))")]
+    config = get_config()
+    config["device"] = "/cpu:0"
+    config["value_cache_mb"] = 1
+    w = LocalWorker(config)
+    results = []
+
+    def client():
+        weights = yield worker.RunOnGPU("init", 0, lambda mw: mw.get_weights())
+        for eval_exprs in [exps[:1], exps, exps]:
+            vals = yield worker.RunOnGPU(
+                "eval",
+                weights,
+                worker.AsEvalModel().then(
+                    lambda m, es: m.evaluate_all_time_left(es), eval_exprs
+                ),
+            )
+            results.append(vals)
+        # The model itself is not cached
+        vals = yield worker.RunOnGPU(
+            "eval_raw", weights, lambda mw: mw.evaluate_all_time_left(exps)
+        )
+        results.append(vals)
+
+    with analytics.LogEventsToList(verbosity_limit=1) as l:
+        w.schedule_work_requests_from(client())
+        w.run()
+    # Evaluations in different batches may differ by rounding
+    for vals in results[1:]:
+        np.testing.assert_allclose(vals, results[-1], atol=1e-6)
+    np.testing.assert_allclose(results[0], results[-1][:1], atol=1e-6)
+    # The third evaluation is entirely from the cache
+    np.testing.assert_array_equal(results[2], results[1])
+    cache_logs = [e for e in l.log_items if e["event"] == "value_cache"]
+    assert [(e["value_cache_hits"], e["value_cache_misses"]) for e in cache_logs] == [
+        (0, 1),
+        (1, 2),
+        (3, 2),
+        (3, 2),
+    ]
+
+
+@pytest.mark.parametrize("intern_expressions", [False, True])
+def test_local_worker_intern_expressions(intern_expressions):
+    from rlo import rewrites
+
+    config = get_config()
+    config["device"] = "/cpu:0"
+    config["intern_expressions"] = intern_expressions
+    w = LocalWorker(config)
+    rules = rewrites.get_rules("simplify_rules")
+    results = []
+
+    def rewrite_twice(_model_wrapper):
+        return [
+            (rw.apply(exp).expr, rw.apply(exp).expr)
+            for rw in rules.get_all_rewrites(exp)
+        ]
+
+    w.schedule("rewrite", None, rewrite_twice, results.append)
+    w.run()
+    (pairs,) = results
+    assert len(pairs) > 0
+    for e1, e2 in pairs:
+        assert e1 == e2
+        assert (e1 is e2) == intern_expressions
@@ -98,7 +98,12 @@ for benchmark_name, benchmark_value in groupedbenchmarks.items():
 
     configurations = defaultdict(set)
 
-    for test_name in ("test_forward", "test_backwards", "test_inference"):
+    for test_name in (
+        "test_forward",
+        "test_backwards",
+        "test_forward_and_backwards",
+        "test_inference",
+    ):
         for time, benchmark in benchmark_value[test_name]:
             configuration = benchmark["group"]
 
@@ -1,5 +1,5 @@
 # set up for global PyTest
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, replace
 import pytest
 import importlib
 import inspect
@@ -12,8 +12,13 @@ from collections import namedtuple
 from contextlib import contextmanager
 from typing import Callable
 
-from ksc.torch_frontend import KscStub, CompileConfiguration
-from ksc.compile import VecSpec_Elementwise
+from ksc.torch_frontend import (
+    KscStub,
+    CompileConfiguration,
+    make_KscAutogradFunction,
+    torch_from_ks,
+)
+from ksc.compile import VecSpec_Elementwise, VecSpec_VMap
 from ksc import utils
 
 
@@ -47,6 +52,7 @@ class BenchmarkFunction:
     name: str
     func: Callable
     device: torch.device = field(default=torch.device("cpu"))
+    supports_grad: bool = True
 
     def to_device(self, input: torch.Tensor):
         if self.device != torch.device("cpu"):
@@ -70,6 +76,65 @@ def function_to_torch_benchmarks(func):
         )
 
 
+def knossos_direct_entry(py_mod):
+    """
+    Call the compiled entry point without going through KscAutogradFunction,
+    to measure the per-call overhead of the autograd path.
+    """
+
+    def entry(x: torch.Tensor):
+        py_mod.reset_allocator()
+        return torch_from_ks(py_mod.entry(x))
+
+    return entry
+
+
+def benchmark_thread_counts():
+    """
+    Thread counts at which to benchmark parallel entry points:
+    powers of two up to the number of threads torch would use by default.
+    """
+    n = 1
+    while n < torch.get_num_threads():
+        yield n
+        n *= 2
+    yield torch.get_num_threads()
+
+
+def with_num_threads(func, num_threads):
+    """
+    Run func with the ATen intra-op thread pool set to num_threads threads.
+    """
+
+    def run(x: torch.Tensor):
+        old_num_threads = torch.get_num_threads()
+        torch.set_num_threads(num_threads)
+        try:
+            return func(x)
+        finally:
+            torch.set_num_threads(old_num_threads)
+
+    return run
+
+
+def knossos_parallel_benchmarks(fn_obj, torch_extension_name, example_inputs):
+    parallel_stub = replace(
+        fn_obj,
+        vectorization=replace(fn_obj.vectorization, parallel=True),
+        compiled=dict(),
+    )
+    ks_compiled = parallel_stub.compile(
+        torch_extension_name=torch_extension_name + "_par",
+        example_inputs=example_inputs,
+        configuration=CompileConfiguration(gpu=False),
+    )
+    for num_threads in benchmark_thread_counts():
+        yield BenchmarkFunction(
+            f"Knossos parallel {num_threads}",
+            with_num_threads(ks_compiled.apply, num_threads),
+        )
+
+
 def function_to_manual_cuda_benchmarks(func):
     cuda_device = torch.device("cuda")
     cpu_device = torch.device("cpu")
@@ -117,6 +182,25 @@ def functions_to_benchmark(
                     configuration=CompileConfiguration(gpu=False),
                 )
                 yield BenchmarkFunction("Knossos", ks_compiled.apply)
+                if hasattr(ks_compiled.py_mod, "entry_fwdpass"):
+                    # The same module, but recomputing the forward pass in backward
+                    yield BenchmarkFunction(
+                        "Knossos unfused VJP",
+                        make_KscAutogradFunction(
+                            ks_compiled.py_mod, fused_vjp=False
+                        ).apply,
+                    )
+                yield BenchmarkFunction(
+                    "Knossos entry",
+                    knossos_direct_entry(ks_compiled.py_mod),
+                    supports_grad=False,
+                )
+                if isinstance(
+                    fn_obj.vectorization, (VecSpec_Elementwise, VecSpec_VMap)
+                ):
+                    yield from knossos_parallel_benchmarks(
+                        fn_obj, torch_extension_name, example_inputs
+                    )
                 if (
                     isinstance(fn_obj.vectorization, VecSpec_Elementwise)
                     and torch.cuda.is_available()
@@ -26,6 +26,8 @@ def test_inference(benchmark, reference_func, func, config):
 
 
 def test_forward(benchmark, reference_func, func, config):
+    if not func.supports_grad:
+        pytest.skip(f"{func.name} does not support gradients")
     config.requires_grad = True
     config_on_func_device = func.to_device(config)
     result = benchmark_semi_pedantic(benchmark, func.func, config_on_func_device).to(
@@ -36,6 +38,8 @@ def test_forward(benchmark, reference_func, func, config):
 
 
 def test_backwards(benchmark, reference_func, func, config):
+    if not func.supports_grad:
+        pytest.skip(f"{func.name} does not support gradients")
     config.requires_grad = True
     config_on_func_device = func.to_device(config)
 
@@ -53,3 +57,26 @@ def test_backwards(benchmark, reference_func, func, config):
     reference_loss = reference_func(config).sum()
     reference_result = torch.autograd.grad(reference_loss, config)
     assert_close(result[0].to(cpu_device), reference_result[0])
+
+
+def test_forward_and_backwards(benchmark, reference_func, func, config):
+    # A whole training step.  Unlike test_backwards, this includes the
+    # forward pass, so that it fairly compares "Knossos", whose forward
+    # pass saves intermediate values for its backward pass, with
+    # "Knossos unfused VJP", whose backward pass recomputes them.
+    if not func.supports_grad:
+        pytest.skip(f"{func.name} does not support gradients")
+    config.requires_grad = True
+    config_on_func_device = func.to_device(config)
+
+    def forward_and_backwards(x):
+        loss = func.func(x).sum()
+        return torch.autograd.grad(loss, config)
+
+    result = benchmark_semi_pedantic(
+        benchmark, forward_and_backwards, config_on_func_device
+    )
+
+    reference_loss = reference_func(config).sum()
+    reference_result = torch.autograd.grad(reference_loss, config)
+    assert_close(result[0].to(cpu_device), reference_result[0])
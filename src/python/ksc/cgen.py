@@ -1,6 +1,7 @@
-from typing import Any
+from typing import Any, List
 from enum import Enum
 from dataclasses import dataclass, field
+import re
 
 from ksc import utils
 from ksc.type import Type
@@ -21,8 +22,14 @@ class VecSpec:
      None: f is compiled to take rank 3 tensors.
      Elementwise: f is compiled to take floats (rank 0), and is computed elementwise.
      VMap: f is compiled to take rank 2 tensors, and mapped over the first dimension.
+
+    Elementwise and VMap take a flag `parallel`: if set, the calls to f are
+    spread over the ATen intra-op thread pool (see torch.set_num_threads),
+    each thread allocating from its own arena.
     """
 
+    parallel = False
+
     def str(self):
         return "BASE_VecSpec"
 
@@ -38,17 +45,19 @@ class VecSpec_None(VecSpec):
 @dataclass
 class VecSpec_Elementwise(VecSpec):
     example_element: Any = field(default=1.1)
+    parallel: bool = field(default=False)
 
     def str(self):
-        return "VSelem"
+        return "VSelem_par" if self.parallel else "VSelem"
 
 
 @dataclass
 class VecSpec_VMap(VecSpec):
     dims_to_strip: int = field(default=1)
+    parallel: bool = field(default=False)
 
     def str(self):
-        return "VSvmap"
+        return "VSvmap_par" if self.parallel else "VSvmap"
 
 
 scalar_type_to_cpp_map = {
@@ -87,9 +96,9 @@ def entry_point_cpp_type(t, use_torch):
         )
     elif t.is_tensor:
         if use_torch:
-            if t.tensor_elem_type != Type.Float:
+            if t.tensor_elem_type not in (Type.Float, Type.Integer):
                 raise ValueError(
-                    f'Entry point signatures may only use tensors with floating-point elements (not "{t}")'
+                    f'Entry point signatures may only use tensors with Float or Integer elements (not "{t}")'
                 )
             return "torch::Tensor"
         else:
@@ -165,6 +174,27 @@ def arg_types_of_decl(decl):
         return arg_types
 
 
+def with_thread_allocator(cpp_body, wrapper):
+    """
+    C++ for a function body which runs CPP_BODY with `alloc` naming the
+    calling thread's allocator, growing the allocator and rerunning
+    CPP_BODY if it overflows.  WRAPPER names one of the
+    with_thread_allocator* functions in knossos-entry-points*.h, which
+    differ in whether they reset the allocator afterwards.
+    """
+    return f"""
+    return {wrapper}([&](ks::allocator * alloc) {{
+{cpp_body}
+    }});
+"""
+
+
+def entry_point_allocator_wrapper(use_torch):
+    # Torch entry points return torch values, which may view the
+    # allocator (see knossos-entry-points-torch.h)
+    return "with_thread_allocator_torch" if use_torch else "with_thread_allocator"
+
+
 def generate_cpp_entry_point(
     cpp_function_name: str,
     decl: Def,
@@ -178,15 +208,26 @@ def generate_cpp_entry_point(
         if gpu:
             return generate_cpp_cuda_entry_point(cpp_function_name, decl)
         else:
-            return generate_cpp_elementwise_entry_point(cpp_function_name, decl)
-    if gpu:
-        raise ValueError(
-            "Only elementwise operations can be compiled for GPU"
-        )  # TODO: could also support vmap
+            return generate_cpp_elementwise_entry_point(
+                cpp_function_name, decl, vectorization.parallel
+            )
     if isinstance(vectorization, VecSpec_VMap):
         if not use_torch:
             raise ValueError("VMap only available when using torch")
-        return generate_cpp_vmap_entry_point(cpp_function_name, decl)
+        if gpu:
+            return generate_cpp_cuda_vmap_entry_point(cpp_function_name, decl)
+        return generate_cpp_vmap_entry_point(
+            cpp_function_name, decl, vectorization.parallel
+        )
+    if gpu:
+        raise ValueError("Only elementwise and vmap operations can be compiled for GPU")
+    if is_split_derivative_pass(decl.name):
+        if not use_torch:
+            raise ValueError("Split derivative passes only available when using torch")
+        if decl.name.is_derived("suffwdpass"):
+            return generate_cpp_suffwdpass_entry_point(cpp_function_name, decl)
+        else:
+            return generate_cpp_sufrevpass_entry_point(cpp_function_name, decl)
 
     arg_types = arg_types_of_decl(decl)
     num_args = len(arg_types)
@@ -204,30 +245,240 @@ def generate_cpp_entry_point(
 
     cpp_declaration = f"{cpp_function};\n"
 
-    cpp = f"""
-{cpp_function} {{
-"""
+    cpp_body = ""
 
     # auto ks_arg0 = convert_to_ks_viewing_tensordata<ks::tensor<Dim, Float>>(arg0);
     # ...
     # auto ks_arg7 = convert_to_ks_viewing_tensordata<ks::tensor<Dim, Float>>(arg7);
     for i in range(num_args):
-        cpp += f"    auto ks_arg{i} = convert_to_ks_viewing_tensordata<{ks_cpp_type(arg_types[i])}>(arg{i});\n"
+        cpp_body += f"    auto ks_arg{i} = convert_to_ks_viewing_tensordata<{ks_cpp_type(arg_types[i])}>(arg{i});\n"
 
-    # auto ks_ret = ks::my_kernel(&g_alloc, ks_arg0, ..., ks_arg7);
-    cpp += f"""
-    auto ks_ret = ks::{ks_function_name}(&g_alloc {join_args("", lambda i: f", ks_arg{i}")});
+    # auto ks_ret = ks::my_kernel(alloc, ks_arg0, ..., ks_arg7);
+    cpp_body += f"""
+    auto ks_ret = ks::{ks_function_name}(alloc {join_args("", lambda i: f", ks_arg{i}")});
 """
 
     # convert return value and return
-    cpp += f"""
+    cpp_body += f"""
     return convert_from_ks<{cpp_return_type}>(ks_ret);
+"""
+
+    cpp = f"""
+{cpp_function} {{
+{with_thread_allocator(cpp_body, entry_point_allocator_wrapper(use_torch))}
+}}
+"""
+
+    if not has_batch_entry_point(vectorization, cpp_function_name):
+        return cpp_declaration, cpp
+
+    batch_declaration, batch_cpp = generate_cpp_batch_entry_point(
+        cpp_function_name, decl, use_torch
+    )
+    return cpp_declaration + batch_declaration, cpp + batch_cpp
+
+
+def batch_entry_point_name(cpp_function_name):
+    return cpp_function_name + "_batch"
+
+
+def has_batch_entry_point(vectorization: VecSpec, binding_name):
+    """
+    Whether generate_cpp_entry_points also generates, for binding_name, an
+    entry point named batch_entry_point_name(binding_name) which calls the
+    function on each of a list of argument tuples.  Only the "entry"
+    binding of a non-vectorized function has one, as only KscStub.call_batch
+    uses them.
+    """
+    return isinstance(vectorization, VecSpec_None) and binding_name == "entry"
+
+
+def is_split_derivative_pass(structured_name):
+    """
+    Whether structured_name is the forward (suffwdpass) or reverse
+    (sufrevpass) pass of a split derivative.  Their entry points pass the
+    intermediate values ("BOG") from one to the other as an opaque
+    saved_values object (see knossos-entry-points-torch.h).
+    """
+    return structured_name.is_derived("suffwdpass") or structured_name.is_derived(
+        "sufrevpass"
+    )
+
+
+def generate_cpp_suffwdpass_entry_point(cpp_function_name, decl):
+    """
+    The forward pass returns the function's result, converted to torch
+    values, and its intermediate values, copied out of the allocator into
+    a saved_values object for the reverse pass.
+    """
+    arg_types = arg_types_of_decl(decl)
+    num_args = len(arg_types)
+
+    def join_args(sep, callable):
+        return sep.join(callable(i) for i in range(num_args))
+
+    ks_function_name = utils.encode_name(decl.name.mangled())
+
+    cpp_arg_types = [entry_point_cpp_type(t, use_torch=True) for t in arg_types]
+    result_type, _bog_type = decl.return_type.tuple_elems()
+    cpp_result_type = entry_point_cpp_type(result_type, use_torch=True)
+
+    # std::tuple<torch::Tensor, std::shared_ptr<saved_values>> entry_fwdpass(torch::Tensor arg0, ...)
+    cpp_function = f"std::tuple<{cpp_result_type}, std::shared_ptr<saved_values>> {cpp_function_name}({join_args(', ', lambda i: f'{cpp_arg_types[i]} arg{i}')})"
+
+    cpp_declaration = f"{cpp_function};\n"
+
+    cpp_body = ""
+    for i in range(num_args):
+        cpp_body += f"    auto ks_arg{i} = convert_to_ks_viewing_tensordata<{ks_cpp_type(arg_types[i])}>(arg{i});\n"
+
+    cpp_body += f"""
+    auto ks_ret = ks::{ks_function_name}(alloc {join_args("", lambda i: f", ks_arg{i}")});
+    return std::make_tuple(
+        convert_from_ks<{cpp_result_type}>(ks::get<0>(ks_ret)),
+        save_bog(ks::get<1>(ks_ret)));
+"""
+
+    cpp = f"""
+{cpp_function} {{
+{with_thread_allocator(cpp_body, entry_point_allocator_wrapper(use_torch=True))}
+}}
+"""
+    return cpp_declaration, cpp
+
+
+def generate_cpp_sufrevpass_entry_point(cpp_function_name, decl):
+    """
+    The reverse pass takes the gradient of the result, and the
+    saved_values returned by the forward pass.
+    """
+    arg_types = arg_types_of_decl(decl)
+    assert len(arg_types) == 2
+    dresult_type, bog_type = arg_types
+
+    ks_function_name = utils.encode_name(decl.name.mangled())
+
+    cpp_dresult_type = entry_point_cpp_type(dresult_type, use_torch=True)
+    cpp_return_type = entry_point_cpp_type(decl.return_type, use_torch=True)
+
+    # torch::Tensor entry_revpass(torch::Tensor arg0, std::shared_ptr<saved_values> const& arg1)
+    cpp_function = f"{cpp_return_type} {cpp_function_name}({cpp_dresult_type} arg0, std::shared_ptr<saved_values> const& arg1)"
+
+    cpp_declaration = f"{cpp_function};\n"
+
+    cpp_body = f"""
+    auto ks_arg0 = convert_to_ks_viewing_tensordata<{ks_cpp_type(dresult_type)}>(arg0);
+    auto const& ks_arg1 = bog_from_saved_values<{ks_cpp_type(bog_type)}>(arg1);
+    auto ks_ret = ks::{ks_function_name}(alloc, ks_arg0, ks_arg1);
+    return convert_from_ks<{cpp_return_type}>(ks_ret);
+"""
+
+    cpp = f"""
+{cpp_function} {{
+{with_thread_allocator(cpp_body, entry_point_allocator_wrapper(use_torch=True))}
+}}
+"""
+    return cpp_declaration, cpp
+
+
+def generate_cpp_batch_entry_point(cpp_function_name, decl, use_torch):
+    arg_types = arg_types_of_decl(decl)
+    num_args = len(arg_types)
+
+    def join_args(sep, callable):
+        return sep.join(callable(i) for i in range(num_args))
+
+    ks_function_name = utils.encode_name(decl.name.mangled())
+
+    cpp_arg_types = [entry_point_cpp_type(t, use_torch) for t in arg_types]
+    cpp_return_type = entry_point_cpp_type(decl.return_type, use_torch)
+
+    # std::vector<torch::Tensor> entry_batch(std::vector<std::tuple<torch::Tensor, ..., torch::Tensor>> args)
+    cpp_function = f"std::vector<{cpp_return_type}> {batch_entry_point_name(cpp_function_name)}(std::vector<std::tuple<{', '.join(cpp_arg_types)}>> args)"
+
+    cpp_declaration = f"{cpp_function};\n"
+
+    cpp_body = f"""
+    std::vector<{cpp_return_type}> rets;
+    rets.reserve(args.size());
+
+    KS_MARK(alloc, mark);
+    for (auto const& item : args) {{
+"""
+
+    for i in range(num_args):
+        cpp_body += f"        auto ks_arg{i} = convert_to_ks_viewing_tensordata<{ks_cpp_type(arg_types[i])}>(std::get<{i}>(item));\n"
+
+    cpp_body += f"""
+        auto ks_ret = ks::{ks_function_name}(alloc {join_args("", lambda i: f", ks_arg{i}")});
+        rets.push_back(convert_from_ks<{cpp_return_type}>(ks_ret));
+"""
+    if use_torch:
+        # Unless the return value views the allocator, we have copied it
+        cpp_body += """
+#ifndef KS_VIEW_RESULTS
+        KS_RESET(alloc, mark);
+#endif
+"""
+    else:
+        cpp_body += """
+        // We have copied the return value, can reset allocator
+        KS_RESET(alloc, mark);
+"""
+    cpp_body += """
+    }
+    return rets;
+"""
+    cpp = f"""
+{cpp_function} {{
+{with_thread_allocator(cpp_body, entry_point_allocator_wrapper(use_torch))}
 }}
 """
     return cpp_declaration, cpp
 
 
-def generate_cpp_elementwise_entry_point(cpp_function_name, decl):
+def generate_cpp_mapped_loop(begin, end, loop_body, parallel, grain_size=1):
+    """
+    C++ for a loop over i from BEGIN to END, whose body is the C++
+    returned by LOOP_BODY(alloc), where alloc is the C++ expression for
+    the allocator which the body should use.  The allocator is reset
+    after each iteration, so the body must copy out anything it keeps.
+    The loop is itself inside with_thread_allocator.
+
+    If PARALLEL, the loop is split into chunks of at least GRAIN_SIZE
+    iterations, which are run on the ATen thread pool, each thread using
+    its own allocator.
+    """
+    if not parallel:
+        return f"""
+    KS_MARK(alloc, mark);
+    for (int64_t i = {begin}; i != {end}; ++i) {{
+{loop_body("alloc")}
+        // We have copied the return value, can reset allocator
+        KS_RESET(alloc, mark);
+    }}
+"""
+    # If a thread's allocator overflows, reset it before the exception
+    # leaves the thread, so that it grows before the call is retried.
+    return f"""
+    at::parallel_for({begin}, {end}, {grain_size}, [&](int64_t begin, int64_t end) {{
+        ks::allocator * thread_alloc = thread_allocator();
+        KS_MARK(thread_alloc, mark);
+        try {{
+            for (int64_t i = begin; i != end; ++i) {{
+{loop_body("thread_alloc")}
+                // We have copied the return value, can reset allocator
+                KS_RESET(thread_alloc, mark);
+            }}
+        }} catch (ks::allocator_overflow const&) {{
+            reset_after_overflow(thread_alloc, mark);
+            throw;
+        }}
+    }});
+"""
+
+
+def generate_cpp_elementwise_entry_point(cpp_function_name, decl, parallel=False):
     arg_types = arg_types_of_decl(decl)
     if not all(a == Type.Float for a in arg_types):
         raise ValueError(
@@ -245,27 +496,44 @@ def generate_cpp_elementwise_entry_point(cpp_function_name, decl):
 
     cpp_declaration = f"{cpp_function};\n"
 
-    cpp = f"""
-{cpp_function} {{
-"""
+    cpp_body = ""
 
-    # auto* arg_data0 = arg0.data_ptr<float>();
-    # ...
-    # auto* arg_data7 = arg7.data_ptr<float>();
     for i in range(num_args):
-        cpp += f"""
-    KS_ASSERT(arg{i}.is_contiguous());
-    KS_ASSERT(arg{i}.scalar_type() == scalar_type_of_Float);
-    auto* arg_data{i} = arg{i}.data_ptr<float>();
+        cpp_body += f"""
+    KS_ASSERT(arg{i}.scalar_type() == scalar_type_of_ElementwiseStorage);
 """
-    # ret_data[i] = ks::my_op(&g_alloc, arg_data0[i], arg_data1[i]);
-    cpp += f"""
-    auto ret = torch::empty_like(arg0);
-    auto* ret_data = ret.data_ptr<float>();
-    for (int i = 0, ne = arg0.numel(); i != ne; ++i) {{
-        ret_data[i] = ks::{ks_function_name}(&g_alloc {join_args("", lambda i: f", arg_data{i}[i]")});
+    # ret_data[i] = ks::my_op(alloc, arg_data0[i], arg_data1[i]);
+    #
+    # The loop is in a generic lambda, which is instantiated with
+    # arg_data0 etc. as pointers to the arguments' data if they are all
+    # contiguous, and otherwise as strided_elements, which read them in place.
+    cpp_body += f"""
+    auto ret = torch::empty(arg0.sizes(), arg0.options());
+    auto* ret_data = ret.data_ptr<ElementwiseStorage>();
+
+    auto loop = [&]({join_args(", ", lambda i: f"auto const& arg_data{i}")}) {{
+"""
+    cpp_body += generate_cpp_mapped_loop(
+        "0",
+        "arg0.numel()",
+        lambda alloc: f"""
+        ret_data[i] = ks::{ks_function_name}({alloc} {join_args("", lambda i: f", arg_data{i}[i]")});
+""",
+        parallel,
+        grain_size="at::internal::GRAIN_SIZE",
+    )
+    cpp_body += f"""
+    }};
+    if ({join_args(" && ", lambda i: f"arg{i}.is_contiguous()")}) {{
+        loop({join_args(", ", lambda i: f"arg{i}.data_ptr<ElementwiseStorage>()")});
+    }} else {{
+        loop({join_args(", ", lambda i: f"strided_elements<ElementwiseStorage>(arg{i})")});
     }}
     return ret;
+"""
+    cpp = f"""
+{cpp_function} {{
+{with_thread_allocator(cpp_body, "with_thread_allocator_scratch")}
 }}
 """
     return cpp_declaration, cpp
@@ -278,9 +546,6 @@ def generate_cpp_cuda_entry_point(cpp_function_name, decl):
             "Elementwise operations only available for floating-point element type"
         )
     num_args = len(arg_types)
-    if num_args != 1 and num_args != 2:
-        raise ValueError("CUDA entry points must have 1 or 2 arguments")
-    map_function_name = "map_gpu" if num_args == 1 else "map2_gpu"
 
     def join_args(sep, callable):
         return sep.join(callable(i) for i in range(num_args))
@@ -295,18 +560,81 @@ def generate_cpp_cuda_entry_point(cpp_function_name, decl):
     struct functor_{cpp_function_name}
     {{
         template<typename scalar_t>
-        inline __device__ scalar_t operator()({join_args(', ', lambda i: f'scalar_t arg{i}')}) {{
+        inline KS_FUNCTION scalar_t operator()({join_args(', ', lambda i: f'scalar_t arg{i}')}) {{
             return {ks_function_name}(nullptr, {join_args(', ', lambda i: f'arg{i}')});
         }}
     }};
     {cpp_function} {{
-        return {map_function_name}({join_args(', ', lambda i: f'arg{i}')}, functor_{cpp_function_name}{{}});
+        return map_gpu(functor_{cpp_function_name}{{}}, {join_args(', ', lambda i: f'arg{i}')});
     }}
 """
     return cpp_declaration, cpp
 
 
-def generate_cpp_vmap_entry_point(cpp_function_name, decl):
+def generate_cpp_cuda_vmap_entry_point(cpp_function_name, decl):
+    """
+    One device thread computes each slice along the first dimension.
+    Device code has no allocator, so the function is passed nullptr,
+    and must not allocate (see torch_frontend._check_cuda_entry_def).
+    """
+    in_arg_types = arg_types_of_decl(decl)
+    num_args = len(in_arg_types)
+
+    def join_args(callable, sep=", "):
+        return sep.join(callable(k) for k in range(num_args))
+
+    for t in in_arg_types:
+        if not (t == Type.Float or (t.is_tensor and t.tensor_elem_type == Type.Float)):
+            raise ValueError(
+                f'CUDA vmap entry points take only Floats and tensors of Floats (not "{t}")'
+            )
+    if decl.return_type != Type.Float:
+        # Each thread would need to allocate its result
+        raise ValueError(
+            f'CUDA vmap entry points must return a Float (not "{decl.return_type}")'
+        )
+    ks_slice_types = [ks_cpp_type(t) for t in in_arg_types]
+    ks_types = [
+        f"ks::tensor<{t.tensor_rank + 1 if t.is_tensor else 1}, ks::Float>"
+        for t in in_arg_types
+    ]
+
+    ks_name = utils.encode_name(decl.name.mangled())
+
+    cpp_function = f"torch::Tensor {cpp_function_name}({join_args(lambda k: f'torch::Tensor arg{k}')})"
+
+    cpp_declaration = f"{cpp_function};\n"
+
+    cpp_body = f"""
+        int64_t n = arg0.size(0);
+"""
+    for k in range(num_args):
+        cpp_body += f"""
+        check_input(arg{k});
+        TORCH_CHECK(arg{k}.size(0) == n, "vmap arguments must have the same first dimension");
+"""
+
+    # One thread computes each slice: the functor's arguments view the
+    # slices of the arguments
+    cpp = f"""
+    struct functor_{cpp_function_name}
+    {{
+        inline KS_FUNCTION ks::Float operator()({join_args(lambda k: f'{ks_slice_types[k]} arg{k}')}) {{
+            return {ks_name}(nullptr, {join_args(lambda k: f'arg{k}')});
+        }}
+    }};
+    {cpp_function} {{
+{cpp_body}
+        return vmap_gpu(
+            functor_{cpp_function_name}{{}},
+            arg0.options(),
+            n{join_args(lambda k: f", convert_to_ks_viewing_tensordata<{ks_types[k]}>(arg{k})", "")});
+    }}
+"""
+    return cpp_declaration, cpp
+
+
+def generate_cpp_vmap_entry_point(cpp_function_name, decl, parallel=False):
     def add_vmap_dimension(t: Type):
         if t.is_scalar:
             return Type.Tensor(1, t)
@@ -321,6 +649,10 @@ def generate_cpp_vmap_entry_point(cpp_function_name, decl):
     # Add a "vmap dimension" to each arg
     arg_types = tuple(add_vmap_dimension(a) for a in in_arg_types)
     ks_types = tuple(ks_cpp_type(a) for a in arg_types)
+    ks_strided_types = tuple(
+        f"ks::strided_tensor<{a.tensor_rank}, {ks_cpp_type(a.tensor_elem_type)}>"
+        for a in arg_types
+    )
 
     num_args = len(arg_types)
 
@@ -339,21 +671,22 @@ torch::Tensor {cpp_function_name}({join_args(lambda k: f'torch::Tensor arg{k}')}
 
     cpp_declaration = f"{cpp_function};\n"
 
-    cpp = f"""
-{cpp_function} {{
+    cpp_body = f"""
     int64_t n = arg0.size(0);
 """
 
-    # auto ks_arg0 = convert_to_ks_viewing_tensordata<ks::tensor<2,float>>(arg0)
-    # ...
-    # auto ks_arg7 = convert_to_ks_viewing_tensordata<ks::tensor<1,int>>(arg7)
     for k in range(num_args):
-        cpp += f"""
-    KS_ASSERT(arg{k}.is_contiguous());
+        cpp_body += f"""
     KS_ASSERT(arg{k}.scalar_type() == scalar_type_of_Float);
     KS_ASSERT(arg{k}.size(0) == n);
+"""
 
-    auto ks_arg{k} = convert_to_ks_viewing_tensordata<{ks_types[k]}>(arg{k});
+    # The loop is in a generic lambda, which is instantiated with ks_arg0
+    # etc. as ks::tensors viewing the arguments if they are all contiguous,
+    # and otherwise as ks::strided_tensors; vmap_slice(alloc, ks_arg0, i)
+    # then views slice i if it is contiguous, and otherwise copies it.
+    cpp_body += f"""
+    auto loop = [&]({join_args(lambda k: f"auto const& ks_arg{k}")}) {{
 """
 
     # Difficulty: depending on the rank of ks_ret, ks_ret[i] returns either
@@ -365,32 +698,30 @@ torch::Tensor {cpp_function_name}({join_args(lambda k: f'torch::Tensor arg{k}')}
     ks_return_type = add_vmap_dimension(decl.return_type)
     ks_return_dim = ks_return_type.tensor_rank
     if ks_return_dim == 1:
-        cpp += f"""
+        cpp_body += f"""
     // Create Torch return value
-    auto ret = torch::zeros({{n}});
+    auto ret = torch::zeros({{n}}, torch::dtype(scalar_type_of_Float));
     ks::Float* ret_ptr = ret.data_ptr<ks::Float>();
-
-    KS_MARK(&g_alloc, mark);
-    for (int i = 0; i != n; ++i) {{
-        ret_ptr[i] = ks::{ks_name}(&g_alloc {concat_args(lambda k: f", ks_arg{k}[i]")});
-        // We have copied the return value, can reset allocator
-        KS_RESET(&g_alloc, mark);
-    }}
-
-    return ret;
-}}
 """
+        cpp_body += generate_cpp_mapped_loop(
+            "0",
+            "n",
+            lambda alloc: f"""
+        ret_ptr[i] = ks::{ks_name}({alloc} {concat_args(lambda k: f", vmap_slice({alloc}, ks_arg{k}, i)")});
+""",
+            parallel,
+        )
     else:
         ks_sizes = ", ".join([f"size{d}" for d in range(ks_return_dim - 1)])
-        cpp += f"""
+        cpp_body += f"""
     KS_ASSERT(n > 0); // TODO: Zero-size tensors
 
     // Make the first call to determine output size
-    auto ret0 = ks::{ks_name}(&g_alloc {concat_args(lambda k: f", ks_arg{k}[0]")});
+    auto ret0 = ks::{ks_name}(alloc {concat_args(lambda k: f", vmap_slice(alloc, ks_arg{k}, 0)")});
 
     // Create empty Torch return value
     auto [{ks_sizes}] = ret0.size();
-    auto ret = torch::empty({{n, {ks_sizes}}});
+    auto ret = torch::empty({{n, {ks_sizes}}}, torch::dtype(scalar_type_of_Float));
     
     // And wrap it in ks - this is a view of the torch data
     auto ks_ret = convert_to_ks_viewing_tensordata<ks::tensor<{ks_return_dim}, Float>>(ret);
@@ -400,17 +731,154 @@ torch::Tensor {cpp_function_name}({join_args(lambda k: f'torch::Tensor arg{k}')}
     inplace_copy(&ks_ret0, ret0);
     
     // And then place the rest
-    KS_MARK(&g_alloc, mark);
-    for (int i = 1; i != n; ++i) {{
-        auto val = ks::{ks_name}(&g_alloc {concat_args(lambda k: f", ks_arg{k}[i]")});
+"""
+        cpp_body += generate_cpp_mapped_loop(
+            "1",
+            "n",
+            lambda alloc: f"""
+        auto val = ks::{ks_name}({alloc} {concat_args(lambda k: f", vmap_slice({alloc}, ks_arg{k}, i)")});
         auto ks_ret_view = ks_ret[i];
         inplace_copy(&ks_ret_view, val);
-        // We have copied the return value, can reset allocator
-        KS_RESET(&g_alloc, mark);
-    }}
+""",
+            parallel,
+        )
 
+    cpp_body += f"""
     return ret;
+    }};
+    if ({join_args(lambda k: f"arg{k}.is_contiguous()", " && ")}) {{
+        return loop({join_args(lambda k: f"convert_to_ks_viewing_tensordata<{ks_types[k]}>(arg{k})")});
+    }} else {{
+        return loop({join_args(lambda k: f"convert_to_ks_viewing_tensordata<{ks_strided_types[k]}>(arg{k})")});
+    }}
+"""
+    cpp = f"""
+{cpp_function} {{
+{with_thread_allocator(cpp_body, "with_thread_allocator_scratch")}
 }}
 """
-    print(cpp)
     return cpp_declaration, cpp
+
+
+@dataclass(frozen=True)
+class KscCppUnits:
+    """
+    C++ generated by ksc, split by split_ksc_cpp into translation units
+    which can be compiled in parallel.
+    """
+
+    # The #includes with which ksc starts its output.  Each unit starts
+    # by including them as "ksc-prelude.h", so that they can be precompiled.
+    prelude: str
+    # Replaces the output of ksc alongside the entry points: it declares
+    # the functions which they call, and includes knossos.cpp.
+    main: str
+    units: List[str]
+
+
+_ksc_def_header = re.compile(r"^KS_DEF \S+ ([\w$]+)\(.*\) \{$")
+
+
+def split_ksc_cpp(generated_cpp, root_names, max_units):
+    """
+    Split GENERATED_CPP, the output of ksc, into at most MAX_UNITS
+    translation units.  ROOT_NAMES are the C++ names of the functions
+    which the entry points call.
+
+    Roots which call one another stay in the same unit.  The functions
+    which only they call are defined in their unit with internal linkage,
+    so they can still be inlined, and are duplicated in any other unit
+    which calls them too.
+
+    Returns a KscCppUnits, or None if GENERATED_CPP is not of the form
+    that ksc's cppGen writes, or there is nothing to split.
+    """
+    lines = generated_cpp.split("\n")
+    try:
+        namespace_begin = lines.index("namespace ks {")
+    except ValueError:
+        return None
+    prelude = "\n".join(lines[:namespace_begin]).strip() + "\n"
+
+    # Each definition is a typedef of its return type, then the function,
+    # whose body is indented up to its closing brace
+    defs = {}
+    i = namespace_begin + 1
+    while i < len(lines) and lines[i] != "}":
+        if lines[i] == "":
+            i += 1
+            continue
+        match = i + 1 < len(lines) and _ksc_def_header.match(lines[i + 1])
+        if not (lines[i].startswith("typedef ") and match):
+            return None
+        end = lines.index("}", i + 1)
+        defs[match.group(1)] = lines[i : end + 1]
+        i = end + 1
+    if [line for line in lines[i:] if line] != ["}", '#include "knossos.cpp"']:
+        return None
+
+    roots = list(dict.fromkeys(name for name in root_names if name in defs))
+    if not roots:
+        return None
+
+    def callees(name):
+        return set(re.findall(r"[\w$]+", "\n".join(defs[name][2:]))) & defs.keys()
+
+    def closure(name):
+        seen = {name}
+        todo = [name]
+        while todo:
+            for callee in callees(todo.pop()) - seen:
+                seen.add(callee)
+                todo.append(callee)
+        return seen
+
+    # Group roots which call one another, directly or not
+    closures = {root: closure(root) for root in roots}
+    group_of = {root: {root} for root in roots}
+    for root in roots:
+        for other in closures[root] & closures.keys():
+            if group_of[other] is not group_of[root]:
+                merged = group_of[root] | group_of[other]
+                for member in merged:
+                    group_of[member] = merged
+    groups = []
+    for group_roots in {id(g): g for g in group_of.values()}.values():
+        group_defs = set().union(*(closures[root] for root in group_roots))
+        groups.append({"roots": group_roots, "defs": group_defs})
+
+    def size(names):
+        return sum(len(defs[name]) for name in names)
+
+    # Largest groups first, each into the smallest unit so far
+    num_units = min(max_units, len(groups))
+    units = [{"roots": set(), "defs": set()} for _ in range(num_units)]
+    for group in sorted(groups, key=lambda g: size(g["defs"]), reverse=True):
+        unit = min(units, key=lambda u: size(u["defs"]))
+        unit["roots"] |= group["roots"]
+        unit["defs"] |= group["defs"]
+    # Definitions which no root calls are kept, with external linkage
+    unreachable = defs.keys() - set().union(*(unit["defs"] for unit in units))
+    units[0]["roots"] |= unreachable
+    units[0]["defs"] |= set().union(*(closure(name) for name in unreachable))
+
+    def unit_cpp(unit):
+        cpp = ['#include "ksc-prelude.h"', "", "namespace ks {", ""]
+        for name, def_lines in defs.items():  # in ksc's order, callees first
+            if name in unit["defs"]:
+                typedef, header, *body = def_lines
+                if name not in unit["roots"]:
+                    header = "static " + header
+                cpp += [typedef, header, *body, ""]
+        cpp += ["}", ""]
+        return "\n".join(cpp)
+
+    main = [prelude, "namespace ks {", ""]
+    for name in roots:
+        typedef, header, *_ = defs[name]
+        main += [typedef, header[: -len(" {")] + ";", ""]
+    main += ["}", '#include "knossos.cpp"', ""]
+
+    return KscCppUnits(
+        prelude=prelude, main="\n".join(main), units=[unit_cpp(u) for u in units]
+    )
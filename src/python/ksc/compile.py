@@ -2,14 +2,23 @@ from dataclasses import dataclass
 from typing import List
 
 import atexit
+import functools
+import hashlib
 import os
+import pickle
+import shlex
+import shutil
 import subprocess
 import sysconfig
 import sys
+import threading
 
+from concurrent.futures import ThreadPoolExecutor
 from tempfile import NamedTemporaryFile
+from tempfile import TemporaryDirectory
 from tempfile import gettempdir
 
+import torch
 from torch.utils import cpp_extension
 
 from ksc import cgen, utils
@@ -18,6 +27,48 @@ from ksc.parse_ks import parse_ks_filename
 
 preserve_temporary_files = False
 
+# Outputs of ksc are cached on disk, keyed by a hash of all the inputs to
+# generate_cpp_from_ks and the identity of the ksc binary.
+# Set to False to always run ksc.
+use_ksc_cache = True
+
+# Python modules built by build_py_module_from_cpp are cached in the same
+# directory, keyed by a hash of the C++ source and the compiler flags.
+# Set to False to build into temporary files which are deleted at exit.
+use_py_module_cache = True
+
+# Torch extensions built by build_module_using_pytorch_from_cpp_backend are
+# cached in get_torch_extensions_dir(), in a build directory named by a hash
+# of their sources and flags, and are loaded from there (or from
+# get_shared_torch_extensions_dirs()) by later calls in this or any other
+# process without running ninja.  Set to False to build each extension in
+# a directory named by its torch_extension_name alone.
+use_torch_extension_cache = True
+
+# At most this many bytes of cached torch extensions are kept in
+# get_torch_extensions_dir(): after another is built, the least recently
+# used which are not in use are removed (see prune_torch_extensions_dir).
+# Set to None to keep them all.
+max_torch_extensions_dir_bytes = 4 << 30
+
+# Print the commands run to build torch extensions
+verbose_torch_extension_builds = True
+
+# Torch extensions of non-vectorized functions compile the ksc-generated
+# functions in up to this many translation units, besides those of the
+# entry points, so that they compile in parallel (see cgen.split_ksc_cpp).
+# Set to 0 to compile them with the entry points, in one translation unit.
+max_ksc_translation_units = 4
+
+# Precompile the ksc runtime and prelude headers, which every translation
+# unit of ksc-generated functions includes (see _ksc_prelude_dir)
+use_prelude_pch = True
+
+# CUDA entry points are compiled with nvcc, unless this is set, in which
+# case they are compiled for the host with KS_CUDA defined, and take CPU
+# tensors (see knossos-kernel.cuh).  This tests them on machines without a GPU.
+emulate_cuda = False
+
 
 @dataclass(frozen=True)
 class CFlags:
@@ -53,6 +104,28 @@ default_cflags = CFlags(
     ],
 )
 
+openmp_cflags = CFlags(cl_flags=["/openmp"], gcc_flags=["-fopenmp"])
+
+# Torch entry points built with these flags return tensors of at least
+# KS_VIEW_RESULTS_MIN_BYTES (64KB) which view the Knossos heap, rather than
+# copies (see knossos-entry-points-torch.h).  Each such view keeps the
+# calling thread's whole allocator buffer (its capacity, 16MB or more)
+# alive, and the next call allocates a fresh buffer, so N live results
+# may hold N buffers.
+view_results_cflags = CFlags(
+    cl_flags=["/DKS_VIEW_RESULTS"], gcc_flags=["-DKS_VIEW_RESULTS"]
+)
+
+# For compiling CUDA entry points for the host (see emulate_cuda)
+cuda_emulation_cflags = CFlags(cl_flags=["/DKS_CUDA"], gcc_flags=["-DKS_CUDA"])
+
+
+def define_cflags(name, value):
+    """
+    CFlags defining the preprocessor macro NAME as VALUE.
+    """
+    return CFlags(cl_flags=[f"/D{name}={value}"], gcc_flags=[f"-D{name}={value}"])
+
 
 def subprocess_run(cmd, env=None):
     return (
@@ -60,7 +133,95 @@ def subprocess_run(cmd, env=None):
     )
 
 
+def get_ksc_cache_dir():
+    """
+    Directory holding cached outputs of ksc.
+    Defaults to build/ksc_cache, override with environment variable KSC_CACHE_DIR.
+    """
+    if "KSC_CACHE_DIR" in os.environ:
+        return os.environ["KSC_CACHE_DIR"]
+    return utils.get_ksc_build_dir() + "/ksc_cache"
+
+
+def ksc_cache_key(ks_str, ks_entry_points, preludes, prelude_headers):
+    """
+    Hash of everything which determines the output of generate_cpp_from_ks:
+    the ks source, the contents of the preludes, the headers, the entry points,
+    and the identity (path, size, modification time) of the ksc binary.
+    """
+    ksc_path, ksc_runtime_dir = utils.get_ksc_paths()
+
+    h = hashlib.sha256()
+
+    def add(s):
+        h.update(s.encode("utf-8"))
+        h.update(b"\0")
+
+    ksc_stat = os.stat(ksc_path)
+    add(os.path.realpath(ksc_path))
+    add(f"{ksc_stat.st_size}:{ksc_stat.st_mtime_ns}")
+    for prelude in preludes:
+        add(prelude)
+        with open(f"{ksc_runtime_dir}/{prelude}") as f:
+            add(f.read())
+    add("--cpp-include")
+    for header in prelude_headers:
+        add(header)
+    add("--used")
+    for entry_point in ks_entry_points:
+        add(str(entry_point))
+    add(ks_str)
+    return h.hexdigest()
+
+
+def _read_ksc_cache(key):
+    cache_dir = get_ksc_cache_dir()
+    try:
+        with open(os.path.join(cache_dir, key + ".cpp")) as f:
+            generated_cpp = f.read()
+        with open(os.path.join(cache_dir, key + ".decls.pickle"), "rb") as f:
+            decls = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        return None
+    return generated_cpp, decls
+
+
+def _write_ksc_cache(key, generated_cpp, decls):
+    cache_dir = get_ksc_cache_dir()
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # Write to a temporary file and rename, so concurrent readers never see a partial entry.
+    def write_atomic(filename, mode, write):
+        with NamedTemporaryFile(mode=mode, dir=cache_dir, delete=False) as f:
+            write(f)
+        os.replace(f.name, os.path.join(cache_dir, filename))
+
+    write_atomic(key + ".decls.pickle", "wb", lambda f: pickle.dump(decls, f))
+    write_atomic(key + ".cpp", "w", lambda f: f.write(generated_cpp))
+
+
 def generate_cpp_from_ks(ks_str, ks_entry_points, preludes, prelude_headers):
+    """
+    Run ksc to generate C++ from KS_STR.
+    Returns the generated C++ as a string, and the list of decls written by ksc.
+
+    If use_ksc_cache is set, results are looked up in, and stored to, get_ksc_cache_dir().
+    """
+    if not use_ksc_cache:
+        return _run_ksc(ks_str, ks_entry_points, preludes, prelude_headers)
+
+    key = ksc_cache_key(ks_str, ks_entry_points, preludes, prelude_headers)
+    cached = _read_ksc_cache(key)
+    if cached is not None:
+        print("generate_cpp_from_ks: Using cached", key)
+        return cached
+
+    generated_cpp, decls = _run_ksc(ks_str, ks_entry_points, preludes, prelude_headers)
+    _write_ksc_cache(key, generated_cpp, decls)
+    return generated_cpp, decls
+
+
+def _run_ksc(ks_str, ks_entry_points, preludes, prelude_headers):
     ksc_path, ksc_runtime_dir = utils.get_ksc_paths()
 
     with NamedTemporaryFile(mode="w", suffix=".ks", delete=False) as fks:
@@ -139,65 +300,167 @@ def generate_cpp_from_ks(ks_str, ks_entry_points, preludes, prelude_headers):
     return generated_cpp, decls
 
 
-def build_py_module_from_cpp(cpp_str, profiling=False):
-    """
-    Build python module, independently of pytorch, non-ninja
-    """
-    _ksc_path, ksc_runtime_dir = utils.get_ksc_paths()
+@functools.lru_cache(maxsize=None)
+def _python_includes():
     pybind11_path = utils.get_ksc_dir() + "/extern/pybind11"
+    return subprocess_run(
+        [sys.executable, "-m", "pybind11", "--includes"],
+        env={"PYTHONPATH": pybind11_path},
+    )
 
-    with NamedTemporaryFile(mode="w", suffix=".cpp", delete=False) as fcpp:
-        fcpp.write(cpp_str)
 
+@functools.lru_cache(maxsize=None)
+def _compiler_identity(compiler):
+    return subprocess_run([compiler, "--version"])
+
+
+def _extension_suffix():
     extension_suffix = sysconfig.get_config_var("EXT_SUFFIX")
     if extension_suffix is None:
         extension_suffix = sysconfig.get_config_var("SO")
+    return extension_suffix
 
-    with NamedTemporaryFile(mode="w", suffix=extension_suffix, delete=False) as fpymod:
-        pass
-    module_path = fpymod.name
-    module_name = os.path.basename(module_path).split(".")[0]
-    python_includes = subprocess_run(
-        [sys.executable, "-m", "pybind11", "--includes"],
-        env={"PYTHONPATH": pybind11_path},
+
+def _py_module_cflags(profiling):
+    _ksc_path, ksc_runtime_dir = utils.get_ksc_paths()
+    pybind11_path = utils.get_ksc_dir() + "/extern/pybind11"
+    return (
+        f"-I{ksc_runtime_dir} -I{pybind11_path}/include "
+        + _python_includes()
+        + " -Wall -Wno-unused-variable -Wno-unused-but-set-variable"
+        " -fmax-errors=1"
+        " -std=c++17"
+        " -O3"
+        " -fPIC" + (" -g -pg -O3" if profiling else "") + " -shared"
+    )
+
+
+def _compile_py_module(compiler, cflags, module_name, cpp_path, module_path):
+    cmd = (
+        f"{compiler} {cflags}"
+        f" -DPYTHON_MODULE_NAME={module_name}"
+        f" -o {module_path} {cpp_path}"
     )
     try:
-        cmd = (
-            f"g++ -I{ksc_runtime_dir} -I{pybind11_path}/include "
-            + python_includes
-            + " -Wall -Wno-unused-variable -Wno-unused-but-set-variable"
-            " -fmax-errors=1"
-            " -std=c++17"
-            " -O3"
-            " -fPIC"
-            + (" -g -pg -O3" if profiling else "")
-            + " -shared"
-            + f" -DPYTHON_MODULE_NAME={module_name}"
-            f" -o {module_path} " + fcpp.name
-        )
         print(cmd)
         subprocess.run(cmd, shell=True, capture_output=True, check=True)
     except subprocess.CalledProcessError as e:
-        print(f"cpp_file={fcpp.name}")
+        print(f"cpp_file={cpp_path}")
         print(cmd)
         print(e.output.decode("utf-8"))
         print(e.stderr.decode("utf-8"))
 
         raise
 
-    if not preserve_temporary_files:
 
-        @atexit.register
-        def _():
-            print(
-                "ksc.utils.build_py_module_from_cpp: Deleting", fcpp.name, fpymod.name,
-            )
-            os.unlink(fcpp.name)
-            os.unlink(fpymod.name)
+def _runtime_identity():
+    """
+    Names and content hashes of the files in the ksc runtime directory,
+    so that edits to the runtime headers invalidate cached modules, while
+    other checkouts of the same runtime can share them.
+    """
+    _ksc_path, ksc_runtime_dir = utils.get_ksc_paths()
+    entries = []
+    for filename in sorted(os.listdir(ksc_runtime_dir)):
+        with open(os.path.join(ksc_runtime_dir, filename), "rb") as f:
+            entries.append(f"{filename}:{hashlib.sha256(f.read()).hexdigest()}")
+    return "\n".join(entries)
+
+
+def py_module_cache_key(cpp_str, compiler, cflags):
+    """
+    Hash of everything which determines the module built by build_py_module_from_cpp:
+    the C++ source, the compiler flags, the compiler version, and the runtime headers.
+    """
+    h = hashlib.sha256()
+    for s in (_compiler_identity(compiler), _runtime_identity(), cflags, cpp_str):
+        h.update(s.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def build_py_module_from_cpp(cpp_str, profiling=False):
+    """
+    Build python module, independently of pytorch, non-ninja
+
+    If use_py_module_cache is set, the module is stored in get_ksc_cache_dir(),
+    keyed by the C++ source and compiler flags, and is reused by later calls
+    in this or any other process.
+    """
+    compiler = "g++"
+    cflags = _py_module_cflags(profiling)
+    extension_suffix = _extension_suffix()
+
+    if not use_py_module_cache:
+        with NamedTemporaryFile(mode="w", suffix=".cpp", delete=False) as fcpp:
+            fcpp.write(cpp_str)
+        with NamedTemporaryFile(
+            mode="w", suffix=extension_suffix, delete=False
+        ) as fpymod:
+            pass
+        module_path = fpymod.name
+        module_name = os.path.basename(module_path).split(".")[0]
+
+        _compile_py_module(compiler, cflags, module_name, fcpp.name, module_path)
+
+        if not preserve_temporary_files:
+
+            @atexit.register
+            def _():
+                print(
+                    "ksc.utils.build_py_module_from_cpp: Deleting",
+                    fcpp.name,
+                    fpymod.name,
+                )
+                os.unlink(fcpp.name)
+                os.unlink(fpymod.name)
+
+        return module_name, module_path
+
+    module_name = "ksc_pymod_" + py_module_cache_key(cpp_str, compiler, cflags)
+    cache_dir = get_ksc_cache_dir()
+    module_path = os.path.join(cache_dir, module_name + extension_suffix)
+    if os.path.isfile(module_path):
+        print("build_py_module_from_cpp: Using cached", module_path)
+        return module_name, module_path
+
+    os.makedirs(cache_dir, exist_ok=True)
+    with NamedTemporaryFile(
+        mode="w", suffix=".cpp", dir=cache_dir, delete=False
+    ) as fcpp:
+        fcpp.write(cpp_str)
+    with NamedTemporaryFile(
+        mode="w", suffix=extension_suffix, dir=cache_dir, delete=False
+    ) as fpymod:
+        pass
+
+    _compile_py_module(compiler, cflags, module_name, fcpp.name, fpymod.name)
+
+    # Rename into place, so concurrent builders never load a partially written module.
+    os.replace(fpymod.name, module_path)
+    if not preserve_temporary_files:
+        os.unlink(fcpp.name)
 
     return module_name, module_path
 
 
+def build_py_modules_from_cpp(cpp_strs, profiling=False, max_workers=None):
+    """
+    Build one python module for each string in CPP_STRS, running up to
+    MAX_WORKERS compilers at once (default: one per core).
+    Identical sources are built only once.
+
+    Returns a list of (module_name, module_path), in the order of CPP_STRS.
+    """
+    # Each build runs in its own compiler process, so threads suffice to keep
+    # max_workers compilers busy.
+    unique_cpp_strs = list(dict.fromkeys(cpp_strs))
+    build = functools.partial(build_py_module_from_cpp, profiling=profiling)
+    with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+        built = dict(zip(unique_cpp_strs, executor.map(build, unique_cpp_strs)))
+    return [built[cpp_str] for cpp_str in cpp_strs]
+
+
 derivatives_to_generate_default = ["fwd", "rev"]
 
 
@@ -215,6 +478,35 @@ def generate_cpp_for_py_module_from_ks(
        The second string defines a pybind module which uses the entry points.
        These can either be compiled separately or concatenated into a single source file.
        """
+    _, cpp_definitions, cpp_pybind = generate_cpp_units_for_py_module_from_ks(
+        ks_str,
+        bindings_to_generate,
+        python_module_name,
+        vectorization=vectorization,
+        use_aten=use_aten,
+        use_torch=use_torch,
+        gpu=gpu,
+    )
+    return cpp_definitions, cpp_pybind
+
+
+def generate_cpp_units_for_py_module_from_ks(
+    ks_str,
+    bindings_to_generate,
+    python_module_name,
+    vectorization: VecSpec = VecSpec_None(),
+    use_aten=True,
+    use_torch=False,
+    gpu=False,
+    max_ksc_units=0,
+):
+    """As generate_cpp_for_py_module_from_ks, but if MAX_KSC_UNITS is
+       nonzero, the ksc-generated functions are split by
+       cgen.split_ksc_cpp into up to that many further translation units.
+       Returns a cgen.KscCppUnits, or None if they were not split, and
+       the two strings of generate_cpp_for_py_module_from_ks, of which the
+       first then only declares the ksc-generated functions.
+       """
 
     def mangled_with_type(structured_name):
         if not structured_name.has_type():
@@ -223,9 +515,15 @@ def generate_cpp_for_py_module_from_ks(
             )
         return structured_name.mangled()
 
+    python_names = [python_name for (python_name, _) in bindings_to_generate]
+    python_names += [
+        cgen.batch_entry_point_name(python_name)
+        for python_name in python_names
+        if cgen.has_batch_entry_point(vectorization, python_name)
+    ]
     bindings = [
         (python_name, "ks::entry_points::generated::" + python_name)
-        for (python_name, _) in bindings_to_generate
+        for python_name in python_names
     ]
 
     preludes = ["prelude.ks"] + (["prelude-aten.ks"] if use_aten else [])
@@ -233,6 +531,15 @@ def generate_cpp_for_py_module_from_ks(
     cpp_ks_functions, decls = generate_cpp_from_ks(
         ks_str, [sn for _, sn in bindings_to_generate], preludes, prelude_headers
     )
+    ksc_units = None
+    if max_ksc_units:
+        ksc_units = cgen.split_ksc_cpp(
+            cpp_ks_functions,
+            [utils.encode_name(sn.mangled()) for _, sn in bindings_to_generate],
+            max_ksc_units,
+        )
+    if ksc_units is not None:
+        cpp_ks_functions = ksc_units.main
     (
         cpp_entry_point_declarations,
         cpp_entry_point_definitions,
@@ -248,15 +555,18 @@ def generate_cpp_for_py_module_from_ks(
     )
 
     return (
+        ksc_units,
         cpp_ks_functions + cpp_entry_point_definitions,
         cpp_entry_point_declarations + cpp_pybind_module_declaration,
     )
 
 
 def generate_cpp_pybind_module_declaration(bindings_to_generate, python_module_name):
+    # Entry points release the GIL: each thread has its own allocator,
+    # so they may be called from several Python threads at once.
     def m_def(python_name, cpp_name):
         return f"""
-        m.def("{python_name}", &{cpp_name});
+        m.def("{python_name}", &{cpp_name}, pybind11::call_guard<pybind11::gil_scoped_release>());
         """
 
     return (
@@ -270,6 +580,9 @@ namespace entry_points {
 void reset_allocator();
 size_t allocator_top();
 size_t allocator_peak();
+size_t allocator_capacity();
+void set_allocator_capacity(size_t capacity);
+std::vector<std::tuple<size_t, size_t>> allocator_stats();
 
 }
 }
@@ -280,6 +593,11 @@ PYBIND11_MODULE("""
     m.def("reset_allocator", &ks::entry_points::reset_allocator);
     m.def("allocator_top", &ks::entry_points::allocator_top);
     m.def("allocator_peak", &ks::entry_points::allocator_peak);
+    m.def("allocator_capacity", &ks::entry_points::allocator_capacity);
+    m.def("set_allocator_capacity", &ks::entry_points::set_allocator_capacity);
+    m.def("allocator_stats", &ks::entry_points::allocator_stats);
+    pybind11::class_<ks::entry_points::saved_values, std::shared_ptr<ks::entry_points::saved_values>>(
+        m, "SavedValues", pybind11::module_local());
 """
         + "\n".join(m_def(*t) for t in bindings_to_generate)
         + """
@@ -339,7 +657,10 @@ def build_module_using_pytorch_from_ks(
       str is the Python name given to that function when exposed.
       Each StructuredName must have a type attached
     """
-    cpp_definitions, cpp_pybind = generate_cpp_for_py_module_from_ks(
+    # Vectorized entry points call the ksc-generated function for each
+    # element or slice, so it must be in their translation unit, to be inlined
+    split = isinstance(vectorization, VecSpec_None) and not gpu
+    ksc_units, cpp_definitions, cpp_pybind = generate_cpp_units_for_py_module_from_ks(
         ks_str,
         bindings_to_generate,
         "TORCH_EXTENSION_NAME",
@@ -347,15 +668,20 @@ def build_module_using_pytorch_from_ks(
         use_aten=use_aten,
         use_torch=True,
         gpu=gpu,
+        max_ksc_units=max_ksc_translation_units if split else 0,
     )
 
+    main_filename = "ksc-main.cu" if gpu else "ksc-main.cpp"
+    if gpu and emulate_cuda:
+        main_filename = "ksc-main.cpp"
+        extra_cflags = extra_cflags + cuda_emulation_cflags
+
     return build_module_using_pytorch_from_cpp_backend(
-        [
-            ("ksc-main.cu" if gpu else "ksc-main.cpp", cpp_definitions),
-            ("ksc-pybind.cpp", cpp_pybind),
-        ],
+        [(main_filename, cpp_definitions), ("ksc-pybind.cpp", cpp_pybind)],
         torch_extension_name,
         extra_cflags,
+        openmp=vectorization.parallel and not gpu,
+        ksc_units=ksc_units,
     )
 
 
@@ -373,8 +699,15 @@ def build_module_using_pytorch_from_cpp(
 
 
 def build_module_using_pytorch_from_cpp_backend(
-    cpp_strs, torch_extension_name, extra_cflags
+    cpp_strs, torch_extension_name, extra_cflags, openmp=False, ksc_units=None
 ):
+    """
+    Build and load the torch extension compiled from CPP_STRS, a list of
+    (filename, C++ source), to each of which torch/extension.h is prepended.
+    KSC_UNITS, if given, is a cgen.KscCppUnits whose units are compiled too,
+    without torch, and with their prelude precompiled (see _ksc_prelude_dir).
+    The compiler runs on the translation units in parallel.
+    """
     __ksc_path, ksc_runtime_dir = utils.get_ksc_paths()
 
     # I don't like this assumption about Windows -> cl but it matches what PyTorch is currently doing:
@@ -382,36 +715,401 @@ def build_module_using_pytorch_from_cpp_backend(
     # We're making a guess here if people recognifigure their C++ compiler on Windows it's because they're using non-MSVC
     # otherwise we need to inspect the end of the path path for cl[.exe].
 
+    # Parallel entry points use at::parallel_for, which only runs on
+    # PyTorch's OpenMP thread pool if the extension is built with OpenMP.
+    extra_ldflags = CFlags.Empty()
+    if openmp:
+        extra_cflags = extra_cflags + openmp_cflags
+        extra_ldflags = CFlags.GCCOnly(["-fopenmp"])
+
     cpp_compiler = os.environ.get("CXX")
     if cpp_compiler == None and sys.platform == "win32":
         extra_cflags = extra_cflags.cl_flags
+        extra_ldflags = extra_ldflags.cl_flags
     else:
         extra_cflags = extra_cflags.gcc_flags
-
-    verbose = True
+        extra_ldflags = extra_ldflags.gcc_flags
 
     # https://pytorch.org/docs/stable/cpp_extension.html
-    build_directory = (
-        utils.get_ksc_build_dir() + "/torch_extensions/" + torch_extension_name
+    sources = [
+        (filename, "#include <torch/extension.h>\n" + cpp_str)
+        for filename, cpp_str in cpp_strs
+    ]
+    key_sources = sources
+    if ksc_units is not None:
+        sources = sources + [
+            (f"ksc-functions-{i}.cpp", unit) for i, unit in enumerate(ksc_units.units)
+        ]
+        key_sources = sources + [("ksc-prelude.h", ksc_units.prelude)]
+
+    def build(module_name, build_directory):
+        include_paths = [ksc_runtime_dir]
+        build_cflags = extra_cflags
+        if ksc_units is not None:
+            include_paths.append(
+                _ksc_prelude_dir(
+                    ksc_units.prelude, ksc_runtime_dir, cpp_compiler, extra_cflags
+                )
+            )
+            if use_prelude_pch and _is_gcc(_cpp_compiler_or_default(cpp_compiler)):
+                # Warn in the build output if the precompiled prelude is not
+                # used, rather than silently compiling the header
+                build_cflags = extra_cflags + ["-Winvalid-pch"]
+        return _build_torch_extension(
+            module_name,
+            sources,
+            build_directory,
+            include_paths,
+            build_cflags,
+            extra_ldflags,
+        )
+
+    if not use_torch_extension_cache:
+        return build(
+            torch_extension_name,
+            os.path.join(get_torch_extensions_dir(), torch_extension_name),
+        )
+
+    key = torch_extension_cache_key(
+        key_sources, cpp_compiler, extra_cflags, extra_ldflags
+    )
+    module_name = torch_extension_name + "_" + key[:16]
+    with _build_lock(module_name):
+        for extensions_dir in [
+            get_torch_extensions_dir()
+        ] + get_shared_torch_extensions_dirs():
+            build_directory = os.path.join(extensions_dir, module_name)
+            marker_path = _built_marker_path(build_directory, module_name)
+            if os.path.isfile(marker_path):
+                print(
+                    "build_module_using_pytorch_from_cpp_backend: Using cached",
+                    build_directory,
+                )
+                if extensions_dir == get_torch_extensions_dir():
+                    # Mark as most recently used, for prune_torch_extensions_dir
+                    try:
+                        os.utime(marker_path)
+                    except FileNotFoundError:
+                        # Just pruned by another process
+                        continue
+                _use_torch_extension(module_name)
+                return _import_torch_extension(
+                    module_name, _torch_extension_path(build_directory, module_name)
+                )
+
+        build_directory = os.path.join(get_torch_extensions_dir(), module_name)
+        module = build(module_name, build_directory)
+        # Only now may other processes load the extension without building it
+        with open(_built_marker_path(build_directory, module_name), "w") as f:
+            f.write(key)
+        _use_torch_extension(module_name)
+
+    if max_torch_extensions_dir_bytes is not None:
+        prune_torch_extensions_dir(max_torch_extensions_dir_bytes)
+    return module
+
+
+# The number of uses of each cached torch extension, in this process,
+# which have not been released by release_torch_extension
+_torch_extension_uses = {}
+_torch_extension_uses_lock = threading.Lock()
+
+
+def _use_torch_extension(module_name):
+    with _torch_extension_uses_lock:
+        _torch_extension_uses[module_name] = (
+            _torch_extension_uses.get(module_name, 0) + 1
+        )
+
+
+def _torch_extension_in_use(module_name):
+    with _torch_extension_uses_lock:
+        return module_name in _torch_extension_uses
+
+
+def release_torch_extension(module_name):
+    """
+    Release a use of the torch extension MODULE_NAME, returned by
+    build_module_using_pytorch_from_cpp_backend.  Once all its uses are
+    released, prune_torch_extensions_dir may remove its build directory.
+    """
+    with _torch_extension_uses_lock:
+        uses = _torch_extension_uses.get(module_name, 0) - 1
+        if uses > 0:
+            _torch_extension_uses[module_name] = uses
+        else:
+            _torch_extension_uses.pop(module_name, None)
+
+
+def prune_torch_extensions_dir(max_bytes):
+    """
+    Remove the least recently used cached torch extensions from
+    get_torch_extensions_dir(), until their build directories take at most
+    MAX_BYTES.  Extensions in use by this process are kept.  Other
+    processes may be using the ones removed: the loaded libraries are
+    unaffected, and the extensions are built again if needed.
+    """
+    extensions_dir = get_torch_extensions_dir()
+    try:
+        module_names = os.listdir(extensions_dir)
+    except FileNotFoundError:
+        return
+    extensions = []
+    for module_name in module_names:
+        build_directory = os.path.join(extensions_dir, module_name)
+        try:
+            last_used = os.path.getmtime(
+                _built_marker_path(build_directory, module_name)
+            )
+        except OSError:
+            # Not a cached extension, or still being built
+            continue
+        extensions.append(
+            (last_used, _directory_size(build_directory), module_name, build_directory)
+        )
+
+    total_bytes = sum(size for _, size, _, _ in extensions)
+    for _, size, module_name, build_directory in sorted(extensions):
+        if total_bytes <= max_bytes:
+            break
+        # Not while this process is loading it
+        with _build_lock(module_name):
+            if _torch_extension_in_use(module_name):
+                continue
+            print("prune_torch_extensions_dir: Removing", build_directory)
+            # Remove the marker first, so that other processes stop loading it
+            try:
+                os.unlink(_built_marker_path(build_directory, module_name))
+            except OSError:
+                continue
+            shutil.rmtree(build_directory, ignore_errors=True)
+        total_bytes -= size
+
+
+def _directory_size(path):
+    return sum(
+        os.path.getsize(os.path.join(dirpath, filename))
+        for dirpath, _, filenames in os.walk(path)
+        for filename in filenames
+    )
+
+
+def get_torch_extensions_dir():
+    """
+    Directory holding the build directories of torch extensions.
+    Defaults to build/torch_extensions, override with environment variable
+    KSC_TORCH_EXTENSIONS_DIR.
+    """
+    if "KSC_TORCH_EXTENSIONS_DIR" in os.environ:
+        return os.environ["KSC_TORCH_EXTENSIONS_DIR"]
+    return utils.get_ksc_build_dir() + "/torch_extensions"
+
+
+def get_shared_torch_extensions_dirs():
+    """
+    Directories, in the layout of get_torch_extensions_dir(), which are
+    searched for an already built extension before building it, but are
+    never written to.  This allows a cache populated by one user (or a CI
+    job) to be read by others.  Set with environment variable
+    KSC_SHARED_TORCH_EXTENSIONS_DIRS, a list separated by os.pathsep.
+    """
+    dirs = os.environ.get("KSC_SHARED_TORCH_EXTENSIONS_DIRS", "")
+    return [d for d in dirs.split(os.pathsep) if d]
+
+
+def torch_extension_cache_key(sources, cpp_compiler, extra_cflags, extra_ldflags):
+    """
+    Hash of everything which determines the torch extension built by
+    build_module_using_pytorch_from_cpp_backend: the sources, the flags, the
+    versions of Python, torch and the compiler, and the runtime headers.
+    """
+    h = hashlib.sha256()
+
+    def add(s):
+        h.update(s.encode("utf-8"))
+        h.update(b"\0")
+
+    add(sys.version)
+    add(torch.__version__)
+    add(str(torch.version.cuda))
+    add(_compiler_identity(_cpp_compiler_or_default(cpp_compiler)))
+    add(_runtime_identity())
+    add(repr(extra_cflags))
+    add(repr(extra_ldflags))
+    for filename, source in sources:
+        add(filename)
+        add(source)
+    return h.hexdigest()
+
+
+def _cpp_compiler_or_default(cpp_compiler):
+    # cpp_extension's default compilers, if CXX is not set
+    return cpp_compiler or ("cl" if sys.platform == "win32" else "c++")
+
+
+_build_locks = {}
+_build_locks_lock = threading.Lock()
+
+
+def _build_lock(name):
+    """
+    Held while looking up or building NAME, e.g. a torch extension, so that
+    threads of this process build each once.  Different builds proceed
+    concurrently; cpp_extension.load itself serialises builds of the same
+    extension in different processes.
+    """
+    with _build_locks_lock:
+        return _build_locks.setdefault(name, threading.Lock())
+
+
+def _ksc_prelude_dir(prelude, ksc_runtime_dir, cpp_compiler, cflags):
+    """
+    Directory holding "ksc-prelude.h", with contents PRELUDE, which the
+    units of a cgen.KscCppUnits include.  If use_prelude_pch is set, and the
+    compiler is GCC, it also holds the header precompiled with CFLAGS,
+    "ksc-prelude.h.gch", which GCC reads instead of the header if the unit
+    is compiled with compatible flags.  (Otherwise GCC ignores it, which
+    build_module_using_pytorch_from_cpp_backend reports with -Winvalid-pch.)
+
+    The directory is in get_ksc_cache_dir(), keyed by everything which
+    determines the precompiled header, so it is built once for all modules.
+    """
+    compiler = _cpp_compiler_or_default(cpp_compiler)
+    h = hashlib.sha256()
+    for s in (_compiler_identity(compiler), _runtime_identity(), repr(cflags), prelude):
+        h.update(s.encode("utf-8"))
+        h.update(b"\0")
+    prelude_dir = os.path.join(get_ksc_cache_dir(), "ksc_prelude_" + h.hexdigest())
+    header_path = os.path.join(prelude_dir, "ksc-prelude.h")
+    built_path = os.path.join(prelude_dir, "ksc-prelude.built")
+
+    with _build_lock(prelude_dir):
+        if os.path.isfile(built_path):
+            return prelude_dir
+
+        os.makedirs(prelude_dir, exist_ok=True)
+        utils.write_file_if_different(prelude, header_path, verbose=False)
+        if use_prelude_pch and _is_gcc(compiler):
+            with NamedTemporaryFile(dir=prelude_dir, delete=False) as fgch:
+                pass
+            cmd = [
+                compiler,
+                "-x",
+                "c++-header",
+                f"-I{ksc_runtime_dir}",
+                *_torch_extension_cflags(),
+                *cflags,
+                header_path,
+                "-o",
+                fgch.name,
+            ]
+            print(" ".join(cmd))
+            try:
+                subprocess.run(cmd, capture_output=True, check=True)
+                os.replace(fgch.name, header_path + ".gch")
+            except subprocess.CalledProcessError as e:
+                # The units still compile, from the header
+                print("Failed to precompile ksc-prelude.h")
+                print(e.stderr.decode("utf-8"))
+                os.unlink(fgch.name)
+
+        with open(built_path, "w"):
+            pass
+        return prelude_dir
+
+
+@functools.lru_cache(maxsize=None)
+def _torch_extension_cflags():
+    """
+    The flags, other than include paths and extra_cflags, with which
+    cpp_extension.load compiles each source with GCC.  A precompiled header
+    is only used by units compiled with the same language options and macro
+    definitions, so they are read from the ninja file which cpp_extension
+    writes for a dummy source.  -DTORCH_EXTENSION_NAME is left out, as it
+    differs between modules; it does not affect the prelude, which does not
+    use it.
+    """
+    try:
+        with TemporaryDirectory() as d:
+            ninja_path = os.path.join(d, "build.ninja")
+            cpp_extension._write_ninja_file_to_build_library(
+                path=ninja_path,
+                name="ksc_flags",
+                sources=[os.path.join(d, "dummy.cpp")],
+                extra_cflags=[],
+                extra_cuda_cflags=[],
+                extra_ldflags=[],
+                extra_include_paths=[],
+                with_cuda=False,
+                is_standalone=False,
+            )
+            with open(ninja_path) as f:
+                (line,) = [l for l in f if l.startswith("cflags = ")]
+    except Exception as e:
+        # cpp_extension's private API has changed: mirror what torch 1.9 does
+        print("Failed to read torch extension cflags, using defaults:", e)
+        cflags = ["-DTORCH_API_INCLUDE_EXTENSION_H"]
+        for pname in ["COMPILER_TYPE", "STDLIB", "BUILD_ABI"]:
+            pval = getattr(torch._C, f"_PYBIND11_{pname}", None)
+            if pval is not None:
+                cflags.append(f'-DPYBIND11_{pname}="{pval}"')
+        cflags.append(
+            f"-D_GLIBCXX_USE_CXX11_ABI={int(torch._C._GLIBCXX_USE_CXX11_ABI)}"
+        )
+        cflags += ["-fPIC", "-std=c++14"]
+        return tuple(cflags)
+
+    cflags = []
+    args = iter(shlex.split(line[len("cflags = ") :]))
+    for arg in args:
+        if arg == "-isystem":
+            next(args)
+        elif not arg.startswith(("-I", "-DTORCH_EXTENSION_NAME=")):
+            cflags.append(arg)
+    return tuple(cflags)
+
+
+def _is_gcc(compiler):
+    return sys.platform != "win32" and (
+        "Free Software Foundation" in _compiler_identity(compiler)
     )
+
+
+def _torch_extension_path(build_directory, module_name):
+    # The library which cpp_extension.load builds
+    return os.path.join(
+        build_directory, module_name + (".pyd" if sys.platform == "win32" else ".so")
+    )
+
+
+def _built_marker_path(build_directory, module_name):
+    return os.path.join(build_directory, module_name + ".built")
+
+
+def _import_torch_extension(module_name, module_path):
+    return utils.import_module_from_path(module_name, module_path)
+
+
+def _build_torch_extension(
+    module_name, sources, build_directory, include_paths, extra_cflags, extra_ldflags
+):
     os.makedirs(build_directory, exist_ok=True)
 
     def source_path(filename):
         return os.path.join(build_directory, filename)
 
-    for filename, cpp_str in cpp_strs:
+    for filename, source in sources:
         utils.write_file_if_different(
-            "#include <torch/extension.h>\n" + cpp_str, source_path(filename), verbose
+            source, source_path(filename), verbose_torch_extension_builds
         )
 
-    module = cpp_extension.load(
-        name=torch_extension_name,
-        sources=[source_path(filename) for filename, _ in cpp_strs],
-        extra_include_paths=[ksc_runtime_dir],
+    return cpp_extension.load(
+        name=module_name,
+        sources=[source_path(filename) for filename, _ in sources],
+        extra_include_paths=include_paths,
         extra_cflags=extra_cflags,
         extra_cuda_cflags=extra_cflags + ["-DKS_CUDA"],
+        extra_ldflags=extra_ldflags,
         build_directory=build_directory,
-        verbose=verbose,
+        verbose=verbose_torch_extension_builds,
     )
-
-    return module
@@ -1,3 +1,5 @@
+import functools
+
 from ksc.abstract_value import ExecutionContext
 from ksc.utils import translate_and_import
 
@@ -12,10 +14,20 @@ def shape_from_type(arg_type, assumed_vector_size=100):
         return ()
 
 
+@functools.lru_cache(maxsize=128)
+def translate_and_import_cached(ks_str, backend):
+    """
+    translate_and_import, memoized on (ks_str, backend), keeping the 128
+    most recently used modules.
+    Modules are kept in memory rather than written to disk.
+    """
+    return translate_and_import(__file__, ks_str, backend, in_memory=True)
+
+
 def compute_cost(
     ks_str, def_name, args, exec_context=None, aggregation_option="default"
 ):
-    m = translate_and_import(__file__, ks_str, "abstract")
+    m = translate_and_import_cached(ks_str, "abstract")
     if def_name in m.defs:
         f = m.defs[def_name]
     else:
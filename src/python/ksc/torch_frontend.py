@@ -1,11 +1,18 @@
 from typing import Callable, List, Tuple, Optional, Union, Set, Dict
+from collections import OrderedDict
 from types import ModuleType
-from dataclasses import dataclass, field, replace
+from dataclasses import dataclass, field, replace, asdict
 from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 import functools
+import hashlib
 import itertools
 import inspect
+import json
+import os
+import shutil
+import threading
 import torch
 import torch.onnx
 
@@ -13,10 +20,14 @@ torch.set_default_dtype(torch.float32)
 
 from ksc import utils
 from ksc.parse_ks import parse_ks_filename
+import ksc.compile
 from ksc.compile import (
     build_module_using_pytorch_from_ks,
     build_module_using_pytorch_from_cpp,
     default_cflags,
+    define_cflags,
+    view_results_cflags,
+    CFlags,
     VecSpec,
     VecSpec_None,
     VecSpec_Elementwise,
@@ -40,6 +51,7 @@ from ksc.expr import (
     make_structured_name,
 )
 from ksc.expr import StructuredName
+from ksc.path import subexps_no_binds
 
 from ksc.type_propagate import type_propagate_decls
 
@@ -78,10 +90,10 @@ def type_from_value(x):
 
 
 def from_torch_dtype(t):
-    if t == torch.int64:
+    if t in (torch.int32, torch.int64):
         return Type.Integer
 
-    if t == torch.float32:
+    if t in (torch.float32, torch.float64, torch.float16, torch.bfloat16):
         return Type.Float
 
     raise NotImplementedError
@@ -436,55 +448,116 @@ def torch_from_ks(ks_object):
         return tuple(torch_from_ks(ks) for ks in ks_object)
 
     if isinstance(ks_object, float):
-        return torch.tensor(ks_object)  # TODO: use torch::Scalar?
+        # scalar_tensor avoids the type inference of torch.tensor, which dominates for small kernels
+        return torch.scalar_tensor(ks_object)  # TODO: use torch::Scalar?
 
     assert isinstance(ks_object, torch.Tensor)  # TODO: strings, etc.
 
     return ks_object
 
 
+def torch_stack_from_ks(ks_objects):
+    """
+    Convert a list of results of a Knossos function, as returned by a batch
+    entry point, to torch values stacked along a new first dimension.
+    Tuple results become tuples of stacked values.
+    """
+    first = ks_objects[0]
+    if isinstance(first, tuple):
+        return tuple(
+            torch_stack_from_ks([ks[i] for ks in ks_objects]) for i in range(len(first))
+        )
+
+    if isinstance(first, float):
+        return torch.tensor(ks_objects)
+
+    return torch.stack(ks_objects)
+
+
 def torch_to_ks(val):
     """
     Return a KS-compatible version of val.
-    If val is a scalar, just return it as a float.
+    If val is a scalar, or a 0-d tensor, return it as a Python number.
+    Entry points take ks::Float and ks::Integer arguments by value, on the
+    host, so a CUDA scalar must be copied to the host whichever side
+    converts it.
     If val is a tensor, we may need to
        (a) make it contiguous
        (b) ensure it's not garbage-collected while we're holding a view to it.
+    CPU tensors are passed through as they are: the generated entry points
+    read non-contiguous tensors through their strides, copying them into the
+    Knossos heap only where the compiled function needs contiguous data,
+    and narrow int64 tensors to ks::Integer, checking their range, as they
+    copy them (see knossos-entry-points-torch.h).
+    CUDA tensors are made contiguous, as the CUDA kernels need.
     """
     if isinstance(val, float):
         return val
 
     if isinstance(val, torch.Tensor):
-        assert (
-            val.dtype == torch.float32
-        ), "TODO: https://github.com/microsoft/knossos-ksc/issues/691"
-        if len(val.shape) == 0:
+        if val.dim() == 0:
             return val.item()
 
-        return val.contiguous()  # Get data, or copy if not already contiguous
+        if val.is_cuda:
+            return val.contiguous()  # Returns val itself if it is contiguous
+
+        return val
 
     raise NotImplementedError(val)
 
 
 # Methods for the KscAutogradFunction class -- a new class will be made for each loaded module
 # See https://pytorch.org/docs/stable/notes/extending.html
-def forward_template(py_mod, ctx, *args):
+def forward_template(py_mod, ctx, *args, fused_vjp=False):
     py_mod.reset_allocator()
-    ks_args = (torch_to_ks(x) for x in args)
-
-    # Call it
-    outputs = py_mod.entry(*ks_args)
+    ks_args = tuple(torch_to_ks(x) for x in args)
+
+    # Call it.  If gradients will be wanted, and fused_vjp is set, call the
+    # forward pass of the split derivative instead, which also returns the
+    # intermediate values that the reverse pass needs, so that backward
+    # does not recompute them.
+    if fused_vjp and ctx is not None and any(ctx.needs_input_grad):
+        outputs, ctx.ks_saved_values = py_mod.entry_fwdpass(*ks_args)
+    else:
+        outputs = py_mod.entry(*ks_args)
 
     if ctx is not None:
-        ctx.torch_vals = ks_args
-        ctx.save_for_backward(*args)
+        # Keep the already-converted arguments, so that backward does not convert
+        # (and perhaps copy) them again.  Input tensors passed through unchanged
+        # go through save_for_backward, and are marked None in ks_unsaved_args;
+        # scalars and contiguous copies are stored directly.
+        saved = tuple(
+            isinstance(x, torch.Tensor) and ks_arg is x
+            for x, ks_arg in zip(args, ks_args)
+        )
+        ctx.save_for_backward(*(x for x, s in zip(args, saved) if s))
+        ctx.ks_unsaved_args = tuple(
+            None if s else ks_arg for ks_arg, s in zip(ks_args, saved)
+        )
 
     return torch_from_ks(outputs)
 
 
 def backward_template(py_mod, ctx, *args):
-    ks_args = make_tuple_if_many_args(torch_to_ks(x) for x in ctx.saved_tensors)
     ks_grad_args = make_tuple_if_many_args(torch_to_ks(x) for x in args)
+    saved_values = getattr(ctx, "ks_saved_values", None)
+    if saved_values is not None:
+        # The saved values are held in their own buffer, outside the
+        # allocator, so the reverse pass may start with an empty allocator.
+        py_mod.reset_allocator()
+        outputs = py_mod.entry_revpass(ks_grad_args, saved_values)
+        return torch_from_ks(outputs)
+
+    saved_tensors = iter(ctx.saved_tensors)
+    ks_args = make_tuple_if_many_args(
+        next(saved_tensors) if a is None else a for a in ctx.ks_unsaved_args
+    )
+    if not hasattr(py_mod, "entry_vjp"):
+        # See ksc_string_to_module
+        raise NotImplementedError(
+            f"{py_mod.__name__} has no vjp: CUDA vmap entry points of functions "
+            "taking tensors, or several arguments, are not differentiable"
+        )
     outputs = py_mod.entry_vjp(ks_args, ks_grad_args)
     return torch_from_ks(outputs)
 
@@ -497,16 +570,29 @@ class KscAutogradFunction(torch.autograd.Function):
     pass
 
 
-def make_KscAutogradFunction(py_mod) -> KscAutogradFunction:
+def make_KscAutogradFunction(py_mod, fused_vjp=True) -> KscAutogradFunction:
     # We need to make a new class for every py_mod, as PyTorch requires forward and backward to be
     # staticmethods.  This is not too expensive, as each mod needs to be compiled anyway.
-    forward = lambda ctx, args: forward_template(py_mod, ctx, args)
-    backward = lambda ctx, args: backward_template(py_mod, ctx, args)
+    # Modules with split derivative passes (see ksc_string_to_module) use them
+    # for the backward pass, unless fused_vjp is False.  As forward runs with
+    # gradients disabled, apply passes it whether they were enabled by the caller,
+    # so that inference does not compute values for a backward pass which
+    # cannot happen.
+    fused_vjp = fused_vjp and hasattr(py_mod, "entry_fwdpass")
+
+    def apply(cls, args):
+        return super(cls, cls).apply(args, fused_vjp and torch.is_grad_enabled())
+
+    forward = lambda ctx, args, fused_vjp: forward_template(
+        py_mod, ctx, args, fused_vjp=fused_vjp
+    )
+    backward = lambda ctx, args: (backward_template(py_mod, ctx, args), None)
     return type(
         "KscAutogradFunction_" + py_mod.__name__,
         (KscAutogradFunction,),
         {
             "py_mod": py_mod,
+            "apply": classmethod(apply),
             "forward": staticmethod(forward),
             "backward": staticmethod(backward),
             "adapt": staticmethod(lambda x: torch_to_ks(x)),
@@ -515,7 +601,14 @@ def make_KscAutogradFunction(py_mod) -> KscAutogradFunction:
 
 
 def ksc_defs_to_module(
-    ksc_defs, entry_def, torch_extension_name, vectorization, generate_lm, gpu=False
+    ksc_defs,
+    entry_def,
+    torch_extension_name,
+    vectorization,
+    generate_lm,
+    gpu=False,
+    view_results=False,
+    float_dtype=torch.float32,
 ):
     symtab = dict()
     ksc_dir = utils.get_ksc_dir()
@@ -531,6 +624,10 @@ def ksc_defs_to_module(
         print("")
 
     type_propagate_decls(ksc_defs, symtab)
+    if gpu:
+        _check_cuda_entry_def(
+            entry_def, decls_prelude + decls_prelude_aten + ksc_defs, vectorization,
+        )
     defs_with_derivatives = []
     for ksc_def in ksc_defs:
         defs_with_derivatives += [ksc_def]
@@ -553,7 +650,9 @@ def ksc_defs_to_module(
         torch_extension_name,
         vectorization,
         generate_lm,
-        extra_cflags=default_cflags,
+        extra_cflags=default_cflags
+        + (view_results_cflags if view_results else CFlags.Empty())
+        + _float_dtype_cflags(float_dtype, vectorization),
         gpu=gpu,
     )
 
@@ -568,10 +667,22 @@ def ksc_string_to_module(
     gpu=False,
 ):
     der = "rev" if generate_lm else "sufrev"
-    bindings_to_generate = [
-        ("entry", entry_sn),
-        ("entry_vjp", StructuredName((der, entry_sn))),
-    ]
+    bindings_to_generate = [("entry", entry_sn)]
+    # CUDA vmap entry points must return a Float, which the vjp of a
+    # function taking a tensor, or several arguments, does not
+    if not (
+        gpu
+        and isinstance(vectorization, VecSpec_VMap)
+        and entry_sn.get_type() != Type.Float
+    ):
+        bindings_to_generate += [("entry_vjp", StructuredName((der, entry_sn)))]
+    if not generate_lm and isinstance(vectorization, VecSpec_None) and not gpu:
+        # The split derivative, which backward_template uses in preference to
+        # entry_vjp, as it does not recompute the forward pass
+        bindings_to_generate += [
+            ("entry_fwdpass", StructuredName(("suffwdpass", entry_sn))),
+            ("entry_revpass", StructuredName(("sufrevpass", entry_sn))),
+        ]
     return build_module_using_pytorch_from_ks(
         ks_str,
         bindings_to_generate,
@@ -602,6 +713,8 @@ def ksc_defs_to_autograd_function(
     vectorization=False,
     generate_lm=True,
     gpu=False,
+    view_results=False,
+    float_dtype=torch.float32,
 ) -> KscAutogradFunction:
     mod = ksc_defs_to_module(
         ksc_defs,
@@ -610,6 +723,8 @@ def ksc_defs_to_autograd_function(
         vectorization=vectorization,
         generate_lm=generate_lm,
         gpu=gpu,
+        view_results=view_results,
+        float_dtype=float_dtype,
     )
     return make_KscAutogradFunction(mod)
 
@@ -653,16 +768,17 @@ def _tsmod2ksmod(
     generate_lm=True,
     vectorization: VecSpec = VecSpec_None(),
     gpu=False,
+    view_results=False,
 ) -> KscAutogradFunction:
     assert isinstance(example_inputs, tuple)
 
+    float_dtype = _float_dtype(example_inputs)
+
     # Transform example inputs to match vectorization
     if isinstance(vectorization, VecSpec_VMap):
-        assert len(example_inputs) == 1, "not implemented"
-        example_inputs = (example_inputs[0][0],)
+        example_inputs = tuple(x[0] for x in example_inputs)
     elif isinstance(vectorization, VecSpec_Elementwise):
-        assert len(example_inputs) == 1, "not implemented"
-        example_inputs = (1.1,)
+        example_inputs = tuple(1.1 for _ in example_inputs)
     else:
         assert isinstance(vectorization, VecSpec_None)
 
@@ -677,12 +793,151 @@ def _tsmod2ksmod(
         vectorization=vectorization,
         generate_lm=generate_lm,
         gpu=gpu,
+        view_results=view_results,
+        float_dtype=float_dtype,
+    )
+
+
+def _float_dtype(example_inputs):
+    """
+    The dtype of the floating-point tensors in EXAMPLE_INPUTS, for which
+    the function is compiled, or float32 if there are none.
+    """
+    dtypes = {
+        x.dtype
+        for x in example_inputs
+        if isinstance(x, torch.Tensor) and x.is_floating_point()
+    }
+    if len(dtypes) > 1:
+        raise NotImplementedError(
+            f"Floating-point tensor inputs of different dtypes {dtypes}"
+        )
+    return dtypes.pop() if dtypes else torch.float32
+
+
+# Elementwise entry points read and write tensors of these dtypes, while
+# computing in float (see knossos-entry-points-torch.h)
+_elementwise_storage_types = {
+    torch.float16: "at::Half",
+    torch.bfloat16: "at::BFloat16",
+}
+
+
+def _contains_tensor(t: Type):
+    return t.is_tensor or (t.is_tuple and any(map(_contains_tensor, t.tuple_elems())))
+
+
+def _may_allocate(expr, defs_by_name, visited):
+    """
+    Whether evaluating the type-propagated EXPR may allocate.
+    Calls to the defs in DEFS_BY_NAME are followed into their bodies;
+    other calls are taken to allocate when they return a tensor, or a
+    tuple containing one.  Edefs which allocate, but return a scalar,
+    are not detected.
+    """
+    if isinstance(expr, Call):
+        callee = defs_by_name.get(expr.name)
+        if callee is not None:
+            if expr.name not in visited:
+                visited.add(expr.name)
+                if _may_allocate(callee.body, defs_by_name, visited):
+                    return True
+        else:
+            prim = expr.name.mangle_without_type()
+            # These view their arguments
+            views = prim in ("tuple", "index") or prim.startswith("get$")
+            if not views and _contains_tensor(expr.type_):
+                return True
+    return any(_may_allocate(e, defs_by_name, visited) for e in subexps_no_binds(expr))
+
+
+def _check_cuda_entry_def(entry_def, decls, vectorization):
+    """
+    Raise ValueError if ENTRY_DEF cannot be called from device code,
+    which has no allocator (see cgen.generate_cpp_cuda_entry_point and
+    cgen.generate_cpp_cuda_vmap_entry_point).
+    """
+    if isinstance(vectorization, VecSpec_VMap) and entry_def.return_type != Type.Float:
+        raise ValueError(
+            f"CUDA vmap entry points must return a Float (not {entry_def.return_type})"
+        )
+    defs_by_name = {decl.name: decl for decl in decls if isinstance(decl, Def)}
+    if _may_allocate(entry_def.body, defs_by_name, {entry_def.name}):
+        raise ValueError(
+            f"CUDA entry points cannot allocate, as {entry_def.name} may (e.g. by calling build)"
+        )
+
+
+def _float_dtype_cflags(float_dtype, vectorization):
+    """
+    CFlags to compile a module taking floating-point tensors of FLOAT_DTYPE,
+    for the CPU or, as knossos-kernel.cuh uses the same definitions, CUDA.
+    """
+    if float_dtype == torch.float32:
+        return CFlags.Empty()
+    if float_dtype == torch.float64:
+        return define_cflags("KS_FLOAT_TYPE", "double")
+    if float_dtype in _elementwise_storage_types and isinstance(
+        vectorization, VecSpec_Elementwise
+    ):
+        return define_cflags(
+            "KS_ELEMENTWISE_STORAGE", _elementwise_storage_types[float_dtype]
+        )
+    raise NotImplementedError(
+        f"Entry points for {float_dtype} tensors (only elementwise ones support half precision)"
     )
 
 
+def _to_tuples(x):
+    # JSON round-trips tuples as lists; convert back so configurations are hashable
+    if isinstance(x, list):
+        return tuple(_to_tuples(e) for e in x)
+    return x
+
+
 @dataclass(frozen=True)
 class CompileConfiguration:
+    """
+    The properties of a call's inputs for which a KscStub compiles a separate
+    specialization.
+
+    * gpu: whether the tensor inputs are on a CUDA device
+
+    * signature: one entry per input, as made by _arg_signature:
+      ("Tensor", dtype, rank) for tensors, and (type name,) for other values.
+    """
+
     gpu: bool = False
+    signature: Optional[Tuple] = None
+
+    def str(self):
+        """
+        A short string, suitable as part of an extension name, which is
+        unique to this configuration.
+        """
+        return hashlib.sha256(repr(self.signature).encode("utf-8")).hexdigest()[:12]
+
+    @staticmethod
+    def from_json(d):
+        return CompileConfiguration(gpu=d["gpu"], signature=_to_tuples(d["signature"]))
+
+
+def _arg_signature(x):
+    if isinstance(x, torch.Tensor):
+        return ("Tensor", str(x.dtype), x.dim())
+    return (type(x).__name__,)
+
+
+def _compile_configuration(example_inputs):
+    return CompileConfiguration(
+        gpu=_input_is_gpu(example_inputs),
+        signature=tuple(_arg_signature(x) for x in example_inputs),
+    )
+
+
+def _vjp_primal_args(x):
+    # The primal argument to a vjp is a tuple when the function takes several arguments
+    return x if isinstance(x, tuple) else (x,)
 
 
 class Lambda(torch.nn.Module):
@@ -702,12 +957,40 @@ class Lambda(torch.nn.Module):
 
 @dataclass
 class KscStub:
+    """
+    A function registered with Knossos, and its compiled specializations.
+
+    A separate specialization is compiled for each CompileConfiguration,
+    that is for each combination of device, and of dtype and rank of the
+    inputs.
+    Specializations for float64 inputs compute in double precision;
+    elementwise ones for float16 or bfloat16 inputs read and write those,
+    computing in float.
+    At most max_compiled specializations are kept: when another is compiled,
+    the least recently used one is evicted, and its build directory removed
+    (or, if ksc.compile.use_torch_extension_cache is set, released, so that
+    it is removed once the cache exceeds
+    ksc.compile.max_torch_extensions_dir_bytes).
+    The stub may be called from several threads at once.
+    """
+
     raw_f: Callable
     module: ModuleType
     generate_lm: bool
     vectorization: VecSpec
-    compiled: Dict[CompileConfiguration, KscAutogradFunction] = field(
-        default_factory=dict
+    compiled: "OrderedDict[CompileConfiguration, KscAutogradFunction]" = field(
+        default_factory=OrderedDict
+    )
+    max_compiled: int = 16
+    view_results: bool = False
+    # Guards self.compiled and self._compile_locks
+    _lock: threading.Lock = field(
+        default_factory=threading.Lock, init=False, repr=False, compare=False
+    )
+    # One lock per configuration, held while compiling it, so that each
+    # configuration is compiled only once, but different ones in parallel
+    _compile_locks: Dict[CompileConfiguration, threading.Lock] = field(
+        default_factory=dict, init=False, repr=False, compare=False
     )
 
     def __call__(self, *args):
@@ -748,9 +1031,8 @@ class KscStub:
         Does not wrap torch tensors, or reset memory allocator.
         For test use only
         """
-        configuration = CompileConfiguration(gpu=_input_is_gpu(args))
-        assert configuration in self.compiled  # TODO: infer call args from vjp args
-        return self.compiled[configuration].py_mod.entry_vjp(*args)
+        x, _df = args
+        return self.ensure_compiled(_vjp_primal_args(x)).py_mod.entry_vjp(*args)
 
     def vjp(self, x, df):
         """
@@ -759,7 +1041,7 @@ class KscStub:
            vjp(x,df) = J(x)^T * df
         ```
         """
-        f = self.ensure_compiled(x)
+        f = self.ensure_compiled(_vjp_primal_args(x))
         x_ks = torch_to_ks(x)
         df_ks = torch_to_ks(df)
         f.py_mod.reset_allocator()
@@ -768,10 +1050,46 @@ class KscStub:
         f.py_mod.reset_allocator()
         return out
 
+    def call_batch(self, arg_tuples):
+        """
+        Call the compiled function on each tuple of arguments in ARG_TUPLES,
+        in a single call into the compiled module, which reuses the
+        allocator arena between items.  All the tuples must have the same
+        signature (see CompileConfiguration).
+        Returns the results stacked along a new first dimension.
+        Does not record gradients.
+        """
+        arg_tuples = list(arg_tuples)
+        if not arg_tuples:
+            raise ValueError("call_batch needs at least one tuple of arguments")
+        py_mod = self.ensure_compiled(arg_tuples[0]).py_mod
+        ks_arg_tuples = [tuple(torch_to_ks(x) for x in args) for args in arg_tuples]
+
+        py_mod.reset_allocator()
+        entry_batch = getattr(py_mod, "entry_batch", None)
+        if entry_batch is not None:
+            outs = entry_batch(ks_arg_tuples)
+        else:
+            # Modules built from C++ strings have no batch entry point
+            outs = [py_mod.entry(*ks_args) for ks_args in ks_arg_tuples]
+        py_mod.reset_allocator()
+
+        return torch_stack_from_ks(outs)
+
+    def call_stacked(self, *stacked_args):
+        """
+        As call_batch, but with each argument given as a single tensor,
+        stacked along the first dimension.
+        ```
+           f.call_stacked(xs, ys) == torch.stack([f(x, y) for x, y in zip(xs, ys)])
+        ```
+        """
+        return self.call_batch(zip(*(torch.unbind(arg) for arg in stacked_args)))
+
     def compile(
         self, example_inputs, torch_extension_name, configuration=CompileConfiguration()
     ) -> KscAutogradFunction:
-        self.compiled[configuration] = _tsmod2ksmod(
+        compiled = _tsmod2ksmod(
             self.module,
             self.raw_f,
             torch_extension_name=torch_extension_name,
@@ -779,15 +1097,56 @@ class KscStub:
             generate_lm=self.generate_lm,
             vectorization=self.vectorization,
             gpu=configuration.gpu,
+            view_results=self.view_results,
         )
+        self._add_compiled(configuration, compiled)
+        return compiled
+
+    def _add_compiled(self, configuration, compiled):
+        # self.compiled is kept in least-recently-used first order
+        evicted = []
+        with self._lock:
+            self.compiled[configuration] = compiled
+            self.compiled.move_to_end(configuration)
+            while len(self.compiled) > self.max_compiled:
+                evicted.append(self.compiled.popitem(last=False)[1])
+        for e in evicted:
+            print(f"knossos.register: Evicting {e.py_mod.__name__}")
+            _remove_torch_extension_build_directory(e.py_mod)
+
+    def _lookup_compiled(self, configuration) -> Optional[KscAutogradFunction]:
+        with self._lock:
+            compiled = self.compiled.get(configuration)
+            if compiled is not None:
+                # Mark as most recently used
+                self.compiled.move_to_end(configuration)
+            return compiled
 
-        return self.compiled[configuration]
+    def compiled_items(self):
+        """
+        The (configuration, compiled function) pairs currently kept,
+        least recently used first.
+        """
+        with self._lock:
+            return list(self.compiled.items())
 
     def ensure_compiled(self, example_inputs) -> KscAutogradFunction:
-        configuration = CompileConfiguration(gpu=_input_is_gpu(example_inputs))
-        compiled = self.compiled.get(configuration)
+        configuration = _compile_configuration(example_inputs)
+        compiled = self._lookup_compiled(configuration)
         if compiled is not None:
             return compiled
+        with self._lock:
+            compile_lock = self._compile_locks.setdefault(
+                configuration, threading.Lock()
+            )
+        with compile_lock:
+            # Another thread may have compiled it while we waited
+            compiled = self._lookup_compiled(configuration)
+            if compiled is not None:
+                return compiled
+            return self._compile_new(example_inputs, configuration)
+
+    def _compile_new(self, example_inputs, configuration):
         print(f"knossos.register: Compiling {self.raw_f.__name__}")
         torch_extension_name = (
             "KscStub_"
@@ -795,14 +1154,137 @@ class KscStub:
             + self.vectorization.str()
             + "_"
             + ("lm_" if self.generate_lm else "")
+            + ("views_" if self.view_results else "")
             + self.module.__name__
             + "_"
             + self.raw_f.__name__
         )
         if self.generate_lm:
             torch_extension_name += "__generate_lm"
+        torch_extension_name += "_" + configuration.str()
         return self.compile(example_inputs, torch_extension_name, configuration)
 
+    def manifest_key(self):
+        """
+        Identifies this stub in a compilation manifest.
+        """
+        return (
+            self.module.__name__
+            + "."
+            + self.raw_f.__name__
+            + ":"
+            + ("lm_" if self.generate_lm else "")
+            + ("views_" if self.view_results else "")
+            + self.vectorization.str()
+        )
+
+    def source_hash(self):
+        """
+        Hash of the source of the defining module, so that manifest entries
+        compiled from an older version of the function, or of the functions
+        it calls, are not loaded.
+        """
+        try:
+            source = inspect.getsource(self.module)
+        except (OSError, TypeError):
+            # e.g. __main__ in an interactive session
+            source = inspect.getsource(self.raw_f)
+        return hashlib.sha256(source.encode("utf-8")).hexdigest()
+
+
+def precompile(stubs_and_example_inputs, max_workers=None):
+    """
+    Compile ahead of time, in parallel, a configuration for each
+    (stub, example_inputs) pair in STUBS_AND_EXAMPLE_INPUTS,
+    so that the first call to each stub does not pay the compilation cost.
+    ```
+       knossos.precompile([(relu3, (x,)), (vrelu3, (x,)), (vrelu3, (x.cuda(),))])
+    ```
+    Returns the list of KscAutogradFunctions, in the same order.
+    Pairs with the same stub and CompileConfiguration are compiled once.
+    """
+    keys = []
+    unique = {}
+    for stub, example_inputs in stubs_and_example_inputs:
+        key = (id(stub), _compile_configuration(example_inputs))
+        keys.append(key)
+        unique.setdefault(key, (stub, example_inputs))
+    # The expensive steps (ksc, and the compiler invoked via ninja)
+    # run in subprocesses, so threads are enough to overlap them.
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            key: executor.submit(stub.ensure_compiled, example_inputs)
+            for key, (stub, example_inputs) in unique.items()
+        }
+        return [futures[key].result() for key in keys]
+
+
+def save_manifest(filename, stubs):
+    """
+    Write a JSON manifest of the compiled configurations of STUBS to FILENAME.
+    A fresh process can pass the manifest to load_manifest to use the
+    compiled extensions without translating or building them again.
+    """
+    entries = [
+        {
+            "key": stub.manifest_key(),
+            "source_hash": stub.source_hash(),
+            "configuration": asdict(configuration),
+            "module_name": compiled.py_mod.__name__,
+            "module_path": compiled.py_mod.__file__,
+        }
+        for stub in stubs
+        for configuration, compiled in stub.compiled_items()
+    ]
+    with open(filename, "w") as f:
+        json.dump({"version": 1, "entries": entries}, f, indent=2)
+
+
+def load_manifest(filename, stubs):
+    """
+    Load into STUBS the compiled extensions listed in the manifest FILENAME,
+    written by save_manifest.
+    Entries whose stub is not in STUBS, whose source has changed, or whose
+    extension is missing are skipped, and will be compiled on first use as usual.
+
+    Returns the number of configurations loaded.
+    """
+    with open(filename) as f:
+        manifest = json.load(f)
+
+    stubs_by_key = {stub.manifest_key(): stub for stub in stubs}
+    loaded = 0
+    for entry in manifest["entries"]:
+        stub = stubs_by_key.get(entry["key"])
+        if stub is None:
+            continue
+        if entry["source_hash"] != stub.source_hash():
+            print(f"knossos.load_manifest: Source changed, skipping {entry['key']}")
+            continue
+        if not os.path.isfile(entry["module_path"]):
+            print(f"knossos.load_manifest: Missing {entry['module_path']}")
+            continue
+        configuration = CompileConfiguration.from_json(entry["configuration"])
+        py_mod = utils.import_module_from_path(
+            entry["module_name"], entry["module_path"]
+        )
+        stub._add_compiled(configuration, make_KscAutogradFunction(py_mod))
+        loaded += 1
+    return loaded
+
+
+def _remove_torch_extension_build_directory(py_mod):
+    # Cached extensions may be loaded by other stubs and processes, so are
+    # only released, and removed by ksc.compile.prune_torch_extensions_dir
+    if ksc.compile.use_torch_extension_cache:
+        ksc.compile.release_torch_extension(py_mod.__name__)
+        return
+    build_directory = os.path.dirname(os.path.abspath(py_mod.__file__))
+    torch_extensions_dir = os.path.abspath(ksc.compile.get_torch_extensions_dir())
+    # Only remove directories made by build_module_using_pytorch_from_cpp_backend
+    if os.path.dirname(build_directory) == torch_extensions_dir:
+        shutil.rmtree(build_directory, ignore_errors=True)
+
 
 def _input_is_gpu(example_inputs):
     tensors = (x for x in example_inputs if isinstance(x, torch.Tensor))
@@ -815,24 +1297,33 @@ def _input_is_gpu(example_inputs):
     return gpu
 
 
-def _Vectorization_from_flags(elementwise, vmap):
+def _Vectorization_from_flags(elementwise, vmap, parallel=False):
     assert not (elementwise and vmap)
+    assert not parallel or elementwise or vmap
     if elementwise:
-        return VecSpec_Elementwise()
+        return VecSpec_Elementwise(parallel=parallel)
     if vmap:
-        return VecSpec_VMap()
+        return VecSpec_VMap(parallel=parallel)
     return VecSpec_None()
 
 
 def _register_core(
-    f: Callable, module: ModuleType, generate_lm=False, vectorization=VecSpec_None()
+    f: Callable,
+    module: ModuleType,
+    generate_lm=False,
+    vectorization=VecSpec_None(),
+    view_results=False,
 ) -> KscStub:
 
     if isinstance(f, KscStub):
         # TODO: this should just add to the list of configurations required of the function
         # Copy the existing KscStub, setting new flags, and force recompilation
         return replace(
-            f, generate_lm=generate_lm, vectorization=vectorization, compiled=dict(),
+            f,
+            generate_lm=generate_lm,
+            vectorization=vectorization,
+            view_results=view_results,
+            compiled=OrderedDict(),
         )
     else:
         # Create a ksc stub
@@ -841,20 +1332,32 @@ def _register_core(
             module=module,
             generate_lm=generate_lm,
             vectorization=vectorization,
-            compiled=dict(),
+            view_results=view_results,
+            compiled=OrderedDict(),
         )
 
 
 # TODO: In Python 3.9, optional-argument decorators will be much simpler.
 # https://docs.python.org/3.9/reference/compound_stmts.html#function
-def register_direct(func: Callable, generate_lm=False, elementwise=False, vmap=False):
+def register_direct(
+    func: Callable,
+    generate_lm=False,
+    elementwise=False,
+    vmap=False,
+    parallel=False,
+    view_results=False,
+):
     frame = inspect.currentframe()
     assert frame
     module = inspect.getmodule(frame.f_back)
     assert module
-    vectorization = _Vectorization_from_flags(elementwise, vmap)
+    vectorization = _Vectorization_from_flags(elementwise, vmap, parallel)
     return _register_core(
-        func, module, generate_lm=generate_lm, vectorization=vectorization,
+        func,
+        module,
+        generate_lm=generate_lm,
+        vectorization=vectorization,
+        view_results=view_results,
     )
 
 
@@ -877,7 +1380,9 @@ def optional_arg_decorator(register):
 
 
 @optional_arg_decorator
-def register(func: Callable, module: ModuleType, generate_lm=False) -> KscStub:
+def register(
+    func: Callable, module: ModuleType, generate_lm=False, view_results=False
+) -> KscStub:
     """
     Main Knossos entry point.
 
@@ -894,14 +1399,28 @@ def register(func: Callable, module: ModuleType, generate_lm=False) -> KscStub:
         y = foo(x)        # Fast (C++/CUDA/...) computation of f(x)
         vjp(foo, x, dy)   # Fast computation of dot(dy, [df_i/dx_j])
     ```
+    With `view_results=True`, tensors of 64KB or more returned by `foo`
+    view the Knossos heap rather than being copied out of it.  This saves
+    a copy of each such result, at a memory cost: while a view is alive,
+    it keeps the whole allocator buffer it points into (16MB or more, see
+    set_allocator_capacity) from being reused or freed, so each live
+    result may hold on to a buffer of its own.
+
     The implementation delays compilation until the first call, or 
     when "foo.compile()" is explicitly called.
     """
-    return _register_core(func, module, generate_lm=generate_lm,)
+    return _register_core(
+        func, module, generate_lm=generate_lm, view_results=view_results
+    )
 
 
 @optional_arg_decorator
-def vmap(func: Union[Callable, KscStub], module: ModuleType, generate_lm=False):
+def vmap(
+    func: Union[Callable, KscStub],
+    module: ModuleType,
+    generate_lm=False,
+    parallel=False,
+):
     """
     Knossos entry point for vmap.
     ```
@@ -915,11 +1434,17 @@ def vmap(func: Union[Callable, KscStub], module: ModuleType, generate_lm=False):
     e.g. transform (Tensor [2], Tensor [N], float) -> (float, Tensor [M])
                 to (Tensor [3], Tensor [1+N], Tensor [1]) -> (Tensor [1], Tensor [1+M])
     ```
+    With `parallel=True`, the calls to `foo` for each row are spread over
+    the ATen intra-op thread pool, whose size is set by torch.set_num_threads.
+
     The implementation delays compilation until the first call, or
     when "f.compile()" is explicitly called.
     """
     return _register_core(
-        func, module, generate_lm=generate_lm, vectorization=VecSpec_VMap(),
+        func,
+        module,
+        generate_lm=generate_lm,
+        vectorization=VecSpec_VMap(parallel=parallel),
     )
 
 
@@ -929,6 +1454,7 @@ def elementwise(
     module: ModuleType,
     generate_lm=False,
     example_element=1.23,
+    parallel=False,
 ):
     """
     Knossos entry point for elementwise.
@@ -949,6 +1475,9 @@ def elementwise(
     Transforms `foo` to take tensors of shape (PxQx...xMxN), mapping over the last two
     dimensions.  In this case, the precise sizes of the tensor are not used
 
+    With `parallel=True`, the elements are computed on the ATen intra-op
+    thread pool, whose size is set by torch.set_num_threads.
+
     The implementation delays compilation until the first call, or
     when "f.compile()" is explicitly called.
     """
@@ -956,5 +1485,5 @@ def elementwise(
         func,
         module,
         generate_lm=generate_lm,
-        vectorization=VecSpec_Elementwise(example_element),
+        vectorization=VecSpec_Elementwise(example_element, parallel=parallel),
     )
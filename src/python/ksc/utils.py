@@ -1,7 +1,10 @@
 import itertools
 
+import hashlib
+import importlib.abc
 import importlib.util
 import os
+import types
 from tempfile import NamedTemporaryFile
 from contextlib import contextmanager
 
@@ -87,12 +90,58 @@ def import_module_from_path(module_name, path):
     return py_out
 
 
-def translate_and_import(source_file_name, *args):
+class _SourceLoader(importlib.abc.InspectLoader):
+    """
+    Loader for a module imported from a string, so that linecache can
+    fetch the source on demand, while it is only kept alive by the module.
+    """
+
+    def __init__(self, source):
+        self.source = source
+
+    def get_source(self, fullname):
+        return self.source
+
+
+def import_module_from_source(module_name, source, filename):
+    """
+    Import python SOURCE as a module, without writing it to disk.
+    Tracebacks through the module still show its lines: linecache fetches
+    them from the module's __loader__ when needed.  FILENAME is followed
+    by a hash of SOURCE, so that different sources given the same FILENAME
+    are not confused.
+    """
+    source_hash = hashlib.sha256(source.encode("utf-8")).hexdigest()[:12]
+    filename = f"{filename}#{source_hash}"
+    py_out = types.ModuleType(module_name)
+    py_out.__file__ = filename
+    py_out.__loader__ = _SourceLoader(source)
+    exec(compile(source, filename, "exec"), py_out.__dict__)
+    return py_out
+
+
+def translate_and_import(source_file_name, *args, in_memory=False):
+    """
+    Translate ks source to python, and import the result.
+    The arguments after SOURCE_FILE_NAME are passed to ksc.translate.translate.
+
+    If IN_MEMORY, the module is imported directly from the translated source,
+    otherwise it is written to a temporary file which is kept for inspection.
+    """
     from ksc.translate import translate
 
     py_out = translate(*args, source_file_name, with_main=False)
+    header = f"# AUTOGEN from {source_file_name} via ksc.utils.translate_and_import"
+
+    if in_memory:
+        return import_module_from_source(
+            PYTHON_MODULE_NAME,
+            header + py_out,
+            f"<ksc.utils.translate_and_import from {source_file_name}>",
+        )
+
     with NamedTemporaryFile(mode="w", suffix=".py", delete=False) as f:
-        f.write(f"# AUTOGEN from {source_file_name} via ksc.utils.translate_and_import")
+        f.write(header)
         f.write(py_out)
 
     print(f.name)
@@ -217,6 +266,10 @@ def write_file_if_different(to_write, filename, verbose):
         if verbose:
             print(f"ksc.utils: New file {filename}")
 
-    # And overwrite if different
-    with open(filename, "w") as f:
+    # And overwrite if different.  Write to a temporary file and rename, so
+    # that a process building from the file never reads it half-written.
+    with NamedTemporaryFile(
+        mode="w", dir=os.path.dirname(filename) or ".", delete=False
+    ) as f:
         f.write(to_write)
+    os.replace(f.name, filename)
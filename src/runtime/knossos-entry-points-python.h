@@ -9,7 +9,7 @@ template<typename KsElementType, typename EntryPointElementType>
 struct Converter<ks::tensor<1, KsElementType>, std::vector<EntryPointElementType>>
 {
   static ks::tensor<1, KsElementType> to_ks(std::vector<EntryPointElementType> const& arg) {
-    auto ks_arg = ks::tensor<1, KsElementType>::create(&g_alloc, arg.size());
+    auto ks_arg = ks::tensor<1, KsElementType>::create(thread_allocator(), arg.size());
     for (int i = 0; i != ks_arg.size(); ++i) {
       ks_arg[i] = convert_to_ks_viewing_tensordata<KsElementType>(arg[i]);
     }
@@ -46,9 +46,11 @@ struct PurePythonEntryPointType<ks::tensor<1, KsElementType>>
 template<typename RetType, typename... ParamTypes>
 auto python_entry_point(RetType(*f)(ks::allocator*, ParamTypes...)) {
   return [f](typename PurePythonEntryPointType<ParamTypes>::type ...params) {
-    return convert_from_ks<typename PurePythonEntryPointType<RetType>::type>(
-      f(&g_alloc, convert_to_ks_viewing_tensordata<ParamTypes>(params)...)
-    );
+    return with_thread_allocator([&](ks::allocator * alloc) {
+      return convert_from_ks<typename PurePythonEntryPointType<RetType>::type>(
+        f(alloc, convert_to_ks_viewing_tensordata<ParamTypes>(params)...)
+      );
+    });
   };
 }
 
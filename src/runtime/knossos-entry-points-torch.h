@@ -4,63 +4,236 @@
 
 #include <torch/extension.h>
 
+#include <array>
+#include <limits>
+#include <stdexcept>
+#include <string>
+#include <type_traits>
+
 namespace ks {
 namespace entry_points {
 
-constexpr at::ScalarType scalar_type_of_Float = c10::CppTypeToScalarType<Float>::value;
+template<typename T>
+constexpr at::ScalarType scalar_type_of = c10::CppTypeToScalarType<T>::value;
+
+// Float is float unless the module is compiled with KS_FLOAT_TYPE,
+// e.g. -DKS_FLOAT_TYPE=double.  Tensors of Integers are int32 tensors,
+// but entry points also take int64 ones (see ks_integer_tensor_from_int64).
+constexpr at::ScalarType scalar_type_of_Float = scalar_type_of<Float>;
+
+// The element type of tensors passed to elementwise entry points, which
+// convert each element to and from Float.  This is Float unless the
+// module is compiled with KS_ELEMENTWISE_STORAGE, e.g. as at::Half, so
+// that elementwise functions read and write half precision tensors,
+// while still computing in Float.
+#ifdef KS_ELEMENTWISE_STORAGE
+typedef KS_ELEMENTWISE_STORAGE ElementwiseStorage;
+#else
+typedef Float ElementwiseStorage;
+#endif
+constexpr at::ScalarType scalar_type_of_ElementwiseStorage = scalar_type_of<ElementwiseStorage>;
+
+// The intermediate values ("BOG") which the forward pass of a split
+// derivative returns for its reverse pass.  They are copied out of the
+// calling thread's allocator into a buffer of their own, sized to fit
+// them, so that the thread's allocator can be reset after the forward
+// pass, and saved values hold on to no more memory than they use.
+template<typename Bog>
+struct saved_bog : saved_values
+{
+#ifdef KS_ALLOCATOR
+  ks::allocator alloc;
+  Bog bog;
+
+  explicit saved_bog(Bog const& bog) :
+    alloc(ks::inflated_bytes(bog) + 1),  // allocations must end strictly before capacity
+    bog(ks::inflated_deep_copy(&alloc, bog))
+  { }
+#else
+  Bog bog;
+
+  explicit saved_bog(Bog const& bog) : bog(bog) { }
+#endif
+};
 
-template<>
-struct Converter<ks::tensor<1, Float>, torch::Tensor>
+template<typename Bog>
+std::shared_ptr<saved_values> save_bog(Bog const& bog)
 {
-  static ks::tensor<1, Float> to_ks(torch::Tensor arg) {
-    KS_ASSERT(arg.sizes().size() == 1u);
-    KS_ASSERT(arg.is_contiguous());
-    KS_ASSERT(arg.scalar_type() == scalar_type_of_Float);
-    return ks::tensor<1, Float>((int)arg.size(0), arg.data_ptr<Float>());
+  return std::make_shared<saved_bog<Bog>>(bog);
+}
+
+template<typename Bog>
+Bog const& bog_from_saved_values(std::shared_ptr<saved_values> const& saved)
+{
+  auto ret = dynamic_cast<saved_bog<Bog> const*>(saved.get());
+  TORCH_CHECK(ret, "Saved values were not returned by the matching forward pass");
+  return ret->bog;
+}
+
+// Results of entry points are converted to torch tensors by copying them
+// out of the Knossos heap.  If KS_VIEW_RESULTS is defined, tensors in the
+// calling thread's allocator are instead returned as views of it, each
+// holding a share of the allocator's buffer, so that the allocator will
+// not reuse the buffer while the view is alive.  A view keeps the whole
+// buffer alive, however small the tensor, so tensors smaller than
+// KS_VIEW_RESULTS_MIN_BYTES are still copied.
+#ifndef KS_VIEW_RESULTS_MIN_BYTES
+#define KS_VIEW_RESULTS_MIN_BYTES 65536
+#endif
+
+template<typename T>
+torch::Tensor torch_tensor_from_ks_data(T const* data, at::IntArrayRef sizes)
+{
+  auto options = torch::TensorOptions().dtype(scalar_type_of<T>);
+#if defined(KS_VIEW_RESULTS) && defined(KS_ALLOCATOR)
+  ks::allocator * alloc = thread_allocator();
+  size_t num_bytes = sizeof(T);
+  for (auto size : sizes) {
+    num_bytes *= size;
   }
+  if (num_bytes >= KS_VIEW_RESULTS_MIN_BYTES && alloc->contains(data)) {
+    auto buffer = alloc->buffer();
+    return torch::from_blob(const_cast<T*>(data), sizes, [buffer](void*) {}, options);
+  }
+#endif
+  torch::Tensor torch_ret = torch::empty(sizes, options);
+  std::memcpy(torch_ret.data_ptr(), data, torch_ret.numel() * sizeof(T));
+  return torch_ret;
+}
 
-  static torch::Tensor from_ks(ks::tensor<1, Float> ret) {
-    torch::Tensor torch_ret = torch::empty(ret.size(), torch::TensorOptions().dtype(scalar_type_of_Float));
-    std::memcpy(torch_ret.data_ptr(), ret.data(), ret.size() * sizeof(Float));
-    return torch_ret;
+// Call f(alloc) for an entry point whose results are converted to
+// torch values.  Unless they may view the allocator (KS_VIEW_RESULTS),
+// they have been copied out of it, so it is reset afterwards.
+template<typename F>
+auto with_thread_allocator_torch(F f)
+{
+#ifdef KS_VIEW_RESULTS
+  return with_thread_allocator(f);
+#else
+  return with_thread_allocator_scratch(f);
+#endif
+}
+
+template<size_t Dim, size_t ...Indices>
+typename ks::tensor_dimension<Dim>::index_type ks_index_from_torch(at::IntArrayRef index, std::index_sequence<Indices...>)
+{
+  if constexpr (Dim == 1u) {
+    return (int)index[0];
+  } else {
+    return ks::make_Tuple((int)index[Indices]...);
   }
-};
+}
 
-template<>
-struct Converter<ks::tensor<2, Float>, torch::Tensor>
+template<size_t Dim, size_t ...Indices>
+std::array<int64_t, Dim> torch_sizes_from_ks(typename ks::tensor_dimension<Dim>::index_type const& size, std::index_sequence<Indices...>)
 {
-  static ks::tensor<2, Float> to_ks(torch::Tensor arg) {
-    KS_ASSERT(arg.sizes().size() == 2u);
-    KS_ASSERT(arg.is_contiguous());
-    KS_ASSERT(arg.scalar_type() == scalar_type_of_Float);
-    return ks::tensor<2, Float>({(int)arg.size(0), (int)arg.size(1)}, arg.data_ptr<Float>());
+  return {{ (int64_t)ks::get_dimension<Indices>(size)... }};
+}
+
+// Torch tensors, contiguous or not, are viewed by strided_tensors.
+template<size_t Dim, typename T>
+struct Converter<ks::strided_tensor<Dim, T>, torch::Tensor>
+{
+  static ks::strided_tensor<Dim, T> to_ks(torch::Tensor arg) {
+    KS_ASSERT(arg.sizes().size() == Dim);
+    KS_ASSERT(arg.scalar_type() == scalar_type_of<T>);
+    return ks::strided_tensor<Dim, T>(
+      ks_index_from_torch<Dim>(arg.sizes(), std::make_index_sequence<Dim>{}),
+      ks_index_from_torch<Dim>(arg.strides(), std::make_index_sequence<Dim>{}),
+      arg.data_ptr<T>());
   }
+};
+
+// Contiguous torch tensors are viewed by ks::tensors.  Others are
+// copied into the calling thread's allocator, which the entry point
+// resets after the call.
+template<size_t Dim, typename T>
+ks::tensor<Dim, T> ks_tensor_from_torch(torch::Tensor arg)
+{
+  auto strided = convert_to_ks_viewing_tensordata<ks::strided_tensor<Dim, T>>(arg);
+#ifdef KS_ALLOCATOR
+  return ks::to_contiguous(thread_allocator(), strided);
+#else
+  KS_ASSERT(arg.is_contiguous());
+  return ks::to_contiguous(nullptr, strided);
+#endif
+}
+
+// The elements of a tensor of any rank in row-major order, for
+// elementwise entry points whose arguments are not contiguous.
+template<typename T>
+struct strided_elements
+{
+  T const* data;
+  at::DimVector sizes;
+  at::DimVector strides;
+
+  explicit strided_elements(torch::Tensor const& arg)
+    : data(arg.data_ptr<T>()),
+      sizes(arg.sizes().begin(), arg.sizes().end()),
+      strides(arg.strides().begin(), arg.strides().end())
+  {}
 
-  static torch::Tensor from_ks(ks::tensor<2, Float> ret) {
-    auto [size0, size1] = ret.size();
-    torch::Tensor torch_ret = torch::empty({size0, size1}, torch::TensorOptions().dtype(scalar_type_of_Float));
-    std::memcpy(torch_ret.data_ptr(), ret.data(), size0 * size1 * sizeof(Float));
-    return torch_ret;
+  T operator[](int64_t i) const {
+    int64_t offset = 0;
+    for (size_t d = sizes.size(); d-- != 0; ) {
+      offset += (i % sizes[d]) * strides[d];
+      i /= sizes[d];
+    }
+    return data[offset];
   }
 };
 
-// TODO: common these? 
-template<>
-struct Converter<ks::tensor<3, Float>, torch::Tensor>
+// ks::Integer is 32-bit, so int64 tensors are copied into the calling
+// thread's allocator, checking in the same pass that each value fits.
+template<size_t Dim>
+ks::tensor<Dim, ks::Integer> ks_integer_tensor_from_int64(torch::Tensor arg)
+{
+  KS_ASSERT(arg.sizes().size() == Dim);
+  auto size = ks_index_from_torch<Dim>(arg.sizes(), std::make_index_sequence<Dim>{});
+#ifdef KS_ALLOCATOR
+  auto ret = ks::tensor<Dim, ks::Integer>::create(thread_allocator(), size);
+#else
+  auto ret = ks::tensor<Dim, ks::Integer>::create(nullptr, size);
+#endif
+  auto narrow = [&](auto const& elements) {
+    ks::Integer* data = ret.data();
+    for (int64_t i = 0, n = arg.numel(); i != n; ++i) {
+      int64_t value = elements[i];
+      if (value < std::numeric_limits<ks::Integer>::min() ||
+          value > std::numeric_limits<ks::Integer>::max()) {
+        // A ValueError in Python
+        throw std::invalid_argument(
+          "Integer tensor has values outside the range of int32 [" +
+          std::to_string(std::numeric_limits<ks::Integer>::min()) + ", " +
+          std::to_string(std::numeric_limits<ks::Integer>::max()) + "]");
+      }
+      data[i] = (ks::Integer)value;
+    }
+  };
+  if (arg.is_contiguous()) {
+    narrow(arg.data_ptr<int64_t>());
+  } else {
+    narrow(strided_elements<int64_t>(arg));
+  }
+  return ret;
+}
+
+template<size_t Dim, typename T>
+struct Converter<ks::tensor<Dim, T>, torch::Tensor>
 {
-  static ks::tensor<3, Float> to_ks(torch::Tensor arg) {
-    KS_ASSERT(arg.sizes().size() == 3u);
-    KS_ASSERT(arg.is_contiguous());
-    KS_ASSERT(arg.scalar_type() == scalar_type_of_Float);
-    ks::tensor<3, Float>::index_type size {(int)arg.size(0), (int)arg.size(1), (int)arg.size(2)};
-    return ks::tensor<3, Float>(size, arg.data_ptr<Float>());
+  static ks::tensor<Dim, T> to_ks(torch::Tensor arg) {
+    if constexpr (std::is_same_v<T, ks::Integer>) {
+      if (arg.scalar_type() == torch::kInt64) {
+        return ks_integer_tensor_from_int64<Dim>(arg);
+      }
+    }
+    return ks_tensor_from_torch<Dim, T>(arg);
   }
 
-  static torch::Tensor from_ks(ks::tensor<3, Float> ret) {
-    auto [size0, size1, size2] = ret.size();
-    torch::Tensor torch_ret = torch::empty({size0, size1, size2}, torch::TensorOptions().dtype(scalar_type_of_Float));
-    std::memcpy(torch_ret.data_ptr(), ret.data(), size0 * size1 * size2 * sizeof(Float));
-    return torch_ret;
+  static torch::Tensor from_ks(ks::tensor<Dim, T> ret) {
+    auto sizes = torch_sizes_from_ks<Dim>(ret.size(), std::make_index_sequence<Dim>{});
+    return torch_tensor_from_ks_data(ret.data(), sizes);
   }
 };
 
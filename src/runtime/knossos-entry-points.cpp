@@ -1,21 +1,77 @@
 #include "knossos-entry-points.h"
 
+#include <atomic>
+#include <mutex>
+
 namespace ks {
 namespace entry_points {
 
 #ifdef KS_ALLOCATOR
 
-ks::allocator g_alloc{ 1'000'000'000 };
+namespace {
+
+// Initial capacity of each thread's allocator.  Allocators grow on
+// demand, so this need only be large enough to avoid early regrowth.
+std::atomic<size_t> g_initial_capacity{ 16'000'000 };
+
+// Every live thread allocator, for allocator_stats.  The mutex is taken
+// only when a thread creates or destroys its allocator.
+std::mutex g_thread_allocators_mutex;
+std::set<ks::allocator const*> g_thread_allocators;
+
+struct thread_allocator_t : ks::allocator
+{
+	thread_allocator_t() : ks::allocator(g_initial_capacity)
+	{
+		std::lock_guard<std::mutex> lock(g_thread_allocators_mutex);
+		g_thread_allocators.insert(this);
+	}
+	~thread_allocator_t()
+	{
+		std::lock_guard<std::mutex> lock(g_thread_allocators_mutex);
+		g_thread_allocators.erase(this);
+	}
+};
+
+}
+
+ks::allocator * thread_allocator()
+{
+	// Created on first use in each thread, and freed when the thread exits.
+	thread_local thread_allocator_t alloc;
+	return &alloc;
+}
+
+void reset_allocator() { thread_allocator()->reset(); }
+size_t allocator_top() { return thread_allocator()->mark(); }
+size_t allocator_peak() { return thread_allocator()->peak(); }
+size_t allocator_capacity() { return thread_allocator()->capacity(); }
 
-void reset_allocator() { g_alloc.reset(); }
-size_t allocator_top() { return g_alloc.mark(); }
-size_t allocator_peak() { return g_alloc.peak(); }
+void set_allocator_capacity(size_t capacity)
+{
+	g_initial_capacity = capacity;
+	thread_allocator()->set_capacity(capacity);
+}
+
+std::vector<std::tuple<size_t, size_t>> allocator_stats()
+{
+	// Stats of allocators in use by other threads may be out of date
+	std::lock_guard<std::mutex> lock(g_thread_allocators_mutex);
+	std::vector<std::tuple<size_t, size_t>> stats;
+	for (auto alloc : g_thread_allocators) {
+		stats.emplace_back(alloc->capacity(), alloc->peak());
+	}
+	return stats;
+}
 
 #else
 
 void reset_allocator() { }
 size_t allocator_top() { return 0u; }
 size_t allocator_peak() { return 0u; }
+size_t allocator_capacity() { return 0u; }
+void set_allocator_capacity(size_t) { }
+std::vector<std::tuple<size_t, size_t>> allocator_stats() { return {}; }
 
 #endif
 
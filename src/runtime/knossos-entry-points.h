@@ -3,17 +3,95 @@
 #include "knossos.h"
 
 #include <iostream>
+#include <tuple>
+#include <vector>
 
 namespace ks {
 namespace entry_points {
 
-#ifdef KS_ALLOCATOR
-extern ks::allocator g_alloc;
-#endif
-
+// Each thread calling an entry point allocates from its own allocator,
+// so compiled functions can be called from several threads at once.
+// The functions below act on the calling thread's allocator, except
+// allocator_stats, which returns (capacity, peak) for each thread's.
 void reset_allocator();
 size_t allocator_top();
 size_t allocator_peak();
+size_t allocator_capacity();
+void set_allocator_capacity(size_t capacity);
+std::vector<std::tuple<size_t, size_t>> allocator_stats();
+
+#ifdef KS_ALLOCATOR
+ks::allocator * thread_allocator();
+
+// Reset alloc to mark after an allocator_overflow.  If that
+// empties it, it grows to fit the allocation which overflowed.
+inline void reset_after_overflow(ks::allocator * alloc, ks::alloc_mark_t mark)
+{
+  if (mark == 0) {
+    alloc->reset();
+  } else {
+    alloc->reset(mark);
+  }
+}
+
+// Call f(alloc), where alloc is the calling thread's allocator.
+// If the allocator overflows, and was empty when f was called,
+// it is grown and f is called again.
+template<typename F>
+auto with_thread_allocator(F f)
+{
+  ks::allocator * alloc = thread_allocator();
+  for (;;) {
+    KS_MARK(alloc, mark);
+    try {
+      return f(alloc);
+    } catch (ks::allocator_overflow const&) {
+      reset_after_overflow(alloc, mark);
+      if (mark != 0) {
+        throw;
+      }
+    }
+  }
+}
+#else
+template<typename F>
+auto with_thread_allocator(F f)
+{
+  return f(nullptr);
+}
+#endif
+
+// As with_thread_allocator, but the allocator is reset after f returns,
+// so the value returned by f must not point into the allocator.
+template<typename F>
+auto with_thread_allocator_scratch(F f)
+{
+  return with_thread_allocator([&](ks::allocator * alloc) {
+    KS_MARK(alloc, mark);
+    auto ret = f(alloc);
+    KS_RESET(alloc, mark);
+    return ret;
+  });
+}
+
+// The ith slice of an argument to a vmapped function.  Slices of
+// strided arguments are viewed if they are contiguous, and otherwise
+// copied into alloc.
+template<size_t Dim, class T>
+auto vmap_slice(ks::allocator_base *, ks::tensor<Dim, T> const& arg, int i)
+{
+  return arg[i];
+}
+
+template<size_t Dim, class T>
+auto vmap_slice(ks::allocator_base * alloc, ks::strided_tensor<Dim, T> const& arg, int i)
+{
+  if constexpr (Dim == 1u) {
+    return arg[i];
+  } else {
+    return ks::to_contiguous(alloc, arg[i]);
+  }
+}
 
 template<typename KSType, typename EntryPointType>
 KSType convert_to_ks_viewing_tensordata(EntryPointType arg);
@@ -1,145 +1,116 @@
-#include <torch/extension.h>
+#include "knossos-entry-points-torch.h"
 
+#ifdef __CUDACC__
 #include <cuda.h>
 #include <cuda_runtime.h>
+#endif
 
-using ks_float = float;
+using ks_float = ks::Float;
 
-#define CHECK_SCALAR_TYPE(x) TORCH_CHECK(x.scalar_type() == at::ScalarType::Float, #x " must use ks floating-point type")
+// Elementwise kernels read and write tensors of ElementwiseStorage, which
+// is ks_float unless the module is compiled with KS_ELEMENTWISE_STORAGE
+// (e.g. at::Half), while computing in ks_float (see
+// knossos-entry-points-torch.h).
+using ks::entry_points::ElementwiseStorage;
+
+// KS_CUDA entry points may also be compiled without nvcc, for the host,
+// so that they can be tested on machines without a GPU.  Kernels then run
+// on the CPU, one index at a time (see launch_1d), on CPU tensors.
+#ifdef __CUDACC__
+#define KS_KERNEL __global__
 #define CHECK_CUDA(x) TORCH_CHECK(x.is_cuda(), #x " must be a CUDA tensor")
+#else
+#define KS_KERNEL
+#define CHECK_CUDA(x)
+#endif
+
+#define CHECK_SCALAR_TYPE(x, t) TORCH_CHECK(x.scalar_type() == t, #x " must have scalar type ", t)
 #define CHECK_CONTIGUOUS(x) TORCH_CHECK(x.is_contiguous(), #x " must be contiguous")
 #define CHECK_INPUT(x) CHECK_CUDA(x); CHECK_CONTIGUOUS(x)
 
-template<typename scalar_t> using tensor_accessor_1 =
-    torch::PackedTensorAccessor32<scalar_t,1,torch::RestrictPtrTraits>;
-template<typename scalar_t> using tensor_accessor_2 =
-    torch::PackedTensorAccessor32<scalar_t,2,torch::RestrictPtrTraits>;
-
-template <typename scalar_t, typename F>
-__global__ void map_kernel_1(
-    tensor_accessor_1<scalar_t> output,
-    const tensor_accessor_1<scalar_t> input,
-    F f) {
-  const int i = blockIdx.x * blockDim.x + threadIdx.x;
-  if (i < input.size(0))
-    output[i] = f(input[i]);
+template<typename T = ks_float>
+void check_input(torch::Tensor const& x)
+{
+  CHECK_INPUT(x);
+  CHECK_SCALAR_TYPE(x, ks::entry_points::scalar_type_of<T>);
 }
 
-template <typename scalar_t, typename F>
-__global__ void map_kernel_2(
-    tensor_accessor_2<scalar_t> output,
-    const tensor_accessor_2<scalar_t> input,
-    F f) {
-  const int n = blockIdx.y;
-  const int i = blockIdx.x * blockDim.x + threadIdx.x;
-  if (i < input.size(1))
-    output[n][i] = f(input[n][i]);
+// The index of the calling thread in a launch_1d.  When running on the
+// host, it is HOST_INDEX, the index passed to the kernel by launch_1d.
+#ifdef __CUDACC__
+#define KS_THREAD_INDEX(host_index) ((int64_t)blockIdx.x * blockDim.x + threadIdx.x)
+#else
+#define KS_THREAD_INDEX(host_index) (host_index)
+#endif
+
+// Call kernel(host_index, n, args...) on one thread for each index in
+// [0, n).  The last block may run past n, so kernels check their index
+// KS_THREAD_INDEX(host_index) against n.
+template<typename Kernel, typename ...Args>
+void launch_1d(int64_t n, Kernel kernel, Args... args)
+{
+  if (n == 0) {
+    return;
+  }
+#ifdef __CUDACC__
+  // TODO: find out how PyTorch chooses these parameters
+  const int threads = 1024;
+  const int64_t blocks = (n + threads - 1) / threads;
+  kernel<<<blocks, threads>>>(0, n, args...);
+#else
+  for (int64_t i = 0; i != n; ++i) {
+    kernel(i, n, args...);
+  }
+#endif
 }
 
-template<typename F>
-torch::Tensor map_gpu(
-    torch::Tensor input,
-    F f) {
-  CHECK_INPUT(input);
-
-  auto output = torch::zeros_like(input);
-
-  switch (input.sizes().size()) {
-    case 1: {
-      const auto input_size = input.size(0);
-
-      // TODO: find out how PyTorch chooses these parameters
-      const int threads = 1024;
-      const int blocks = (input_size + threads - 1) / threads;
-
-      map_kernel_1<ks_float><<<blocks, threads>>>(
-          output.packed_accessor32<ks_float,1,torch::RestrictPtrTraits>(),
-          input.packed_accessor32<ks_float,1,torch::RestrictPtrTraits>(),
-          f);
-      break;
-    }
-    case 2: {
-      const auto input_size_0 = input.size(0);
-      const auto input_size_1 = input.size(1);
+template <typename F, typename ...Inputs>
+KS_KERNEL void map_kernel(int64_t host_index, int64_t n, ElementwiseStorage* output, F f, Inputs... inputs) {
+  const int64_t i = KS_THREAD_INDEX(host_index);
+  if (i < n)
+    output[i] = f(inputs[i]...);
+}
 
-      const int threads = 1024;
-      const dim3 blocks((input_size_1 + threads - 1) / threads, input_size_0);
+template<typename> using storage_ptr = ElementwiseStorage const*;
 
-      map_kernel_2<ks_float><<<blocks, threads>>>(
-          output.packed_accessor32<ks_float,2,torch::RestrictPtrTraits>(),
-          input.packed_accessor32<ks_float,2,torch::RestrictPtrTraits>(),
-          f);
-      break;
-    }
-    default:
-      TORCH_CHECK(false, "Unsupported tensor rank");
-  }
+// f applied elementwise to inputs, which all have the same size
+template<typename F, typename ...Inputs>
+torch::Tensor map_gpu(
+    F f,
+    torch::Tensor input0,
+    Inputs... inputs) {
+  check_input<ElementwiseStorage>(input0);
+  (check_input<ElementwiseStorage>(inputs), ...);
+  TORCH_CHECK(((inputs.sizes() == input0.sizes()) && ...), "map_gpu inputs must have the same size");
+
+  auto output = torch::empty_like(input0);
+  launch_1d(
+      input0.numel(),
+      map_kernel<F, ElementwiseStorage const*, storage_ptr<Inputs>...>,
+      output.data_ptr<ElementwiseStorage>(),
+      f,
+      input0.data_ptr<ElementwiseStorage>(),
+      inputs.template data_ptr<ElementwiseStorage>()...);
   return output;
 }
 
-template <typename scalar_t, typename F>
-__global__ void map2_kernel_1(
-    tensor_accessor_1<scalar_t> output,
-    const tensor_accessor_1<scalar_t> input1,
-    const tensor_accessor_1<scalar_t> input2,
-    F f) {
-  const int i = blockIdx.x * blockDim.x + threadIdx.x;
-  if (i < input1.size(0))
-    output[i] = f(input1[i], input2[i]);
+template <typename F, typename ...KsArgs>
+KS_KERNEL void vmap_kernel(int64_t host_index, int64_t n, ks_float* output, F f, KsArgs... args) {
+  const int64_t i = KS_THREAD_INDEX(host_index);
+  if (i < n)
+    output[i] = f(args[i]...);
 }
 
-template <typename scalar_t, typename F>
-__global__ void map2_kernel_2(
-    tensor_accessor_2<scalar_t> output,
-    const tensor_accessor_2<scalar_t> input1,
-    const tensor_accessor_2<scalar_t> input2,
-    F f) {
-  const int n = blockIdx.y;
-  const int i = blockIdx.x * blockDim.x + threadIdx.x;
-  if (i < input1.size(1))
-    output[n][i] = f(input1[n][i], input2[n][i]);
-}
-
-template<typename F>
-torch::Tensor map2_gpu(
-    torch::Tensor input1,
-    torch::Tensor input2,
-    F f) {
-  CHECK_INPUT(input1);
-  CHECK_INPUT(input2);
-
-  auto output = torch::zeros_like(input1);
-  switch (input1.sizes().size()) {
-    case 1: {
-      auto input_size = input1.size(0);
-
-      // TODO: find out how PyTorch chooses these parameters
-      const int threads = 1024;
-      const int blocks = (input_size + threads - 1) / threads;
-
-      map2_kernel_1<ks_float><<<blocks, threads>>>(
-          output.packed_accessor32<ks_float,1,torch::RestrictPtrTraits>(),
-          input1.packed_accessor32<ks_float,1,torch::RestrictPtrTraits>(),
-          input2.packed_accessor32<ks_float,1,torch::RestrictPtrTraits>(),
-          f);
-      break;
-    }
-    case 2: {
-      auto input_size_0 = input1.size(0);
-      auto input_size_1 = input1.size(1);
-
-      const int threads = 1024;
-      const dim3 blocks((input_size_1 + threads - 1) / threads, input_size_0);
-
-      map2_kernel_2<ks_float><<<blocks, threads>>>(
-          output.packed_accessor32<ks_float,2,torch::RestrictPtrTraits>(),
-          input1.packed_accessor32<ks_float,2,torch::RestrictPtrTraits>(),
-          input2.packed_accessor32<ks_float,2,torch::RestrictPtrTraits>(),
-          f);
-      break;
-    }
-    default:
-      TORCH_CHECK(false, "Unsupported tensor rank");
-  }
+// f applied to each slice, along their first dimension, of the ks
+// tensors args, which view CUDA tensors of n slices.  One thread
+// computes each slice's result, which is a scalar.
+template<typename F, typename ...KsArgs>
+torch::Tensor vmap_gpu(
+    F f,
+    torch::TensorOptions options,
+    int64_t n,
+    KsArgs... args) {
+  auto output = torch::empty({n}, options);
+  launch_1d(n, vmap_kernel<F, KsArgs...>, output.data_ptr<ks_float>(), f, args...);
   return output;
 }
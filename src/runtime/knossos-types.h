@@ -1,12 +1,29 @@
 #pragma once
 
+#include <memory>
 #include <string>
 
 namespace ks {
 
+#ifdef KS_FLOAT_TYPE
+typedef KS_FLOAT_TYPE Float;
+#else
 typedef float Float;
+#endif
 typedef int Integer;
 typedef bool Bool;
 typedef std::string String;
 
+namespace entry_points {
+
+// Values which an entry point returns for passing back to a later entry
+// point, such as those kept between the forward and reverse passes of
+// a split derivative.  Python sees them only as an opaque object.
+struct saved_values
+{
+  virtual ~saved_values() = default;
+};
+
+}
+
 }
@@ -17,12 +17,15 @@ Contents:
 - Other primitives
 */
 
+#include <algorithm>
+#include <stdexcept>
 #include <type_traits>
 #include <utility>
 #include <variant>
 #include <tuple>
 #include <set>
 #include <functional>
+#include <memory>
 #include <sstream>
 #include <iostream>
 #include <random>
@@ -38,9 +41,13 @@ Each C++ function is annotated with one of the following macros:
 - KS_DEF: a definition which has been generated by ksc
 - KS_FUNCTION: a function used only from within ksc-generated code
 - KS_INTERFACE: a function which may be called from outside the generated code (e.g. to convert to/from ks types)
+
+With KS_CUDA, the generated code is for CUDA kernels, and does not use an
+allocator.  It may also be compiled for the host, without nvcc, to test
+CUDA entry points without a GPU (see knossos-kernel.cuh).
 */
 
-#ifdef KS_CUDA
+#if defined(KS_CUDA) && defined(__CUDACC__)
 
 #define KS_DEF __device__
 #define KS_FUNCTION __device__
@@ -370,32 +377,53 @@ namespace ks {
 	// ===============================  Allocator  ==================================
 #ifdef KS_ALLOCATOR
 
+	// Thrown when an allocation does not fit in the allocator's buffer.
+	struct allocator_overflow : std::runtime_error
+	{
+		using std::runtime_error::runtime_error;
+	};
+
 	class allocator_base {
 		size_t max_size_;
 		unsigned char* buf_;
 		size_t top_;
 		size_t peak_;
+		size_t wanted_size_;  // Size to which a growable allocator should grow when next empty
 	
 	public:
 		allocator_base(unsigned char * buf, size_t max_size, size_t peak = 0) :
 			max_size_(max_size),
 			buf_(buf),
 			top_(0),
-			peak_(peak)
+			peak_(peak),
+			wanted_size_(max_size)
 		{}
 
 		void* allocate(size_t size)
 		{
 			KS_ASSERT(size < 1000 * 1000000);
 			void* ret = buf_ + top_;
-			top_ += padded_size(size);
-			if (top_ > peak_) {
-				peak_ = top_;
-				KS_ASSERT(top_ < max_size_);
+			size_t top = top_ + padded_size(size);
+			// Compare against the capacity on every allocation: peak_ may
+			// exceed the capacity of a buffer which replaced a larger one.
+			if (top >= max_size_) {
+				overflow(top);
+			}
+			if (top > peak_) {
+				peak_ = top;
 			}
+			top_ = top;
 			return ret;
 		}
 
+		[[noreturn]] void overflow(size_t top)
+		{
+			wanted_size_ = std::max({ wanted_size_, 2 * max_size_, top + 1 });
+			std::ostringstream os;
+			os << "ks::allocator overflow: needed " << top << " bytes, capacity " << max_size_;
+			throw allocator_overflow(os.str());
+		}
+
 		static size_t padded_size(size_t size) { return ((size + 15) / 16) * 16; }
 
 		size_t mark() const { return top_;  }
@@ -410,18 +438,83 @@ namespace ks {
 		}
 
 		size_t peak() const { return peak_; }
+
+		size_t capacity() const { return max_size_; }
+
+		size_t wanted_capacity() const { return wanted_size_; }
+
+		void set_wanted_capacity(size_t size) { wanted_size_ = size; }
+
+	protected:
+		void set_buffer(unsigned char * buf, size_t max_size)
+		{
+			KS_ASSERT(top_ == 0);
+			buf_ = buf;
+			max_size_ = max_size;
+			wanted_size_ = max_size;
+		}
 	};
 
 	typedef size_t alloc_mark_t;
 
+	// An allocator which owns its buffer.  If an allocation overflows,
+	// allocator_overflow is thrown, and the buffer is replaced by a larger
+	// one the next time reset() is called with no argument (when nothing
+	// can still point into the old buffer).
+	//
+	// Ownership of the buffer may be shared, by copies of buffer(), with
+	// values which view data in it.  While any such copy is alive, reset()
+	// moves the allocator to a fresh buffer, rather than reusing this one.
 	class allocator : public allocator_base
 	{
+		std::shared_ptr<unsigned char> buffer_;
+
+		static std::shared_ptr<unsigned char> new_buffer(size_t size)
+		{
+			return std::shared_ptr<unsigned char>(new unsigned char[size], std::default_delete<unsigned char[]>());
+		}
+
 	public:
 		allocator(size_t max_size) :
-			allocator_base(new unsigned char[max_size], max_size)
-		{}
-		~allocator() {
-			delete[] static_cast<unsigned char*>(ptr_at(0));
+			allocator_base(nullptr, 0),
+			buffer_(new_buffer(max_size))
+		{
+			set_buffer(buffer_.get(), max_size);
+		}
+		allocator(allocator const&) = delete;
+		allocator& operator=(allocator const&) = delete;
+
+		void reset(size_t top)
+		{
+			allocator_base::reset(top);
+		}
+
+		void reset()
+		{
+			allocator_base::reset();
+			if (wanted_capacity() != capacity() || buffer_.use_count() > 1) {
+				size_t size = wanted_capacity();
+				buffer_ = new_buffer(size);
+				set_buffer(buffer_.get(), size);
+			}
+		}
+
+		// Change the capacity of the buffer, now if the allocator is
+		// empty, otherwise when it is next reset to empty.
+		void set_capacity(size_t size)
+		{
+			set_wanted_capacity(size);
+			if (mark() == 0) {
+				reset();
+			}
+		}
+
+		std::shared_ptr<void> buffer() const { return buffer_; }
+
+		bool contains(void const* p) const
+		{
+			auto* q = static_cast<unsigned char const*>(p);
+			return buffer_.get() <= q && q < buffer_.get() + capacity();
 		}
 	};
 
@@ -707,6 +800,95 @@ namespace ks {
 		}
 	};
 
+	// A view of tensor data with arbitrary strides, such as a transposed or
+	// sliced PyTorch tensor.  Compiled functions take contiguous tensors, so
+	// entry points read strided tensors in place where they can (e.g. one
+	// element at a time), and otherwise use to_contiguous, which copies
+	// only if the data is not already contiguous.
+	template <size_t Dim, class T>
+	class strided_tensor
+	{
+		using dimension = tensor_dimension<Dim>;
+
+		typename dimension::index_type size_;
+		typename dimension::index_type strides_;  // In elements, not bytes
+		T* data_;
+
+		template<size_t... Indices>
+		KS_INTERFACE int offset(typename dimension::index_type const& i, std::index_sequence<Indices...>) const {
+			return (0 + ... + (get_dimension<Indices>(i) * get_dimension<Indices>(strides_)));
+		}
+
+		template<size_t... Indices>
+		KS_INTERFACE bool is_contiguous(std::index_sequence<Indices...>) const {
+			// Innermost dimension first.  Dimensions of size 1 may have any stride.
+			int expected_stride = 1;
+			bool ret = true;
+			((ret = ret && (get_dimension<Dim - 1u - Indices>(size_) == 1 ||
+			                get_dimension<Dim - 1u - Indices>(strides_) == expected_stride),
+			  expected_stride *= get_dimension<Dim - 1u - Indices>(size_)), ...);
+			return ret;
+		}
+
+	public:
+		typedef typename dimension::index_type index_type;
+		typedef T value_type;
+
+		KS_INTERFACE strided_tensor() : size_{}, strides_{}, data_{ nullptr } {}
+		KS_INTERFACE strided_tensor(index_type size, index_type strides, T * data) : size_(size), strides_(strides), data_(data) {}
+
+		KS_INTERFACE index_type size() const { return size_; }
+		KS_INTERFACE index_type strides() const { return strides_; }
+		KS_INTERFACE int outer_dimension() const { return get_dimension<0>(size_); }
+		KS_INTERFACE int num_elements() const { return dimension::num_elements(size_); }
+
+		KS_INTERFACE T* data() const { return data_; }
+
+		KS_INTERFACE bool is_contiguous() const {
+			return num_elements() == 0 || is_contiguous(std::make_index_sequence<Dim>{});
+		}
+
+		KS_INTERFACE std::conditional_t<Dim == 1u, T&, strided_tensor<Dim-1, T>> operator[](int i) const {
+			if constexpr (Dim == 1u) {
+				return data_[i * strides_];
+			} else {
+				return strided_tensor<Dim-1, T>(
+					tensor_dimension<Dim-1>::tail(size_),
+					tensor_dimension<Dim-1>::tail(strides_),
+					data_ + i * get_dimension<0>(strides_));
+			}
+		}
+
+		KS_INTERFACE T& index(index_type i) const {
+			return data_[offset(i, std::make_index_sequence<Dim>{})];
+		}
+	};
+
+	template <size_t Dim, class T>
+	KS_INTERFACE void copy_strided(tensor<Dim, T> dest, strided_tensor<Dim, T> const& src)
+	{
+		for (int i = 0, ne = src.outer_dimension(); i != ne; ++i) {
+			if constexpr (Dim == 1u) {
+				dest[i] = src[i];
+			} else {
+				copy_strided(dest[i], src[i]);
+			}
+		}
+	}
+
+	// A contiguous tensor with the elements of t: a view of t if it is
+	// already contiguous, otherwise a copy allocated from alloc.
+	template <size_t Dim, class T>
+	KS_INTERFACE tensor<Dim, T> to_contiguous(allocator_base * alloc, strided_tensor<Dim, T> const& t)
+	{
+		if (t.is_contiguous()) {
+			return tensor<Dim, T>(t.size(), t.data());
+		}
+		auto ret = tensor<Dim, T>::create(alloc, t.size());
+		copy_strided(ret, t);
+		return ret;
+	}
+
 	// ===============================  Shape  ==================================
 
 	inline KS_FUNCTION Tuple<> shape(allocator_base *, Bool const&) { return {}; }
@@ -0,0 +1,104 @@
+import pytest
+
+from ksc import cgen
+from ksc.parse_ks import parse_ks_string
+
+
+def ksc_def(name, body):
+    return [
+        f"typedef ks::Float ty${name};",
+        f"KS_DEF ty${name} {name}(ks::allocator * $alloc, ks::Float x) {{",
+        f"  {body}",
+        "}",
+        "",
+    ]
+
+
+def ksc_cpp(*defs):
+    lines = ['#include "knossos.h"', '#include "prelude.h"', "", "namespace ks {", ""]
+    for def_lines in defs:
+        lines += def_lines
+    return "\n".join(lines + ["}", '#include "knossos.cpp"', ""])
+
+
+def defined(cpp):
+    return [
+        line.split("(")[0].split()[-1]
+        for line in cpp.split("\n")
+        if line.startswith(("KS_DEF", "static KS_DEF")) and line.endswith("{")
+    ]
+
+
+def test_split_ksc_cpp():
+    cpp = ksc_cpp(
+        ksc_def("h", "return x;"),
+        ksc_def("f", "return h($alloc, x);"),
+        ksc_def("g", "return f($alloc, x) + h($alloc, x);"),
+        ksc_def("k", "return x;"),
+        ksc_def("unused", "return x;"),
+    )
+    units = cgen.split_ksc_cpp(cpp, ["f", "g", "k"], 4)
+
+    assert units.prelude == '#include "knossos.h"\n#include "prelude.h"\n'
+    assert defined(units.main) == []
+    assert "KS_DEF ty$f f(ks::allocator * $alloc, ks::Float x);" in units.main
+    assert "KS_DEF ty$h" not in units.main
+    assert units.main.endswith('}\n#include "knossos.cpp"\n')
+
+    # g calls f, so they share a unit; callees precede callers, and
+    # functions which no root calls are kept in the first unit
+    assert [defined(unit) for unit in units.units] == [["h", "f", "g", "unused"], ["k"]]
+    for unit in units.units:
+        assert unit.startswith('#include "ksc-prelude.h"\n')
+    assert "static KS_DEF ty$h h(" in units.units[0]
+    assert "\nKS_DEF ty$f f(" in units.units[0]
+    assert "\nKS_DEF ty$unused unused(" in units.units[0]
+
+
+def test_split_ksc_cpp_duplicates_shared_callees():
+    cpp = ksc_cpp(
+        ksc_def("h", "return x;"),
+        ksc_def("f", "return h($alloc, x);"),
+        ksc_def("g", "return h($alloc, x);"),
+    )
+    units = cgen.split_ksc_cpp(cpp, ["f", "g"], 2)
+    assert sorted(defined(unit) for unit in units.units) == [["h", "f"], ["h", "g"]]
+    assert cgen.split_ksc_cpp(cpp, ["f", "g"], 1).units == [
+        cgen.split_ksc_cpp(cpp, ["g"], 1).units[0]
+    ]
+
+
+def test_split_ksc_cpp_unexpected_form():
+    cpp = ksc_cpp(ksc_def("f", "return x;"))
+    assert cgen.split_ksc_cpp(cpp, ["g"], 2) is None
+    assert cgen.split_ksc_cpp(cpp.replace("KS_DEF ", ""), ["f"], 2) is None
+    assert cgen.split_ksc_cpp(cpp + "int extra;\n", ["f"], 2) is None
+
+
+def test_cuda_vmap_entry_point_return_type():
+    (f, g) = parse_ks_string(
+        """
+        (def f Float ((x : Tensor 1 Float)) (index 0 x))
+        (def g (Tensor 1 Float) ((x : Tensor 1 Float)) x)
+        """,
+        "test_cuda_vmap_entry_point_return_type",
+    )
+    cgen.generate_cpp_cuda_vmap_entry_point("entry", f)
+    # Raised when generating the module, rather than when calling it
+    with pytest.raises(ValueError):
+        cgen.generate_cpp_cuda_vmap_entry_point("entry", g)
+
+
+def test_batch_entry_point_only_for_entry():
+    (f,) = parse_ks_string(
+        "(def f Float ((x : Float)) x)", "test_batch_entry_point_only_for_entry"
+    )
+
+    def declaration(binding_name):
+        cpp_declaration, _ = cgen.generate_cpp_entry_point(
+            binding_name, f, cgen.VecSpec_None(), use_torch=True, gpu=False
+        )
+        return cpp_declaration
+
+    assert "entry_batch(" in declaration("entry")
+    assert "_batch(" not in declaration("entry_vjp")
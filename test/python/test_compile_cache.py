@@ -0,0 +1,326 @@
+import os
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from ksc import cgen, compile
+
+
+@pytest.fixture
+def fake_ksc(tmp_path, monkeypatch):
+    """
+    Point the ksc cache at a fresh directory, and replace the ksc
+    invocation with a stub which records its calls.
+    """
+    ksc_path = tmp_path / "ksc"
+    ksc_path.write_text("fake ksc binary")
+    monkeypatch.setenv("KSC_PATH", str(ksc_path))
+    monkeypatch.setenv("KSC_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(compile, "use_ksc_cache", True)
+
+    calls = []
+
+    def run_ksc(ks_str, ks_entry_points, preludes, prelude_headers):
+        calls.append(ks_str)
+        return f"// cpp for {ks_str}", [ks_str, list(ks_entry_points)]
+
+    monkeypatch.setattr(compile, "_run_ksc", run_ksc)
+    return ksc_path, calls
+
+
+def test_ksc_cache_hit(fake_ksc):
+    _, calls = fake_ksc
+    args = ("(def f Float (x : Float) x)", ["f"], ["prelude.ks"], ["prelude.h"])
+
+    first = compile.generate_cpp_from_ks(*args)
+    second = compile.generate_cpp_from_ks(*args)
+
+    assert len(calls) == 1
+    assert first == second
+    assert second == ("// cpp for (def f Float (x : Float) x)", [args[0], ["f"]])
+
+
+def test_ksc_cache_miss_on_changed_inputs(fake_ksc):
+    _, calls = fake_ksc
+    compile.generate_cpp_from_ks("(def f Float (x : Float) x)", ["f"], [], [])
+    compile.generate_cpp_from_ks("(def g Float (x : Float) x)", ["g"], [], [])
+    compile.generate_cpp_from_ks("(def g Float (x : Float) x)", ["g"], [], ["a.h"])
+    compile.generate_cpp_from_ks("(def g Float (x : Float) x)", ["g"], [], ["a.h"])
+    assert len(calls) == 3
+
+
+def test_ksc_cache_miss_on_changed_binary(fake_ksc):
+    ksc_path, calls = fake_ksc
+    args = ("(def f Float (x : Float) x)", ["f"], [], [])
+    compile.generate_cpp_from_ks(*args)
+    ksc_path.write_text("a rebuilt fake ksc binary")
+    compile.generate_cpp_from_ks(*args)
+    assert len(calls) == 2
+
+
+def test_ksc_cache_disabled(fake_ksc, monkeypatch):
+    _, calls = fake_ksc
+    monkeypatch.setattr(compile, "use_ksc_cache", False)
+    args = ("(def f Float (x : Float) x)", ["f"], [], [])
+    compile.generate_cpp_from_ks(*args)
+    compile.generate_cpp_from_ks(*args)
+    assert len(calls) == 2
+    assert not os.path.exists(compile.get_ksc_cache_dir())
+
+
+@pytest.fixture
+def fake_compiler(tmp_path, monkeypatch):
+    """
+    Point the module cache at a fresh directory, and replace the compiler
+    invocation with a stub which records its calls.
+    """
+    monkeypatch.setenv("KSC_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(compile, "use_py_module_cache", True)
+    monkeypatch.setattr(compile, "_compiler_identity", lambda compiler: "g++ 9.9")
+    monkeypatch.setattr(compile, "_python_includes", lambda: "-I/python")
+
+    calls = []
+
+    def compile_py_module(compiler, cflags, module_name, cpp_path, module_path):
+        with open(cpp_path) as f:
+            calls.append((f.read(), cflags))
+        with open(module_path, "w") as f:
+            f.write(module_name)
+
+    monkeypatch.setattr(compile, "_compile_py_module", compile_py_module)
+    return calls
+
+
+def test_py_module_cache_hit(fake_compiler):
+    name1, path1 = compile.build_py_module_from_cpp("int f() { return 1; }")
+    name2, path2 = compile.build_py_module_from_cpp("int f() { return 1; }")
+    assert (name1, path1) == (name2, path2)
+    assert len(fake_compiler) == 1
+    with open(path1) as f:
+        assert f.read() == name1
+
+
+def test_py_module_cache_miss_on_changed_flags(fake_compiler):
+    compile.build_py_module_from_cpp("int f() { return 1; }")
+    compile.build_py_module_from_cpp("int f() { return 1; }", profiling=True)
+    compile.build_py_module_from_cpp("int f() { return 2; }")
+    assert len(fake_compiler) == 3
+
+
+def test_build_py_modules_from_cpp(fake_compiler):
+    cpp_strs = [f"int f() {{ return {i % 3}; }}" for i in range(6)]
+    modules = compile.build_py_modules_from_cpp(cpp_strs, max_workers=4)
+    assert len(fake_compiler) == 3
+    assert modules[:3] == modules[3:]
+    assert len(set(modules)) == 3
+    assert modules[1] == compile.build_py_module_from_cpp(cpp_strs[1])
+
+
+@pytest.fixture
+def fake_torch_extension_build(tmp_path, monkeypatch):
+    """
+    Point the torch extensions directory at a fresh directory, and replace
+    the extension build and import with stubs which record their calls.
+    """
+    monkeypatch.setenv("KSC_TORCH_EXTENSIONS_DIR", str(tmp_path / "extensions"))
+    monkeypatch.setenv("KSC_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.delenv("KSC_SHARED_TORCH_EXTENSIONS_DIRS", raising=False)
+    monkeypatch.setattr(compile, "use_torch_extension_cache", True)
+    monkeypatch.setattr(compile, "_compiler_identity", lambda compiler: "c++ 9.9")
+
+    calls = []
+
+    def build_torch_extension(module_name, sources, build_directory, *args):
+        calls.append(module_name)
+        os.makedirs(build_directory, exist_ok=True)
+        with open(compile._torch_extension_path(build_directory, module_name), "w"):
+            pass
+        return ("built", module_name)
+
+    monkeypatch.setattr(compile, "_build_torch_extension", build_torch_extension)
+    monkeypatch.setattr(
+        compile,
+        "_import_torch_extension",
+        lambda module_name, module_path: ("imported", module_name, module_path),
+    )
+    return calls
+
+
+def build_torch_extension(
+    source, name="ext", cflags=compile.CFlags.Empty(), ksc_units=None
+):
+    return compile.build_module_using_pytorch_from_cpp_backend(
+        [("ksc.cpp", source)], name, cflags, ksc_units=ksc_units
+    )
+
+
+def test_torch_extension_cache_hit(fake_torch_extension_build):
+    built = build_torch_extension("int f() { return 1; }")
+    imported = build_torch_extension("int f() { return 1; }")
+    assert fake_torch_extension_build == [built[1]]
+    assert imported[:2] == ("imported", built[1])
+    assert os.path.dirname(imported[2]) == os.path.join(
+        compile.get_torch_extensions_dir(), built[1]
+    )
+
+
+def test_torch_extension_cache_miss(fake_torch_extension_build):
+    build_torch_extension("int f() { return 1; }")
+    build_torch_extension("int f() { return 2; }")
+    build_torch_extension("int f() { return 2; }", name="ext2")
+    build_torch_extension("int f() { return 2; }", cflags=compile.default_cflags)
+    assert len(set(fake_torch_extension_build)) == 4
+
+
+def test_torch_extension_shared_cache(fake_torch_extension_build, monkeypatch):
+    _, module_name = build_torch_extension("int f() { return 1; }")
+    shared_dir = compile.get_torch_extensions_dir()
+    local_dir = os.path.join(os.path.dirname(shared_dir), "local")
+    monkeypatch.setenv("KSC_TORCH_EXTENSIONS_DIR", local_dir)
+    monkeypatch.setenv("KSC_SHARED_TORCH_EXTENSIONS_DIRS", shared_dir)
+
+    _, _, module_path = build_torch_extension("int f() { return 1; }")
+    assert module_path.startswith(shared_dir)
+    build_torch_extension("int f() { return 2; }")
+    assert len(fake_torch_extension_build) == 2
+    assert os.listdir(local_dir) == [fake_torch_extension_build[1]]
+
+
+def test_torch_extensions_dir_pruned(fake_torch_extension_build, monkeypatch):
+    # Each fake build directory holds only its marker, of 64 bytes
+    monkeypatch.setattr(compile, "max_torch_extensions_dir_bytes", 150)
+    monkeypatch.setattr(compile, "_torch_extension_uses", {})
+    extensions_dir = compile.get_torch_extensions_dir()
+
+    def marker_path(module_name):
+        build_directory = os.path.join(extensions_dir, module_name)
+        return compile._built_marker_path(build_directory, module_name)
+
+    names = []
+    for i in range(3):
+        _, module_name = build_torch_extension(f"int f() {{ return {i}; }}")
+        os.utime(marker_path(module_name), (i, i))
+        names.append(module_name)
+    # Extensions in use are kept, whatever their size
+    assert sorted(os.listdir(extensions_dir)) == sorted(names)
+    for module_name in names:
+        compile.release_torch_extension(module_name)
+
+    # A cache hit marks the extension as most recently used
+    build_torch_extension("int f() { return 1; }")
+    assert os.path.getmtime(marker_path(names[1])) > 2
+    build_torch_extension("int f() { return 3; }")
+    # The least recently used of those released are removed
+    assert sorted(os.listdir(extensions_dir)) == sorted(
+        [names[1], fake_torch_extension_build[-1]]
+    )
+
+
+def test_torch_extensions_built_concurrently(fake_torch_extension_build, monkeypatch):
+    # Two different extensions must be building at once to pass the barrier
+    barrier = threading.Barrier(2, timeout=10)
+    build = compile._build_torch_extension
+
+    def build_at_barrier(*args):
+        barrier.wait()
+        return build(*args)
+
+    monkeypatch.setattr(compile, "_build_torch_extension", build_at_barrier)
+    sources = [f"int f() {{ return {i % 2}; }}" for i in range(8)]
+    with ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(build_torch_extension, sources))
+    assert len(fake_torch_extension_build) == 2
+    assert {result[1] for result in results} == set(fake_torch_extension_build)
+
+
+def test_torch_extension_with_ksc_units(fake_torch_extension_build, monkeypatch):
+    builds = []
+    build = compile._build_torch_extension
+
+    def record_build(module_name, sources, build_directory, include_paths, *args):
+        builds.append((sources, include_paths))
+        return build(module_name, sources, build_directory, include_paths, *args)
+
+    monkeypatch.setattr(compile, "_build_torch_extension", record_build)
+
+    def units(prelude):
+        return cgen.KscCppUnits(prelude=prelude, main="// main", units=["// 0", "// 1"])
+
+    build_torch_extension("int f();", ksc_units=units('#include "knossos.h"\n'))
+    build_torch_extension("int f();", ksc_units=units('#include "knossos.h"\n'))
+    build_torch_extension("int f();", ksc_units=units('#include "prelude.h"\n'))
+    assert len(fake_torch_extension_build) == 2
+
+    sources, include_paths = builds[0]
+    assert sources[1:] == [
+        ("ksc-functions-0.cpp", "// 0"),
+        ("ksc-functions-1.cpp", "// 1"),
+    ]
+    prelude_dir = include_paths[-1]
+    assert os.path.dirname(prelude_dir) == compile.get_ksc_cache_dir()
+    with open(os.path.join(prelude_dir, "ksc-prelude.h")) as f:
+        assert f.read() == '#include "knossos.h"\n'
+    # The fake compiler is not GCC
+    assert not os.path.exists(os.path.join(prelude_dir, "ksc-prelude.h.gch"))
+
+
+def test_prelude_pch_used_with_torch_extension_flags(tmp_path, monkeypatch):
+    if not compile._is_gcc(compile._cpp_compiler_or_default(None)):
+        pytest.skip("Precompiled headers are only built with GCC")
+    monkeypatch.setenv("KSC_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(compile, "use_prelude_pch", True)
+    cflags = ["-std=c++17", "-O1"]
+    prelude_dir = compile._ksc_prelude_dir(
+        "#include <vector>\n", str(tmp_path), None, cflags
+    )
+    assert os.path.exists(os.path.join(prelude_dir, "ksc-prelude.h.gch"))
+
+    unit = tmp_path / "unit.cpp"
+    unit.write_text('#include "ksc-prelude.h"\nstd::vector<int> v;\n')
+    # As cpp_extension compiles each source (with a module-specific
+    # TORCH_EXTENSION_NAME); -H lists the headers read, marking with "!"
+    # a precompiled header which is used
+    result = subprocess.run(
+        [
+            compile._cpp_compiler_or_default(None),
+            "-DTORCH_EXTENSION_NAME=test_ext",
+            *compile._torch_extension_cflags(),
+            *cflags,
+            "-Winvalid-pch",
+            "-H",
+            f"-I{prelude_dir}",
+            "-c",
+            str(unit),
+            "-o",
+            str(tmp_path / "unit.o"),
+        ],
+        capture_output=True,
+        check=True,
+        text=True,
+    )
+    assert "not used" not in result.stderr
+    assert result.stderr.startswith("! ")
+
+
+def test_torch_extension_cflags(monkeypatch):
+    cflags = compile._torch_extension_cflags()
+    assert any(flag.startswith("-std=") for flag in cflags)
+    assert "-isystem" not in cflags
+    assert not any(
+        flag.startswith(("-I", "-DTORCH_EXTENSION_NAME=")) for flag in cflags
+    )
+
+    def fail(*args, **kwargs):
+        raise TypeError("changed signature")
+
+    # If cpp_extension's private API changes, fall back to torch 1.9's flags
+    monkeypatch.setattr(
+        compile.cpp_extension, "_write_ninja_file_to_build_library", fail
+    )
+    compile._torch_extension_cflags.cache_clear()
+    try:
+        assert "-std=c++14" in compile._torch_extension_cflags()
+    finally:
+        compile._torch_extension_cflags.cache_clear()
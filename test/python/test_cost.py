@@ -1,11 +1,15 @@
+import linecache
+import traceback
+
 import numpy as np
 import pytest
 
 import ksc
 from ksc.abstract_value import AbstractValue, ExecutionContext
-from ksc.cost import compute_cost
+from ksc.cost import compute_cost, translate_and_import_cached
 from ksc.tracing.functions import math
 from ksc.type import Type
+from ksc import utils
 from ksc.utils import translate_and_import
 from ksc.shape import Shape, TensorShape, ScalarShape, ShapeType
 
@@ -230,3 +234,41 @@ def test_if_then_else():
     assert cost1 == 302.0201
     assert cost1 == cost2
     assert cost3 < cost1
+
+
+def test_compute_cost_reuses_translation():
+    ks_str = """
+(edef add Float (Tuple Float Float))
+(def cost$add Float ((a : Float) (b : Float)) 1.0)
+(def shape$add Integer ((a : Float) (b : Float)) (tuple))
+
+(def add3 Float ((a : Float) (b : Float) (c : Float))
+  (add a (add b c))
+)
+"""
+    args = [AbstractValue(ScalarShape, Type.Float)] * 3
+    translate_and_import_cached.cache_clear()
+    assert compute_cost(ks_str, "add3", args) == compute_cost(ks_str, "add3", args)
+    info = translate_and_import_cached.cache_info()
+    assert (info.hits, info.misses) == (1, 1)
+    m = translate_and_import_cached(ks_str, "abstract")
+    assert m.__file__.startswith("<")  # not written to disk
+
+
+def test_import_module_from_source_linecache():
+    filename = "<test_import_module_from_source_linecache>"
+    m1 = utils.import_module_from_source("m1", "x = 1\n", filename)
+    m2 = utils.import_module_from_source("m2", "x = 2\n", filename)
+    assert m1.__file__ != m2.__file__
+    # Nothing is cached until the source is needed
+    assert m1.__file__ not in linecache.cache
+    assert linecache.getline(m1.__file__, 1, m1.__dict__) == "x = 1\n"
+    assert linecache.getline(m2.__file__, 1, m2.__dict__) == "x = 2\n"
+
+    m3 = utils.import_module_from_source(
+        "m3", "def f():\n    raise ValueError('f')\n", filename
+    )
+    with pytest.raises(ValueError) as excinfo:
+        m3.f()
+    lines = traceback.format_exception(excinfo.type, excinfo.value, excinfo.tb)
+    assert "raise ValueError('f')" in "".join(lines)
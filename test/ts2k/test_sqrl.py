@@ -1,6 +1,7 @@
 import sys
 import torch
 import ksc
+import ksc.torch_frontend as knossos
 
 import importlib
 
@@ -22,3 +23,11 @@ def test_knossos_vs_pytorch():
     ans_pt = mod.vsqrl_pytorch(x)
     ans_ks = mod.vsqrl(x)
     assert torch.isclose(ans_pt, ans_ks).all()
+
+
+def test_knossos_parallel_vs_serial():
+    vsqrl_parallel = knossos.register_direct(
+        mod.sqrl, vmap=True, parallel=True, generate_lm=True
+    )
+    x = torch.rand(100, 3, 4)
+    assert torch.equal(vsqrl_parallel(x), mod.vsqrl(x))
@@ -1,10 +1,19 @@
 import pytest
 
+import json
 import math
+import types
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict
 import torch
 import numpy
 
+from ksc import utils
+import ksc.compile
 import ksc.torch_frontend as knossos
+from ksc.parse_ks import parse_ks_filename, parse_ks_string
+from ksc.type_propagate import type_propagate_decls
 from ksc.torch_utils import elementwise_apply
 
 
@@ -61,7 +70,7 @@ def test_ts2k_relux():
 
 
 def test_ts2k_relux_grad():
-    relux._reset_allocator((1.3,))  # TODO: remove when entry_vjp knows how to compile
+    relux._reset_allocator(1.3)
     ks_ans = relux._entry_vjp(1.3, 1.0)
     ans = grad_relux(1.3)
     assert pytest.approx(ks_ans, 1e-6) == ans
@@ -82,6 +91,279 @@ def test_ts2k_vrelux():
     assert torch.isclose(pt_ans, ks_ans, rtol=1e-05, atol=1e-06, equal_nan=False).all()
 
 
+vrelux_parallel = knossos.register_direct(relux, elementwise=True, parallel=True)
+
+
+@pytest.fixture(params=[1, 3])
+def num_threads(request):
+    old_num_threads = torch.get_num_threads()
+    torch.set_num_threads(request.param)
+    yield request.param
+    torch.set_num_threads(old_num_threads)
+
+
+def test_ts2k_vrelux_parallel(num_threads):
+    # Large enough to be split between threads
+    y = torch.randn(400, 300)
+    assert torch.equal(vrelux_parallel(y), vrelux(y))
+
+
+def sin_times(x: torch.Tensor):
+    return torch.sin(x) * x
+
+
+vsin_times = knossos.register_direct(sin_times, vmap=True)
+vsin_times_parallel = knossos.register_direct(sin_times, vmap=True, parallel=True)
+
+
+def test_vmap_parallel(num_threads):
+    x = torch.randn(50, 3, 4)
+    ks_ans = vsin_times_parallel(x)
+    assert torch.equal(ks_ans, vsin_times(x))
+    assert torch.allclose(ks_ans, sin_times(x))
+
+
+@pytest.mark.parametrize(
+    "make_strided",
+    [lambda x: x.transpose(0, 2), lambda x: x[::2], lambda x: x[:, :, 1:]],
+)
+def test_strided_inputs(make_strided):
+    x = make_strided(torch.randn(20, 30, 40))
+    assert not x.is_contiguous()
+    assert torch.equal(vsin_times(x), vsin_times(x.contiguous()))
+    assert torch.equal(vrelux(x), vrelux(x.contiguous()))
+    assert torch.equal(vrelux_parallel(x), vrelux(x.contiguous()))
+
+    @knossos.register
+    def ks_sin_times(x: torch.Tensor):
+        return torch.sin(x) * x
+
+    assert torch.equal(ks_sin_times(x), ks_sin_times(x.contiguous()))
+
+
+@pytest.mark.parametrize("dtype", [torch.float16, torch.bfloat16, torch.float64])
+def test_elementwise_dtypes(dtype):
+    y = torch.randn(40, 30)
+    ks_ans = vrelux(y.to(dtype))
+    assert ks_ans.dtype == dtype
+    if dtype == torch.float64:
+        assert torch.allclose(ks_ans, vrelux(y).double())
+    else:
+        # Computed in float, so rounding only the result
+        assert torch.equal(ks_ans, vrelux(y.to(dtype).float()).to(dtype))
+
+
+def test_float64_gradcheck():
+    ks_sin_times = knossos.register_direct(sin_times)
+    x = torch.randn(3, 4, dtype=torch.float64, requires_grad=True)
+    assert ks_sin_times(x).dtype == torch.float64
+    assert torch.autograd.gradcheck(ks_sin_times, (x,))
+
+
+int_tensor_sum_cpp = """
+#include "knossos-entry-points-torch.h"
+
+ks::Integer entry(torch::Tensor t) {
+    using namespace ks::entry_points;
+    return with_thread_allocator_torch([&](ks::allocator * alloc) {
+        auto ks_t = convert_to_ks_viewing_tensordata<ks::tensor<1, ks::Integer>>(t);
+        ks::Integer total = 0;
+        for (int i = 0; i != ks_t.size(); ++i) {
+            total += ks_t[i] % 1000;
+        }
+        return total;
+    });
+}
+"""
+
+
+def test_int64_tensor_arguments():
+    py_mod = ksc.compile.build_module_using_pytorch_from_cpp(
+        int_tensor_sum_cpp,
+        [("entry", "entry")],
+        "test_int64_tensor_arguments",
+        knossos.default_cflags,
+    )
+    x = torch.tensor([-(2 ** 31), 2 ** 31 - 1, 5])
+    # int64 tensors are passed as they are, and narrowed by the entry point
+    assert knossos.torch_to_ks(x) is x
+    expected = int(torch.fmod(x.to(torch.int32), 1000).sum())
+    assert py_mod.entry(x) == expected
+    assert py_mod.entry(x.to(torch.int32)) == expected
+    assert py_mod.entry(torch.stack([x, x], 1)[:, 0]) == expected
+    with pytest.raises(ValueError, match="outside the range of int32"):
+        py_mod.entry(torch.tensor([2 ** 31]))
+    with pytest.raises(ValueError, match="outside the range of int32"):
+        py_mod.entry(torch.tensor([-(2 ** 31) - 1]))
+
+
+@pytest.fixture
+def emulate_cuda(monkeypatch):
+    """
+    Build CUDA entry points for the host, so that they run on CPU tensors.
+    """
+    monkeypatch.setattr(ksc.compile, "emulate_cuda", True)
+
+
+def compile_for_cuda(stub, example_inputs, name):
+    return stub.compile(
+        example_inputs, name, knossos.CompileConfiguration(gpu=True)
+    ).py_mod
+
+
+def mul_add(x: float, y: float, z: float):
+    return x * y + z
+
+
+def test_cuda_elementwise_three_args(emulate_cuda):
+    vmul_add = knossos.register_direct(mul_add, elementwise=True)
+    x, y, z = (torch.randn(20, 30) for _ in range(3))
+    py_mod = compile_for_cuda(vmul_add, (x, y, z), "test_cuda_elementwise_mul_add")
+    assert torch.equal(py_mod.entry(x, y, z), vmul_add(x, y, z))
+
+
+def mean_times(x: torch.Tensor, a: float):
+    return torch.mean(x) * a
+
+
+mul_add_map_gpu_cpp = """
+#include "knossos-entry-points-torch-cuda.cuh"
+
+struct mul_add_functor {
+    template<typename scalar_t>
+    inline KS_FUNCTION scalar_t operator()(scalar_t x, scalar_t y, scalar_t z) {
+        ks::Float ks_x = x, ks_y = y, ks_z = z;
+        return ks_x * ks_y + ks_z;
+    }
+};
+
+torch::Tensor entry(torch::Tensor x, torch::Tensor y, torch::Tensor z) {
+    return map_gpu(mul_add_functor{}, x, y, z);
+}
+"""
+
+
+@pytest.mark.parametrize("dtype", [torch.float16, torch.bfloat16, torch.float64])
+def test_cuda_elementwise_dtypes(dtype):
+    # Built from C++, as cgen.generate_cpp_cuda_entry_point would, and
+    # for the host (see ksc.compile.emulate_cuda), so that it needs no
+    # ksc, nor GPU
+    py_mod = ksc.compile.build_module_using_pytorch_from_cpp(
+        mul_add_map_gpu_cpp,
+        [("entry", "entry")],
+        "test_cuda_elementwise_" + str(dtype).split(".")[-1],
+        knossos.default_cflags
+        + ksc.compile.cuda_emulation_cflags
+        + knossos._float_dtype_cflags(dtype, knossos.VecSpec_Elementwise()),
+    )
+    x, y, z = (torch.randn(20, 30).to(dtype) for _ in range(3))
+    ks_ans = py_mod.entry(x, y, z)
+    assert ks_ans.dtype == dtype
+    if dtype == torch.float64:
+        assert torch.allclose(ks_ans, x * y + z)
+    else:
+        # Computed in float, so rounding only the result
+        assert torch.equal(ks_ans, (x.float() * y.float() + z.float()).to(dtype))
+    with pytest.raises(RuntimeError, match="must have scalar type"):
+        py_mod.entry(x.float(), y.float(), z.float())
+
+
+def test_cuda_vmap(emulate_cuda):
+    vmean_times = knossos.register_direct(mean_times, vmap=True)
+    x = torch.randn(50, 3, 4)
+    a = torch.randn(50)
+    py_mod = compile_for_cuda(vmean_times, (x, a), "test_cuda_vmap_mean_times")
+    assert torch.allclose(py_mod.entry(x, a), vmean_times(x, a))
+
+
+def test_check_cuda_entry_def():
+    symtab = {}
+    prelude_ks = utils.get_ksc_dir() + "/src/runtime/prelude.ks"
+    prelude = list(parse_ks_filename(prelude_ks))
+    type_propagate_decls(prelude, symtab)
+    decls = list(
+        parse_ks_string(
+            """
+            (def first Float ((x : Tensor 1 Float)) (index 0 x))
+            (def copy (Tensor 1 Float) ((x : Tensor 1 Float))
+                (build (size x) (lam (i : Integer) (index i x))))
+            (def first_of_copy Float ((x : Tensor 1 Float)) (first (copy x)))
+            """,
+            "test_check_cuda_entry_def",
+        )
+    )
+    type_propagate_decls(decls, symtab)
+    first, copy, first_of_copy = decls
+
+    def check(decl, vectorization):
+        knossos._check_cuda_entry_def(decl, prelude + decls, vectorization)
+
+    check(first, knossos.VecSpec_VMap())
+    with pytest.raises(ValueError, match="must return a Float"):
+        check(copy, knossos.VecSpec_VMap())
+    # Device code has no allocator, however deep the allocation
+    with pytest.raises(ValueError, match="cannot allocate"):
+        check(first_of_copy, knossos.VecSpec_VMap())
+    with pytest.raises(ValueError, match="cannot allocate"):
+        check(first_of_copy, knossos.VecSpec_Elementwise())
+
+
+def test_allocator_per_thread():
+    xs = [torch.randn(20, 30, 40) for _ in range(8)]
+    with ThreadPoolExecutor(4) as executor:
+        results = list(executor.map(vsin_times, xs))
+    for x, ks_ans in zip(xs, results):
+        assert torch.equal(ks_ans, vsin_times(x))
+
+
+def test_allocator_grows():
+    x = torch.randn(20, 30, 40)
+    py_mod = vsin_times.autogradFunction(x).py_mod
+    capacity = py_mod.allocator_capacity()
+    py_mod.set_allocator_capacity(256)
+    try:
+        assert py_mod.allocator_capacity() == 256
+        assert torch.allclose(vsin_times(x), sin_times(x))
+        assert py_mod.allocator_capacity() > 256
+        assert all(peak <= cap for cap, peak in py_mod.allocator_stats())
+    finally:
+        py_mod.set_allocator_capacity(capacity)
+
+
+def test_allocator_overflows_after_shrinking():
+    # The peak usage of the larger buffer exceeds the capacity of the
+    # smaller one, so it must not suppress the overflow check.
+    x = torch.randn(20, 30, 40)
+    py_mod = vsin_times.autogradFunction(x).py_mod
+    capacity = py_mod.allocator_capacity()
+    try:
+        py_mod.set_allocator_capacity(1 << 24)
+        assert torch.allclose(vsin_times(x), sin_times(x))
+        assert py_mod.allocator_peak() > 256
+        py_mod.set_allocator_capacity(256)
+        assert py_mod.allocator_capacity() == 256
+        assert torch.allclose(vsin_times(x), sin_times(x))
+        assert py_mod.allocator_capacity() > 256
+    finally:
+        py_mod.set_allocator_capacity(capacity)
+
+
+def test_view_results():
+    @knossos.register(view_results=True)
+    def ks_sin_times(x: torch.Tensor):
+        return torch.sin(x) * x
+
+    # Large results view the allocator's buffer, which is not reused while
+    # they live; small ones are copied
+    for x in [torch.randn(200, 300), torch.randn(2, 3)]:
+        y1 = ks_sin_times(x)
+        y1_copy = y1.clone()
+        y2 = ks_sin_times(2 * x)
+        assert torch.equal(y1, y1_copy)
+        assert torch.allclose(y1, sin_times(x))
+        assert torch.allclose(y2, sin_times(2 * x))
+
+
 @knossos.register(generate_lm=True)
 def bar(a: int, x: float):
     y = torch.tensor([[1.1, -1.2], [2.1, 2.2]])
@@ -204,3 +486,253 @@ def test_relu3(generate_lm):
         ks_ans = ks_relu3._entry_vjp(x, 1.0)
 
         assert pytest.approx(ks_ans, 1e-6) == py_ans
+
+
+def test_precompile_and_manifest(tmp_path):
+    @knossos.register
+    def ks_relu3(x: float):
+        return relu3(x)
+
+    (compiled,) = knossos.precompile([(ks_relu3, (0.5,))])
+    assert ks_relu3.ensure_compiled((0.5,)) is compiled
+
+    manifest = tmp_path / "manifest.json"
+    knossos.save_manifest(manifest, [ks_relu3])
+
+    # A fresh stub, as in a new process, loads the extension without compiling
+    fresh = knossos.register_direct(ks_relu3.raw_f)
+    assert fresh.compiled == {}
+    assert knossos.load_manifest(manifest, [fresh]) == 1
+    assert pytest.approx(fresh._entry(0.5), 1e-6) == relu3(0.5)
+
+
+def test_precompile_deduplicates(monkeypatch):
+    def g(x: torch.Tensor):
+        return x
+
+    stub = knossos.register_direct(g)
+    compiles = []
+
+    class FakeCompiled:
+        py_mod = types.SimpleNamespace(__name__="fake", __file__=__file__)
+
+    def fake_compile(example_inputs, torch_extension_name, configuration):
+        compiles.append(configuration)
+        compiled = FakeCompiled()
+        stub._add_compiled(configuration, compiled)
+        return compiled
+
+    monkeypatch.setattr(stub, "compile", fake_compile)
+    x, y = torch.randn(2, 3), torch.randn(4, 5)
+    results = knossos.precompile([(stub, (x,)), (stub, (y,)), (stub, (x[0],))] * 4)
+    assert len(compiles) == 2
+    assert results[0] is results[1] is results[3]
+    assert results[2] is not results[0]
+
+
+def test_precompile_configurations_in_parallel(monkeypatch):
+    def g(x: torch.Tensor):
+        return x
+
+    stub = knossos.register_direct(g)
+    # Each compile waits for all four: this fails if they are serialized
+    barrier = threading.Barrier(4, timeout=10)
+
+    class FakeCompiled:
+        py_mod = types.SimpleNamespace(__name__="fake", __file__=__file__)
+
+    def fake_compile(example_inputs, torch_extension_name, configuration):
+        barrier.wait()
+        compiled = FakeCompiled()
+        stub._add_compiled(configuration, compiled)
+        return compiled
+
+    monkeypatch.setattr(stub, "compile", fake_compile)
+    inputs = [(torch.zeros([1] * rank),) for rank in range(1, 5)]
+    results = knossos.precompile([(stub, x) for x in inputs], max_workers=4)
+    assert len(set(map(id, results))) == 4
+
+
+def test_compile_configuration_signature():
+    def config(*args):
+        return knossos._compile_configuration(args)
+
+    x = torch.randn(2, 3)
+    assert config(x) == config(torch.randn(4, 5))
+    assert config(x) != config(torch.randn(2, 3, 4))
+    assert config(x) != config(x.double())
+    assert config(x) != config(1.3)
+    c = config(x, 1.3)
+    assert (
+        knossos.CompileConfiguration.from_json(json.loads(json.dumps(asdict(c)))) == c
+    )
+
+
+def test_compiled_lru_eviction():
+    def g(x: torch.Tensor):
+        return x
+
+    stub = knossos.register_direct(g)
+    stub.max_compiled = 2
+
+    class FakeCompiled:
+        py_mod = types.SimpleNamespace(__name__="fake", __file__=__file__)
+
+    ranks = [1, 2, 1, 3]
+    for rank in ranks:
+        config = knossos._compile_configuration((torch.zeros([1] * rank),))
+        if config not in stub.compiled:
+            stub._add_compiled(config, FakeCompiled())
+        else:
+            stub.ensure_compiled((torch.zeros([1] * rank),))
+
+    remaining_ranks = [config.signature[0][2] for config in stub.compiled]
+    assert remaining_ranks == [1, 3]
+
+
+def test_compiled_lru_threads():
+    def g(x: torch.Tensor):
+        return x
+
+    stub = knossos.register_direct(g)
+    stub.max_compiled = 3
+
+    class FakeCompiled:
+        py_mod = types.SimpleNamespace(__name__="fake", __file__=__file__)
+
+    def use(rank):
+        config = knossos._compile_configuration((torch.zeros([1] * rank),))
+        if stub._lookup_compiled(config) is None:
+            stub._add_compiled(config, FakeCompiled())
+
+    with ThreadPoolExecutor(8) as executor:
+        list(executor.map(use, [i % 5 + 1 for i in range(1000)]))
+    assert len(stub.compiled_items()) == 3
+
+
+def test_autograd_function_marshalling():
+    # A stand-in for a compiled module, computing f(x) = 2 * x
+    class FakeModule:
+        __name__ = "fake"
+        calls = []
+
+        @staticmethod
+        def reset_allocator():
+            pass
+
+        @staticmethod
+        def entry(x):
+            FakeModule.calls.append(x)
+            return x * 2
+
+        @staticmethod
+        def entry_vjp(x, df):
+            FakeModule.calls.append(x)
+            return df * 2
+
+    f = knossos.make_KscAutogradFunction(FakeModule)
+
+    # Contiguous inputs are passed, and saved for backward, without a copy
+    x = torch.randn(3, 4, requires_grad=True)
+    y = f.apply(x)
+    (dx,) = torch.autograd.grad(y.sum(), x)
+    assert FakeModule.calls[0] is x
+    assert FakeModule.calls[1].data_ptr() == x.data_ptr()
+    assert torch.equal(dx, torch.full((3, 4), 2.0))
+
+    # Non-contiguous CPU inputs are passed through too, for the entry point
+    # to read through their strides
+    FakeModule.calls.clear()
+    xt = torch.randn(4, 3, requires_grad=True)
+    y = f.apply(xt.t())
+    (dxt,) = torch.autograd.grad(y.sum(), xt)
+    assert not FakeModule.calls[0].is_contiguous()
+    assert FakeModule.calls[0].data_ptr() == xt.data_ptr()
+    assert FakeModule.calls[1].data_ptr() == xt.data_ptr()
+    assert torch.equal(dxt, torch.full((4, 3), 2.0))
+
+
+def test_autograd_function_fused_vjp():
+    # A stand-in for a compiled module with split derivative passes,
+    # computing f(x) = x * x
+    class FakeModule:
+        __name__ = "fake"
+        calls = []
+
+        @staticmethod
+        def reset_allocator():
+            pass
+
+        @staticmethod
+        def entry(x):
+            FakeModule.calls.append("entry")
+            return x * x
+
+        @staticmethod
+        def entry_fwdpass(x):
+            FakeModule.calls.append("entry_fwdpass")
+            return x * x, 2 * x
+
+        @staticmethod
+        def entry_revpass(df, saved):
+            FakeModule.calls.append("entry_revpass")
+            return df * saved
+
+    f = knossos.make_KscAutogradFunction(FakeModule)
+    x = torch.randn(3, 4, requires_grad=True)
+    (dx,) = torch.autograd.grad(f.apply(x).sum(), x)
+    assert FakeModule.calls == ["entry_fwdpass", "entry_revpass"]
+    assert torch.equal(dx, 2 * x)
+
+    # Without gradients, there is nothing to save
+    FakeModule.calls.clear()
+    with torch.no_grad():
+        f.apply(x)
+    f.apply(x.detach())
+    assert FakeModule.calls == ["entry", "entry"]
+
+
+def test_fused_vjp():
+    @knossos.register(generate_lm=False)
+    def ks_sin_times(x: torch.Tensor):
+        return torch.sin(x) * x
+
+    x = torch.randn(20, 30, requires_grad=True)
+    ks_compiled = ks_sin_times.autogradFunction(x)
+    assert hasattr(ks_compiled.py_mod, "entry_fwdpass")
+    unfused = knossos.make_KscAutogradFunction(ks_compiled.py_mod, fused_vjp=False)
+
+    # Two forward passes before the backward passes, so that the first
+    # pass's saved values must survive the second pass
+    y1 = ks_sin_times(x)
+    y2 = ks_sin_times(2 * x)
+    (dx,) = torch.autograd.grad(y1.sum() + y2.sum(), x)
+    (dx_unfused,) = torch.autograd.grad(
+        unfused.apply(x).sum() + unfused.apply(2 * x).sum(), x
+    )
+    assert torch.allclose(dx, dx_unfused)
+
+
+def test_call_batch():
+    @knossos.register
+    def ks_relu3(x: float):
+        return relu3(x)
+
+    xs = [-0.1, 0.31221, 2.27160]
+    ks_ans = ks_relu3.call_batch([(x,) for x in xs])
+    assert torch.allclose(ks_ans, torch.tensor([relu3(x) for x in xs]))
+
+    ks_ans_stacked = ks_relu3.call_stacked(torch.tensor(xs))
+    assert torch.equal(ks_ans, ks_ans_stacked)
+
+
+def test_torch_stack_from_ks():
+    assert torch.equal(
+        knossos.torch_stack_from_ks([1.0, 2.0]), torch.tensor([1.0, 2.0])
+    )
+
+    x = torch.randn(3)
+    y = torch.randn(3)
+    stacked_x, stacked_f = knossos.torch_stack_from_ks([(x, 1.0), (y, 2.0)])
+    assert torch.equal(stacked_x, torch.stack([x, y]))
+    assert torch.equal(stacked_f, torch.tensor([1.0, 2.0]))